@@ -239,6 +239,8 @@ GAME_MEDIA_PATH_ROOT = 'game/'
 DEFAULT_GAME_IMAGE = os.path.join(GAME_MEDIA_PATH_ROOT, 'default.svg')
 COLLECTION_MEDIA_PATH_ROOT = 'collection/'
 DEFAULT_COLLECTION_IMAGE = os.path.join(COLLECTION_MEDIA_PATH_ROOT, 'default.svg')
+# covers of books, movies, music and games are stored here by hash of their content
+COVER_MEDIA_PATH_ROOT = 'cover/'
 SYNC_FILE_PATH_ROOT = 'sync/'
 EXPORT_FILE_PATH_ROOT = 'export/'
 
@@ -278,6 +280,79 @@ LUMINATI_PASSWORD = 'nsb7te9bw0ney'
 
 SCRAPING_TIMEOUT = 90
 
+# Scrapers and searchers keep up to HTTP_POOL_SIZE connections alive to each host,
+# failed connections, 429 and 5xx responses are retried HTTP_RETRIES times with exponential backoff,
+# waiting no more than HTTP_MAX_RETRY_AFTER seconds when server asks to retry later;
+# read timeouts are not retried, so a scrape never waits much longer than SCRAPING_TIMEOUT for a page
+HTTP_POOL_SIZE = 10
+HTTP_RETRIES = 2
+HTTP_RETRY_BACKOFF = 0.5
+HTTP_MAX_RETRY_AFTER = 30
+# Requests to each host are limited to HTTP_RATE per second (or as in HTTP_RATE_LIMITS)
+# with bursts of HTTP_BURST, waiting no more than HTTP_RATE_MAX_WAIT seconds for their turn;
+# the rate of a host is halved each time it throttles us, and restored after it's left
+# alone for HTTP_RATE_RECOVERY seconds. A host failing HTTP_BREAKER_THRESHOLD times in a row
+# is not requested for HTTP_BREAKER_COOLDOWN seconds.
+HTTP_RATE = 10
+HTTP_BURST = 20
+HTTP_RATE_LIMITS = {
+    'book.douban.com': 2,
+    'movie.douban.com': 2,
+    'music.douban.com': 2,
+    'www.douban.com': 2,
+}
+HTTP_RATE_MAX_WAIT = 30
+HTTP_RATE_RECOVERY = 300
+HTTP_BREAKER_THRESHOLD = 10
+HTTP_BREAKER_COOLDOWN = 120
+
+# Whether an unknown host is a custom domain of a supported site (e.g. Bandcamp) is
+# found by DNS lookups, their answers are kept for SCRAPER_DNS_CACHE_TTL seconds,
+# or SCRAPER_DNS_NEGATIVE_TTL seconds if the host is not supported
+SCRAPER_DNS_CACHE_TTL = 86400
+SCRAPER_DNS_NEGATIVE_TTL = 3600
+SCRAPER_DNS_TIMEOUT = 3
+
+# Scrape results are cached in redis by url for SCRAPE_CACHE_TTL seconds, so scraping
+# an item again soon (e.g. retry after a failed save) does not download it again;
+# pages not found or hidden by the site are remembered for SCRAPE_CACHE_NEGATIVE_TTL seconds
+SCRAPE_CACHE_TTL = 3600
+SCRAPE_CACHE_NEGATIVE_TTL = 21600
+# Only one worker scrapes a new url at a time, others wait up to SCRAPE_LOCK_WAIT seconds
+# for it to be saved; the lock expires after SCRAPE_LOCK_TTL seconds if the worker dies
+SCRAPE_LOCK_TTL = 180
+SCRAPE_LOCK_WAIT = 60
+
+# Douban pages are fetched via fallbacks (ProxyCrawl, Wayback Machine) too if the live page
+# is not back in DOUBAN_HEDGE_DELAY seconds; after Douban bans our IP, fallbacks start right
+# away for DOUBAN_BAN_COOLDOWN seconds. DOUBAN_FETCH_WORKERS threads are shared by all fetches.
+DOUBAN_HEDGE_DELAY = 5
+DOUBAN_BAN_COOLDOWN = 600
+DOUBAN_FETCH_WORKERS = 32
+
+# Doufen sync scrapes up to SYNC_SCRAPE_CONCURRENCY items ahead of the row being synced,
+# Goodreads import up to SYNC_SCRAPE_CONCURRENCY items at a time,
+# no more than SYNC_SCRAPE_PER_HOST of them from the same site at a time
+SYNC_SCRAPE_CONCURRENCY = 6
+SYNC_SCRAPE_PER_HOST = 3
+
+# Progress of running sync and import jobs is published to redis on every item,
+# and saved to db every SYNC_PROGRESS_FLUSH_ITEMS items or SYNC_PROGRESS_FLUSH_INTERVAL seconds;
+# marks synced from Doufen are also written to db in chunks of this size
+SYNC_PROGRESS_FLUSH_ITEMS = 50
+SYNC_PROGRESS_FLUSH_INTERVAL = 10
+
+# External search queries all providers at the same time, results not
+# arrived in EXTERNAL_SEARCH_DEADLINE seconds are left out of the page
+EXTERNAL_SEARCH_TIMEOUT = 5
+EXTERNAL_SEARCH_DEADLINE = 6
+# External search results are cached in redis for EXTERNAL_SEARCH_CACHE_TTL seconds,
+# then served for another EXTERNAL_SEARCH_CACHE_STALE_TTL seconds while being refreshed;
+# empty results are cached for EXTERNAL_SEARCH_CACHE_NEGATIVE_TTL seconds
+EXTERNAL_SEARCH_CACHE_TTL = 3600
+EXTERNAL_SEARCH_CACHE_STALE_TTL = 86400
+EXTERNAL_SEARCH_CACHE_NEGATIVE_TTL = 300
+
 # ScraperAPI api key
 SCRAPERAPI_KEY = '***REMOVED***'
 PROXYCRAWL_KEY = None
@@ -303,12 +378,32 @@ IGDB_ACCESS_TOKEN = requests.post(f'https://id.twitch.tv/oauth2/token?client_id=
 
 # Thumbnail setting
 # It is possible to optimize the image size even more: https://easy-thumbnails.readthedocs.io/en/latest/ref/optimize/
+# thumbnails of all aliases are generated in background when a cover is saved,
+# pages show the original image until they are ready
+# also save a WebP copy of each thumbnail, used by browsers supporting it
+THUMBNAIL_WEBP = True
+THUMBNAIL_WEBP_QUALITY = 80
+# 'webp' option puts '_webp' in thumbnail names, such a thumbnail is only saved after its WebP copy,
+# so pages know the copy exists without checking storage; thumbnails made before are generated again
 THUMBNAIL_ALIASES = {
     '': {
+        'small': {
+            'size': (100, 100),
+            'crop': 'scale',
+            'autocrop': True,
+            'webp': THUMBNAIL_WEBP,
+        },
         'normal': {
             'size': (200, 200),
             'crop': 'scale',
             'autocrop': True,
+            'webp': THUMBNAIL_WEBP,
+        },
+        'large': {
+            'size': (400, 400),
+            'crop': 'scale',
+            'autocrop': True,
+            'webp': THUMBNAIL_WEBP,
         },
     },
 }
@@ -322,6 +417,13 @@ if DEBUG:
 REDIS_HOST = os.environ.get('REDIS_HOST', '127.0.0.1')
 
 RQ_QUEUES = {
+    # no job is queued here, its connection is used for caches and counters
+    'default': {
+        'HOST': REDIS_HOST,
+        'PORT': 6379,
+        'DB': 0,
+        'DEFAULT_TIMEOUT': -1,
+    },
     'mastodon': {
         'HOST': REDIS_HOST,
         'PORT': 6379,
@@ -339,6 +441,24 @@ RQ_QUEUES = {
         'PORT': 6379,
         'DB': 0,
         'DEFAULT_TIMEOUT': -1,
+    },
+    'index': {
+        'HOST': REDIS_HOST,
+        'PORT': 6379,
+        'DB': 0,
+        'DEFAULT_TIMEOUT': -1,
+    },
+    'thumbnail': {
+        'HOST': REDIS_HOST,
+        'PORT': 6379,
+        'DB': 0,
+        'DEFAULT_TIMEOUT': -1,
+    },
+    'scrape': {
+        'HOST': REDIS_HOST,
+        'PORT': 6379,
+        'DB': 0,
+        'DEFAULT_TIMEOUT': -1,
     }
 }
 
@@ -346,6 +466,12 @@ RQ_SHOW_ADMIN_LINK = True
 
 SEARCH_INDEX_NEW_ONLY = False
 
+# index updates are queued and written in batch after this many seconds, 0 to update synchronously in request
+SEARCH_INDEX_QUEUE_WINDOW = 2
+
+
+# use a table in PostgreSQL as search index, no extra service needed, run `init_index` and `reindex` after switching
+# SEARCH_BACKEND = 'POSTGRES'
 
 # SEARCH_BACKEND = 'MEILISEARCH'
 # MEILISEARCH_SERVER = 'http://127.0.0.1:7700'
@@ -6,5 +6,7 @@ class BooksConfig(AppConfig):
 
     def ready(self):
         from common.index import Indexer
+        from common.thumbnails import init_thumbnail_handler
         from .models import Book
         Indexer.update_model_indexable(Book)
+        init_thumbnail_handler(Book)
@@ -4,6 +4,7 @@ from django.db import models
 from django.shortcuts import reverse
 from common.models import Entity, Mark, Review, Tag, MarkStatusEnum
 from common.utils import GenerateDateUUIDMediaFilePath
+from common.storage import cover_storage
 from django.conf import settings
 from django.db.models import Q
 from simple_history.models import HistoricalRecords
@@ -58,7 +59,7 @@ class Book(Entity):
     isbn = models.CharField(_("ISBN"), blank=True, null=False,
                             max_length=20, db_index=True, default='')
     # to store previously scrapped data
-    cover = models.ImageField(_("cover picture"), upload_to=book_cover_path,
+    cover = models.ImageField(_("cover picture"), upload_to=book_cover_path, storage=cover_storage,
                               default=settings.DEFAULT_BOOK_IMAGE, blank=True)
     contents = models.TextField(blank=True, default="")
     history = HistoricalRecords()
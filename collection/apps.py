@@ -4,3 +4,8 @@ from django.apps import AppConfig
 class CollectionConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'collection'
+
+    def ready(self):
+        from common.thumbnails import init_thumbnail_handler
+        from .models import Collection
+        init_thumbnail_handler(Collection)
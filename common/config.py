@@ -1,6 +1,12 @@
 # how many items are showed in one search result page
 ITEMS_PER_PAGE = 20
 
+# max number of matches per category considered by search without search backend
+SEARCH2_MAX_CANDIDATES = 500
+
+# scraping page polls every 2 seconds, and gives up after this many polls
+SCRAPE_STATUS_MAX_POLLS = 150
+
 # how many pages links in the pagination
 PAGE_LINK_NUMBER = 7
 
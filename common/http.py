@@ -0,0 +1,247 @@
+"""
+Shared http sessions for scrapers and searchers.
+
+Each host gets its own pooled session so that connections are kept alive and
+reused between requests. Failed connections are retried by the session, 429 and
+5xx responses are retried with backoff by `request()`, honouring `Retry-After`
+from the server; each retry takes a token and counts in the circuit breaker.
+Read timeouts are not retried, a slow host would otherwise hold a scrape job
+for several timeouts.
+
+Cookies are not kept between requests, so going through a shared session
+behaves the same as calling `requests.get` each time.
+
+Requests to each host are rate limited by a token bucket, and a host failing
+HTTP_BREAKER_THRESHOLD times in a row is not requested for HTTP_BREAKER_COOLDOWN
+seconds. Being throttled (429, or a ban reported by scrapers) halves the rate of
+the host until it's left alone for HTTP_RATE_RECOVERY seconds. The state is kept
+in redis and shared by all processes.
+"""
+import logging
+import threading
+import time
+import urllib.parse
+import django_rq
+from http.cookiejar import DefaultCookiePolicy
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+
+_sessions = {}
+_lock = threading.Lock()
+_acquire_script = None
+
+
+BUCKET_KEY_PREFIX = 'http:bucket:'
+RATE_FACTOR_KEY_PREFIX = 'http:rate_factor:'
+FAILURES_KEY_PREFIX = 'http:failures:'
+BREAKER_KEY_PREFIX = 'http:breaker:'
+MIN_RATE_FACTOR = 1 / 16
+
+# take a token and return seconds to wait before using it, or -1 if host is unavailable.
+# tokens may go negative: each waiting caller reserves its own slot, so concurrent callers are spaced out.
+# if the wait would exceed max wait, nothing is reserved and the wait is returned for caller to give up.
+ACQUIRE_SCRIPT = """
+if redis.call('EXISTS', KEYS[3]) == 1 then
+    return '-1'
+end
+local rate = tonumber(ARGV[1]) * tonumber(redis.call('GET', KEYS[2]) or '1')
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local max_wait = tonumber(ARGV[4])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'time')
+local tokens = tonumber(bucket[1]) or burst
+local last = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - last) * rate)
+local wait = math.max(0, (1 - tokens) / rate)
+if wait > max_wait then
+    return tostring(wait)
+end
+tokens = tokens - 1
+redis.call('HMSET', KEYS[1], 'tokens', tokens, 'time', now)
+redis.call('EXPIRE', KEYS[1], math.ceil((burst - tokens) / rate) + 1)
+return tostring(wait)
+"""
+
+
+class HostUnavailable(requests.exceptions.ConnectionError):
+    """
+    Host is failing or throttling us, request is not sent
+    """
+    pass
+
+
+def _create_session():
+    session = requests.Session()
+    session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+    # only connection errors are retried here, responses are retried in request() through rate limits
+    retry = Retry(
+        total=settings.HTTP_RETRIES,
+        read=0,
+        backoff_factor=settings.HTTP_RETRY_BACKOFF,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=settings.HTTP_POOL_SIZE, max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_retry_delay(response, attempt):
+    """
+    Seconds to wait before retrying a 429 or 5xx response: `Retry-After` if given,
+    never longer than HTTP_MAX_RETRY_AFTER, otherwise exponential backoff
+    """
+    retry_after = response.headers.get('Retry-After')
+    if retry_after:
+        try:
+            return min(Retry().parse_retry_after(retry_after), settings.HTTP_MAX_RETRY_AFTER)
+        except Exception:
+            pass
+    return settings.HTTP_RETRY_BACKOFF * (2 ** attempt)
+
+
+def get_host(url):
+    return urllib.parse.urlparse(url).netloc.lower()
+
+
+def get_session(url):
+    host = get_host(url)
+    session = _sessions.get(host)
+    if session is None:
+        with _lock:
+            session = _sessions.get(host)
+            if session is None:
+                session = _create_session()
+                _sessions[host] = session
+    return session
+
+
+def request(method, url, **kwargs):
+    kwargs.setdefault('timeout', settings.SCRAPING_TIMEOUT)
+    host = get_host(url)
+    attempt = 0
+    while True:
+        acquire(host, kwargs['timeout'])
+        try:
+            if kwargs.get('proxies'):
+                # rotating proxy sessions are different connections anyway, pooling them only leaks pools
+                r = requests.request(method, url, **kwargs)
+            else:
+                r = get_session(url).request(method, url, **kwargs)
+        except Exception:
+            report_failure(host)
+            raise
+        if r.status_code == 429:
+            report_failure(host, throttled=True)
+        elif r.status_code >= 500:
+            report_failure(host)
+        else:
+            report_success(host)
+            return r
+        if attempt >= settings.HTTP_RETRIES:
+            return r
+        time.sleep(get_retry_delay(r, attempt))
+        attempt += 1
+
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request('POST', url, **kwargs)
+
+
+def get_rate(host):
+    return settings.HTTP_RATE_LIMITS.get(host, settings.HTTP_RATE)
+
+
+def acquire(host, timeout):
+    """
+    Take a token of host and wait until it can be used, no longer than HTTP_RATE_MAX_WAIT or timeout of the request;
+    raise HostUnavailable if host is in cooldown or the wait would be longer, no token is taken then
+    """
+    global _acquire_script
+    max_wait = min(settings.HTTP_RATE_MAX_WAIT, timeout or settings.HTTP_RATE_MAX_WAIT)
+    try:
+        conn = django_rq.get_connection('default')
+        if _acquire_script is None:
+            _acquire_script = conn.register_script(ACQUIRE_SCRIPT)
+        keys = [BUCKET_KEY_PREFIX + host, RATE_FACTOR_KEY_PREFIX + host, BREAKER_KEY_PREFIX + host]
+        wait = float(_acquire_script(keys=keys, args=[get_rate(host), settings.HTTP_BURST, time.time(), max_wait], client=conn))
+    except Exception as e:
+        # requests go on without limits when redis is unavailable
+        logger.error(f"unable to acquire rate limit token for {host}: {e}")
+        return
+    if wait < 0:
+        raise HostUnavailable(f"{host} is unavailable, not requested")
+    if wait > max_wait:
+        raise HostUnavailable(f"{host} is rate limited, not requested")
+    if wait > 0:
+        time.sleep(wait)
+
+
+def report_success(host):
+    try:
+        django_rq.get_connection('default').delete(FAILURES_KEY_PREFIX + host)
+    except Exception as e:
+        logger.error(f"unable to report success of {host}: {e}")
+
+
+def report_failure(host, throttled=False):
+    """
+    Count a failure of host, open its breaker after HTTP_BREAKER_THRESHOLD failures in a row.
+    If `throttled`, halve its rate for HTTP_RATE_RECOVERY seconds instead,
+    and open its breaker if still throttled at the lowest rate.
+    """
+    try:
+        conn = django_rq.get_connection('default')
+        if throttled:
+            factor = float(conn.get(RATE_FACTOR_KEY_PREFIX + host) or 1)
+            conn.set(RATE_FACTOR_KEY_PREFIX + host, max(MIN_RATE_FACTOR, factor / 2), ex=settings.HTTP_RATE_RECOVERY)
+            failures = settings.HTTP_BREAKER_THRESHOLD if factor <= MIN_RATE_FACTOR else 0
+        else:
+            failures = conn.incr(FAILURES_KEY_PREFIX + host)
+            conn.expire(FAILURES_KEY_PREFIX + host, settings.HTTP_BREAKER_COOLDOWN * 2)
+        if failures >= settings.HTTP_BREAKER_THRESHOLD:
+            logger.error(f"{host} keeps failing, pausing requests for {settings.HTTP_BREAKER_COOLDOWN} seconds")
+            conn.set(BREAKER_KEY_PREFIX + host, 1, ex=settings.HTTP_BREAKER_COOLDOWN)
+            conn.delete(FAILURES_KEY_PREFIX + host)
+    except Exception as e:
+        logger.error(f"unable to report failure of {host}: {e}")
+
+
+def report_throttled(url):
+    """
+    For scrapers which find they're banned from the content of a response
+    """
+    report_failure(get_host(url), throttled=True)
+
+
+def get_stats():
+    """
+    return {host: {'requests': n, 'connections': n, 'reused': n}} for this process
+    """
+    stats = {}
+    for host, session in list(_sessions.items()):
+        s = {'requests': 0, 'connections': 0}
+        for adapter in set(session.adapters.values()):
+            for key in list(adapter.poolmanager.pools.keys()):
+                pool = adapter.poolmanager.pools.get(key)
+                if pool is not None:
+                    s['requests'] += pool.num_requests
+                    s['connections'] += pool.num_connections
+        s['reused'] = s['requests'] - s['connections']
+        stats[host] = s
+    return stats
+
+
+def log_stats():
+    for host, s in get_stats().items():
+        logger.info(f"{host}: {s['requests']} requests over {s['connections']} connections, {s['reused']} reused")
@@ -1,10 +1,10 @@
 import openpyxl
-import requests
+from common import http
 import re
 from lxml import html
 from markdownify import markdownify as md
 from datetime import datetime
-from common.scraper import get_scraper_by_url
+from common.scraper import get_scraper_by_url, get_or_scrape
 import logging
 import pytz
 from django.conf import settings
@@ -21,6 +21,9 @@ from common.scraper import DoubanAlbumScraper, DoubanBookScraper, DoubanGameScra
 from PIL import Image
 from io import BytesIO
 import filetype
+import json
+import time
+from django.core.serializers.json import DjangoJSONEncoder
 from common.models import MarkStatusEnum
 
 
@@ -39,7 +42,7 @@ def fetch_remote_image(url):
             dl_url = f'http://api.scraperapi.com?api_key={settings.SCRAPERAPI_KEY}&url={url}'
         else:
             dl_url = url
-        img_response = requests.get(dl_url, timeout=settings.SCRAPING_TIMEOUT)
+        img_response = http.get(dl_url, timeout=settings.SCRAPING_TIMEOUT)
         raw_img = img_response.content
         img = Image.open(BytesIO(raw_img))
         img.load()  # corrupted image will trigger exception
@@ -66,12 +69,18 @@ class DoubanImporter:
     user = None
     visibility = 0
     file = None
+    status_saved_time = 0
+    status_saved_processed = 0
 
     def __init__(self, user, visibility):
         self.user = user
         self.visibility = visibility
 
-    def update_user_import_status(self, status):
+    def update_user_import_status(self, status, force=True):
+        """
+        Status is always published to redis, but written to db only when forced
+        or every SYNC_PROGRESS_FLUSH_ITEMS reviews / SYNC_PROGRESS_FLUSH_INTERVAL seconds
+        """
         self.user.preference.import_status['douban_pending'] = status
         self.user.preference.import_status['douban_file'] = self.file
         self.user.preference.import_status['douban_visibility'] = self.visibility
@@ -80,7 +89,40 @@ class DoubanImporter:
         self.user.preference.import_status['douban_skipped'] = self.skipped
         self.user.preference.import_status['douban_imported'] = self.imported
         self.user.preference.import_status['douban_failed'] = self.failed
-        self.user.preference.save(update_fields=['import_status'])
+        key = self.import_status_key(self.user)
+        try:
+            conn = django_rq.get_connection('doufen')
+            if status:
+                conn.set(key, json.dumps(self.user.preference.import_status, cls=DjangoJSONEncoder), ex=86400)
+            else:
+                conn.delete(key)
+        except Exception as e:
+            logger.error(f'{self.user} | error publishing import status: {e}')
+        now = time.time()
+        if force or self.processed - self.status_saved_processed >= settings.SYNC_PROGRESS_FLUSH_ITEMS \
+                or now - self.status_saved_time >= settings.SYNC_PROGRESS_FLUSH_INTERVAL:
+            self.user.preference.save(update_fields=['import_status'])
+            self.status_saved_processed = self.processed
+            self.status_saved_time = now
+
+    @classmethod
+    def import_status_key(cls, user):
+        return f'douban_import:{user.id}:status'
+
+    @classmethod
+    def get_user_import_status(cls, user):
+        """
+        Import status saved in db, updated with the latest one published by running import
+        """
+        import_status = user.get_preference().import_status
+        if import_status.get('douban_pending'):
+            try:
+                latest = django_rq.get_connection('doufen').get(cls.import_status_key(user))
+                if latest:
+                    import_status.update(json.loads(latest))
+            except Exception as e:
+                logger.error(f'{user} | error loading import status: {e}')
+        return import_status
 
     def import_from_file(self, uploaded_file):
         try:
@@ -123,6 +165,9 @@ class DoubanImporter:
     mark_data = {}
     review_data = {}
     entity_lookup = {}
+    # entities and user's reviews of current sheet: {url: entity}, {entity id: review}
+    entities = {}
+    reviews = {}
 
     def load_sheets(self):
         f = open(self.file, 'rb')
@@ -179,6 +224,13 @@ class DoubanImporter:
         if worksheet is None:  # or worksheet.max_row < 2:
             print(f'{prefix} {review_class.__name__} empty sheet')
             return
+        # look up entities and user's reviews of them in bulk, only those missing will be queried or scraped one by one
+        urls = []
+        for cells in worksheet:
+            if len(cells) >= 6:
+                urls.append(self.guess_entity_url(re.sub('^《', '', re.sub('》$', '', cells[1])), cells[4], self.parse_time(cells[3])))
+        self.entities = entity_class.lookup_by_source_urls([u for u in urls if u])
+        self.reviews = review_class.lookup_by_owner(self.user, list(self.entities.values()))
         for cells in worksheet:
             if len(cells) < 6:
                 continue
@@ -189,12 +241,7 @@ class DoubanImporter:
             rating = cells[4]
             content = cells[6]
             self.processed += 1
-            if time:
-                if type(time) == str:
-                    time = datetime.strptime(time, "%Y-%m-%d %H:%M:%S")
-                time = time.replace(tzinfo=tz_sh)
-            else:
-                time = None
+            time = self.parse_time(time)
             if not content:
                 content = ""
             if not title:
@@ -206,7 +253,15 @@ class DoubanImporter:
                 self.skipped += 1
             else:
                 self.failed.append(review_url)
-            self.update_user_import_status(1)
+            self.update_user_import_status(1, force=False)
+
+    def parse_time(self, time):
+        if time:
+            if type(time) == str:
+                time = datetime.strptime(time, "%Y-%m-%d %H:%M:%S")
+            return time.replace(tzinfo=tz_sh)
+        else:
+            return None
 
     def import_review(self, entity_title, rating, title, review_url, content, time, scraper, entity_class, review_class):
         # return 1: done / 2: skipped / None: failed
@@ -219,7 +274,7 @@ class DoubanImporter:
                     _review_url = f'http://api.scrapestack.com/scrape?access_key={settings.SCRAPESTACK_KEY}&url={review_url}'
                 else:
                     _review_url = review_url
-                r = requests.get(_review_url, timeout=settings.SCRAPING_TIMEOUT)
+                r = http.get(_review_url, timeout=settings.SCRAPING_TIMEOUT)
                 if r.status_code != 200:
                     print(f'{prefix} fetching error {review_url} {r.status_code}')
                     return
@@ -233,24 +288,23 @@ class DoubanImporter:
             except Exception:
                 print(f'{prefix} fetching exception {review_url}')
                 return
-        try:
-            entity = entity_class.objects.get(source_url=url)
+        entity = self.entities.get(url)
+        if entity is None:
+            # url found in review page is not looked up in bulk
+            entity = entity_class.objects.filter(source_url=url).first()
+            if entity is None:
+                try:
+                    print(f'{prefix} scraping {url}')
+                    entity = get_or_scrape(scraper, url, self.user)
+                except Exception as e:
+                    print(f"{prefix} scrape failed: {url} {e}")
+                    logger.error(f"{prefix} scrape failed: {url}", exc_info=e)
+                    return
+            self.entities[url] = entity
+            self.reviews.update(review_class.lookup_by_owner(self.user, [entity]))
+        else:
             print(f'{prefix} matched {url}')
-        except ObjectDoesNotExist:
-            try:
-                print(f'{prefix} scraping {url}')
-                scraper.scrape(url)
-                form = scraper.save(request_user=self.user)
-                entity = form.instance
-            except Exception as e:
-                print(f"{prefix} scrape failed: {url} {e}")
-                logger.error(f"{prefix} scrape failed: {url}", exc_info=e)
-                return
-        params = {
-            'owner': self.user,
-            entity_class.__name__.lower(): entity
-        }
-        if review_class.objects.filter(**params).exists():
+        if entity.id in self.reviews:
             return 2
         content = re.sub(r'<span style="font-weight: bold;">([^<]+)</span>', r'<b>\1</b>', content)
         content = re.sub(r'(<img [^>]+>)', r'\1<br>', content)
@@ -266,5 +320,5 @@ class DoubanImporter:
             'visibility': self.visibility,
             entity_class.__name__.lower(): entity,
         }
-        review_class.objects.create(**params)
+        self.reviews[entity.id] = review_class.objects.create(**params)
         return 1
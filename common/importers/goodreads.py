@@ -1,9 +1,9 @@
 import re
-import requests
+from common import http
 from lxml import html
 from datetime import datetime
 # from common.scrapers.goodreads import GoodreadsScraper
-from common.scraper import get_scraper_by_url
+from common.scraper import get_scraper_by_url, scrape_item, get_or_scrape
 from books.models import Book, BookMark
 from collection.models import Collection
 from common.models import MarkStatusEnum
@@ -11,6 +11,7 @@ from django.conf import settings
 from user_messages import api as msg
 import django_rq
 from django.utils.timezone import make_aware
+from concurrent.futures import ThreadPoolExecutor
 
 
 re_list = r'^https://www.goodreads.com/list/show/\d+'
@@ -64,7 +65,12 @@ class GoodreadsImporter:
             for status in shelves:
                 shelf_url = shelves.get(status)
                 shelf = cls.parse_shelf(shelf_url, user)
+                marked = BookMark.lookup_by_owner(user, [book['book'] for book in shelf['books']])
                 for book in shelf['books']:
+                    if book['book'].id in marked:
+                        print(f'Skip mark for {book["book"]}')
+                        total += 1
+                        continue
                     params = {
                         'owner': user,
                         'rating': book['rating'],
@@ -79,12 +85,41 @@ class GoodreadsImporter:
                     try:
                         mark = BookMark.objects.create(**params)
                         mark.book.update_rating(None, mark.rating)
+                        marked[mark.book_id] = mark
                     except Exception:
                         print(f'Skip mark for {book["book"]}')
                         pass
                     total += 1
             msg.success(user, f'成功从Goodreads用户主页导入{total}个标记。')
 
+    @classmethod
+    def resolve_books(cls, rows, user):
+        """
+        Find books of rows in db with a few queries, scrape only those missing, rows with book unavailable are dropped
+        """
+        known = Book.lookup_by_source_urls([row['url'] for row in rows])
+        missing = list(dict.fromkeys(row['url'] for row in rows if row['url'] not in known))
+        resolved = []
+        # scrape missing books in threads, save them here in order of rows
+        with ThreadPoolExecutor(max_workers=settings.SYNC_SCRAPE_CONCURRENCY) as fetcher:
+            scraping = {url: fetcher.submit(scrape_item, get_scraper_by_url(url), url) for url in missing}
+            for row in rows:
+                url_book = row['url']
+                try:
+                    book = known.get(url_book)
+                    if not book:
+                        print("add new book " + url_book)
+                        scraper = get_scraper_by_url(url_book)
+                        # saved under the lock of url, another import or user may be saving it too
+                        book = get_or_scrape(scraper, url_book, user, scraping.pop(url_book).result)
+                        known[url_book] = book
+                    row['book'] = book
+                    resolved.append(row)
+                except Exception:
+                    print("Error adding " + url_book)
+                    pass  # likely just download error
+        return resolved
+
     @classmethod
     def parse_shelf(cls, url, user):  # return {'title': 'abc', books: [{'book': obj, 'rating': 10, 'review': 'txt'}, ...]}
         title = None
@@ -92,7 +127,7 @@ class GoodreadsImporter:
         url_shelf = url + '&view=table'
         while url_shelf:
             print(f'Shelf loading {url_shelf}')
-            r = requests.get(url_shelf, timeout=settings.SCRAPING_TIMEOUT)
+            r = http.get(url_shelf, timeout=settings.SCRAPING_TIMEOUT)
             if r.status_code != 200:
                 print(f'Shelf loading error {url_shelf}')
                 break
@@ -120,7 +155,7 @@ class GoodreadsImporter:
                 review = ''
                 last_updated = None
                 try:
-                    r2 = requests.get(
+                    r2 = http.get(
                         url_review, timeout=settings.SCRAPING_TIMEOUT)
                     if r2.status_code == 200:
                         c2 = html.fromstring(r2.content.decode('utf-8'))
@@ -138,15 +173,8 @@ class GoodreadsImporter:
                         print(f"Error loading review{url_review}, ignored")
                     scraper = get_scraper_by_url(url_book)
                     url_book = scraper.get_effective_url(url_book)
-                    book = Book.objects.filter(source_url=url_book).first()
-                    if not book:
-                        print("add new book " + url_book)
-                        scraper.scrape(url_book)
-                        form = scraper.save(request_user=user)
-                        book = form.instance
                     books.append({
                         'url': url_book,
-                        'book': book,
                         'rating': rating,
                         'review': review,
                         'last_updated': last_updated
@@ -156,7 +184,7 @@ class GoodreadsImporter:
                     pass  # likely just download error
             next_elem = content.xpath("//a[@class='next_page']/@href")
             url_shelf = ('https://www.goodreads.com' + next_elem[0].strip()) if next_elem else None
-        return {'title': title, 'description': '', 'books': books}
+        return {'title': title, 'description': '', 'books': cls.resolve_books(books, user)}
 
     @classmethod
     def parse_list(cls, url, user):  # return {'title': 'abc', books: [{'book': obj, 'rating': 10, 'review': 'txt'}, ...]}
@@ -165,7 +193,7 @@ class GoodreadsImporter:
         url_shelf = url
         while url_shelf:
             print(f'List loading {url_shelf}')
-            r = requests.get(url_shelf, timeout=settings.SCRAPING_TIMEOUT)
+            r = http.get(url_shelf, timeout=settings.SCRAPING_TIMEOUT)
             if r.status_code != 200:
                 print(f'List loading error {url_shelf}')
                 break
@@ -183,15 +211,8 @@ class GoodreadsImporter:
                 try:
                     scraper = get_scraper_by_url(url_book)
                     url_book = scraper.get_effective_url(url_book)
-                    book = Book.objects.filter(source_url=url_book).first()
-                    if not book:
-                        print("add new book " + url_book)
-                        scraper.scrape(url_book)
-                        form = scraper.save(request_user=user)
-                        book = form.instance
                     books.append({
                         'url': url_book,
-                        'book': book,
                         'review': '',
                     })
                 except Exception:
@@ -199,4 +220,4 @@ class GoodreadsImporter:
                     pass  # likely just download error
             next_elem = content.xpath("//a[@class='next_page']/@href")
             url_shelf = ('https://www.goodreads.com' + next_elem[0].strip()) if next_elem else None
-        return {'title': title, 'description': description, 'books': books}
+        return {'title': title, 'description': description, 'books': cls.resolve_books(books, user)}
@@ -5,6 +5,8 @@ if settings.SEARCH_BACKEND == 'MEILISEARCH':
     from .search.meilisearch import Indexer
 elif settings.SEARCH_BACKEND == 'TYPESENSE':
     from .search.typesense import Indexer
+elif settings.SEARCH_BACKEND == 'POSTGRES':
+    from .search.postgres import Indexer
 else:
     class Indexer:
         @classmethod
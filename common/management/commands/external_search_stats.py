@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+from common.searcher import ExternalSources
+
+
+class Command(BaseCommand):
+    help = 'Show latency and errors of external search providers'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', help='Reset counters after showing them')
+
+    def handle(self, *args, **options):
+        metrics = ExternalSources.get_metrics()
+        for provider, m in sorted(metrics.items()):
+            self.stdout.write(f"{provider}: {m['calls']} calls, {m['errors']} errors, {m['timeouts']} timeouts, {m['cache_hits']} cache hits, avg latency {m['avg_latency_ms']}ms")
+        if not metrics:
+            self.stdout.write('No external search since last reset')
+        if options['reset']:
+            ExternalSources.reset_metrics()
+            self.stdout.write(self.style.SUCCESS('Counters reset.'))
@@ -0,0 +1,177 @@
+from django.core.management.base import BaseCommand
+from django.core.files.base import ContentFile
+from django.conf import settings
+from common.scraper import get_scraper_by_url, scrape_item
+from movies.models import Movie
+from books.models import Book
+from games.models import Game
+from music.models import Album, Song
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from io import BytesIO
+from PIL import Image
+from tqdm import tqdm
+import filetype
+import logging
+import json
+import os
+
+
+COVER_MODELS = [Book, Movie, Album, Song, Game]
+BATCH_SIZE = 1000
+CHECKPOINT_FILE = '/tmp/fix_covers_checkpoint.json'
+
+
+logger = logging.getLogger(__name__)
+
+
+def check_cover(name, verify=False, include_default=False):
+    """
+    Return why the cover needs repair ('missing', 'default' or 'corrupt'), or None if it looks fine.
+    Only file size and header are checked unless `verify`, which decodes the whole image.
+    Default cover usually means the item has no cover at its source, it's only reported if `include_default`.
+    """
+    if not name:
+        return 'missing'
+    if name.endswith('default.svg'):
+        return 'default' if include_default else None
+    path = os.path.join(settings.MEDIA_ROOT, name)
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        return 'missing'
+    if size == 0:
+        return 'corrupt'
+    if name.endswith('.svg'):
+        return None
+    try:
+        if verify:
+            with Image.open(path) as img:
+                img.load()
+        else:
+            with open(path, 'rb') as f:
+                if not filetype.is_image(f.read(262)):
+                    return 'corrupt'
+    except Exception:
+        return 'corrupt'
+    return None
+
+
+def fix_cover(model, pk):
+    """
+    Runs in worker threads: scrape cover of given item again and save it, return True if fixed
+    """
+    obj = model.objects.filter(pk=pk).first()
+    if obj is None:
+        return False
+    scraper = get_scraper_by_url(obj.source_url) if obj.source_url else None
+    if scraper is None:
+        logger.error(f"fix cover: no scraper for {obj.source_url}")
+        return False
+    try:
+        # cached result may carry the same broken cover
+        result = scrape_item(scraper, obj.source_url, refresh=True)
+        raw_img, img_ext = result.raw_img, result.img_ext
+        if not raw_img or not img_ext:
+            logger.error(f"fix cover: no image from {obj.source_url}")
+            return False
+        img = Image.open(BytesIO(raw_img))
+        img.load()  # corrupted image will trigger exception
+        obj.cover.save('temp.' + img_ext, ContentFile(raw_img), save=False)
+        obj.save(update_fields=['cover'])
+        return True
+    except Exception as e:
+        logger.error(f"fix cover error: {obj.source_url}\n{e}")
+        return False
+
+
+class Command(BaseCommand):
+    help = 'Find items whose cover is missing or corrupt, and fetch the cover again from their source'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--model', type=str, nargs='*', help='Only fix covers of these item types, e.g. Book Movie')
+        parser.add_argument('--site', type=str, help='Only fix items from this source site, e.g. douban')
+        parser.add_argument('--verify', action='store_true', help='Decode existing covers to find corrupt ones, slower than checking file headers')
+        parser.add_argument('--include-default', action='store_true', help='Fetch again covers of items with default cover, most of them have no cover at source')
+        parser.add_argument('--dry-run', action='store_true', help='Only list items to be fixed')
+        parser.add_argument('--workers', type=int, default=8, help='Number of covers being fetched at the same time')
+        parser.add_argument('--batch', type=int, default=BATCH_SIZE, help='Number of items per batch')
+        parser.add_argument('--checkpoint', type=str, default=CHECKPOINT_FILE, help='File to save progress, re-run with same options to resume')
+        parser.add_argument('--restart', action='store_true', help='Ignore saved progress and start over')
+
+    def handle(self, *args, **options):
+        models = [m for m in COVER_MODELS if not options['model'] or m.__name__ in options['model']]
+        self.checkpoint_file = options['checkpoint']
+        self.checkpoint = {'site': options['site'], 'verify': options['verify'], 'include_default': options['include_default'], 'last_id': {}, 'finished': []}
+        if not options['restart'] and not options['dry_run'] and os.path.exists(self.checkpoint_file):
+            with open(self.checkpoint_file) as f:
+                saved = json.load(f)
+            if all(saved.get(k) == self.checkpoint[k] for k in ['site', 'verify', 'include_default']):
+                self.checkpoint = saved
+                self.stdout.write(f'Resuming from {self.checkpoint_file}')
+            else:
+                self.stdout.write('Saved progress is for different options, starting over')
+        self.stats = {'missing': 0, 'default': 0, 'corrupt': 0, 'fixed': 0, 'failed': 0}
+        executor = ThreadPoolExecutor(max_workers=options['workers'])
+        try:
+            for model in models:
+                if model.__name__ in self.checkpoint['finished']:
+                    self.stdout.write(f'Skipping {model}')
+                    continue
+                self.stdout.write(f'Checking {model}')
+                self.fix_model(model, executor, options)
+                if not options['dry_run']:
+                    self.checkpoint['finished'].append(model.__name__)
+                    self.save_checkpoint()
+        finally:
+            executor.shutdown()
+        if not options['dry_run'] and os.path.exists(self.checkpoint_file):
+            os.remove(self.checkpoint_file)
+        s = self.stats
+        self.stdout.write(self.style.SUCCESS(f"{s['missing']} missing, {s['default']} default, {s['corrupt']} corrupt, {s['fixed']} fixed, {s['failed']} failed"))
+
+    def fix_model(self, model, executor, options):
+        name = model.__name__
+        cursor = self.checkpoint['last_id'].get(name, 0)
+        qs = model.objects.all()
+        if options['site']:
+            qs = qs.filter(source_site=options['site'])
+        progress = tqdm(total=qs.filter(id__gt=cursor).count())
+        batches = deque()
+
+        def wait_batches(limit):
+            # progress is saved only up to the last batch whose items are all done
+            while len(batches) > limit:
+                last_id, n, futures = batches.popleft()
+                for future in futures:
+                    self.stats['fixed' if future.result() else 'failed'] += 1
+                progress.update(n)
+                if not options['dry_run']:
+                    self.checkpoint['last_id'][name] = last_id
+                    self.save_checkpoint()
+
+        while True:
+            # keyset pagination, cost of each page does not grow with offset
+            rows = list(qs.filter(id__gt=cursor).order_by('id').values_list('id', 'cover', 'source_url')[:options['batch']])
+            if not rows:
+                break
+            futures = []
+            for pk, cover, url in rows:
+                reason = check_cover(cover, options['verify'], options['include_default'])
+                if reason is None:
+                    continue
+                self.stats[reason] += 1
+                if options['dry_run']:
+                    self.stdout.write(f'{reason} {name} {pk} {url}')
+                else:
+                    futures.append(executor.submit(fix_cover, model, pk))
+            cursor = rows[-1][0]
+            batches.append((cursor, len(rows), futures))
+            # keep next batch queued while this one is being fetched, so workers never idle between batches
+            wait_batches(1)
+        wait_batches(0)
+        progress.close()
+
+    def save_checkpoint(self):
+        with open(self.checkpoint_file, 'w') as f:
+            json.dump(self.checkpoint, f)
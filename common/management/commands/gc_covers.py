@@ -0,0 +1,69 @@
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from easy_thumbnails.files import get_thumbnailer
+from movies.models import Movie
+from books.models import Book
+from games.models import Game
+from music.models import Album, Song
+import os
+import time
+
+
+COVER_MODELS = [Book, Movie, Album, Song, Game]
+
+
+class Command(BaseCommand):
+    help = 'Find cover images no longer used by any item, and optionally delete them'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--delete', action='store_true', help='Delete unused files, otherwise only list them')
+        parser.add_argument('--min-age', type=int, default=24, help='Ignore files modified in this many hours, they may be saved before the item')
+        parser.add_argument('--include-history', action='store_true', help='Also treat covers only referenced by edit history as unused, reverting those edits will lose the cover')
+
+    def handle(self, *args, **options):
+        # all cover fields share one storage, thumbnails of any cover are looked up through one of them
+        self.cover_field = Book._meta.get_field('cover')
+        referenced = set()
+        for model in COVER_MODELS:
+            referenced.update(model.objects.exclude(cover='').values_list('cover', flat=True))
+            if not options['include_history']:
+                referenced.update(model.history.exclude(cover='').values_list('cover', flat=True))
+        self.stdout.write(f'{len(referenced)} covers in use')
+        roots = [settings.COVER_MEDIA_PATH_ROOT, settings.BOOK_MEDIA_PATH_ROOT, settings.MOVIE_MEDIA_PATH_ROOT,
+                 settings.ALBUM_MEDIA_PATH_ROOT, settings.SONG_MEDIA_PATH_ROOT, settings.GAME_MEDIA_PATH_ROOT]
+        min_mtime = time.time() - options['min_age'] * 3600
+        count = 0
+        size = 0
+        for root in roots:
+            for dirpath, dirnames, filenames in os.walk(os.path.join(settings.MEDIA_ROOT, root)):
+                for filename in filenames:
+                    path = os.path.join(dirpath, filename)
+                    name = os.path.relpath(path, settings.MEDIA_ROOT)
+                    # thumbnails may be gone with their cover already
+                    if not os.path.exists(path):
+                        continue
+                    if filename == 'default.svg' or self.is_used(name, referenced) or os.path.getmtime(path) > min_mtime:
+                        continue
+                    count += 1
+                    size += os.path.getsize(path)
+                    if options['delete']:
+                        self.delete_thumbnails(name)
+                        if os.path.exists(path):
+                            os.remove(path)
+                    else:
+                        self.stdout.write(name)
+        action = 'Deleted' if options['delete'] else 'Found'
+        self.stdout.write(self.style.SUCCESS(f'{action} {count} unused files, {size // 1048576}MB'))
+
+    def delete_thumbnails(self, name):
+        # thumbnail records of easy_thumbnails go with the cover, WebP copies are found by the walk as unused files
+        thumbnailer = get_thumbnailer(self.cover_field.attr_class(None, self.cover_field, name))
+        thumbnailer.delete_thumbnails()
+        source = thumbnailer.get_source_cache()
+        if source is not None:
+            source.delete()
+
+    def is_used(self, name, referenced):
+        # thumbnails are named after their source file, e.g. x.jpg.200x200_q85.jpg
+        parts = name.split('.')
+        return any('.'.join(parts[:i]) in referenced for i in range(1, len(parts) + 1))
@@ -1,5 +1,6 @@
 from django.core.management.base import BaseCommand
 from common.index import Indexer
+from common.search.tasks import clear_fingerprints
 from django.conf import settings
 
 
@@ -9,6 +10,7 @@ class Command(BaseCommand):
     def handle(self, *args, **options):
         print(f'Connecting to search server')
         Indexer.init()
+        clear_fingerprints()
         self.stdout.write(self.style.SUCCESS('Index created.'))
         # try:
         #     Indexer.init()
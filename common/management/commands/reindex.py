@@ -1,40 +1,127 @@
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 from common.index import Indexer
+from common.models import Entity
+from common.search.tasks import clear_fingerprints
 from django.conf import settings
+from django.db import connections
+from django.utils import timezone
 from movies.models import Movie
 from books.models import Book
 from games.models import Game
 from music.models import Album, Song
-from django.core.paginator import Paginator
 from tqdm import tqdm
-from time import sleep
-from datetime import timedelta
-from django.utils import timezone
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import multiprocessing
+import dateparser
+import datetime
+import json
+import os
 
 
 BATCH_SIZE = 1000
+CHECKPOINT_FILE = '/tmp/reindex_checkpoint.json'
+
+
+def load_documents(model_name, ids):
+    """
+    Runs in worker process: load a batch of items and convert them to search documents
+    """
+    model = Indexer.class_map[model_name]
+    objs = Entity.prefetch_tag_lists(list(model.objects.filter(id__in=ids)))
+    return [Indexer.obj_to_dict(o) for o in objs]
 
 
 class Command(BaseCommand):
     help = 'Regenerate the search index'
 
-    # def add_arguments(self, parser):
-    #     parser.add_argument('hours', type=int, help='Re-index items modified in last N hours, 0 to reindex all')
+    def add_arguments(self, parser):
+        parser.add_argument('--since', type=str, help='Re-index items edited since given time, e.g. "2022-10-01" or "3 days ago"')
+        parser.add_argument('--workers', type=int, default=4, help='Number of processes converting items to documents')
+        parser.add_argument('--inflight', type=int, default=4, help='Max number of batches being sent to search server at the same time')
+        parser.add_argument('--batch', type=int, default=BATCH_SIZE, help='Number of items per batch')
+        parser.add_argument('--checkpoint', type=str, default=CHECKPOINT_FILE, help='File to save progress, re-run with same options to resume')
+        parser.add_argument('--restart', action='store_true', help='Ignore saved progress and start over')
 
     def handle(self, *args, **options):
-        # h = int(options['hours'])
+        since = None
+        if options['since']:
+            since = dateparser.parse(options['since'])
+            if since is None:
+                self.stdout.write(self.style.ERROR(f'Unable to parse time {options["since"]}'))
+                return
+            if timezone.is_naive(since):
+                since = timezone.make_aware(since)
+        self.checkpoint_file = options['checkpoint']
+        # `since` may be relative like "3 days ago", the time resolved in first run is kept for resuming
+        self.checkpoint = {'since': options['since'], 'since_time': since.isoformat() if since else None, 'last_id': {}, 'finished': []}
+        if not options['restart'] and os.path.exists(self.checkpoint_file):
+            with open(self.checkpoint_file) as f:
+                saved = json.load(f)
+            if saved.get('since') == self.checkpoint['since']:
+                self.checkpoint = saved
+                if saved.get('since_time'):
+                    since = datetime.datetime.fromisoformat(saved['since_time'])
+                self.stdout.write(f'Resuming from {self.checkpoint_file}')
+            else:
+                self.stdout.write(f'Saved progress is for different options, starting over')
+        if not self.checkpoint['last_id'] and not self.checkpoint['finished']:
+            # documents are written here without fingerprints, old ones would make queued updates skip them
+            clear_fingerprints()
         print(f'Connecting to search server')
         if Indexer.busy():
             print('Please wait for previous updates')
-        # Indexer.update_settings()
-        # self.stdout.write(self.style.SUCCESS('Index settings updated.'))
-        for c in [Book, Song, Album, Game, Movie]:
-            print(f'Re-indexing {c}')
-            qs = c.objects.all()  # if h == 0 else c.objects.filter(edited_time__gt=timezone.now() - timedelta(hours=h))
-            pg = Paginator(qs.order_by('id'), BATCH_SIZE)
-            for p in tqdm(pg.page_range):
-                items = list(map(lambda o: Indexer.obj_to_dict(o), pg.get_page(p).object_list))
-                if items:
-                    Indexer.replace_batch(items)
-                    while Indexer.busy():
-                        sleep(0.5)
+        # worker processes must not share db connection with this one, Pool forks all of them right here
+        connections.close_all()
+        loader = multiprocessing.get_context('fork').Pool(options['workers'])
+        writer = ThreadPoolExecutor(max_workers=options['inflight'])
+        try:
+            for c in [Book, Song, Album, Game, Movie]:
+                if c.__name__ in self.checkpoint['finished']:
+                    print(f'Skipping {c}')
+                    continue
+                print(f'Re-indexing {c}')
+                qs = c.objects.all() if since is None else c.objects.filter(edited_time__gte=since)
+                self.reindex_model(c.__name__, qs, loader, writer, options)
+                self.checkpoint['finished'].append(c.__name__)
+                self.save_checkpoint()
+        finally:
+            loader.close()
+            writer.shutdown()
+        os.remove(self.checkpoint_file)
+        self.stdout.write(self.style.SUCCESS('Done.'))
+
+    def reindex_model(self, name, qs, loader, writer, options):
+        cursor = self.checkpoint['last_id'].get(name, 0)
+        progress = tqdm(total=qs.filter(id__gt=cursor).count())
+        loads = deque()
+        writes = deque()
+
+        def wait_writes(limit):
+            while len(writes) > limit:
+                last_id, n, future = writes.popleft()
+                if future and not future.result():
+                    raise CommandError(f'Failed to index {name} up to id {last_id}, re-run with same options to resume')
+                progress.update(n)
+                self.checkpoint['last_id'][name] = last_id
+                self.save_checkpoint()
+
+        while True:
+            # keyset pagination, cost of each page does not grow with offset
+            ids = list(qs.filter(id__gt=cursor).order_by('id').values_list('id', flat=True)[:options['batch']])
+            if ids:
+                loads.append((ids[-1], len(ids), loader.apply_async(load_documents, (name, ids))))
+                cursor = ids[-1]
+            while len(loads) > (options['workers'] if ids else 0):
+                last_id, n, result = loads.popleft()
+                docs = result.get()
+                writes.append((last_id, n, writer.submit(Indexer.replace_batch, docs) if docs else None))
+                wait_writes(options['inflight'])
+            if not ids:
+                wait_writes(0)
+                break
+        progress.close()
+
+    def save_checkpoint(self):
+        with open(self.checkpoint_file, 'w') as f:
+            json.dump(self.checkpoint, f)
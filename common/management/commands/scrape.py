@@ -20,6 +20,6 @@ class Command(BaseCommand):
 
         effective_url = scraper.get_effective_url(url)
         self.stdout.write(f'Fetching {effective_url} via {scraper.__name__}')
-        data, img = scraper.scrape(effective_url)
+        result = scraper.scrape(effective_url)
         self.stdout.write(self.style.SUCCESS(f'Done.'))
-        pprint.pp(data)
+        pprint.pp(result.data)
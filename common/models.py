@@ -3,6 +3,8 @@ from decimal import *
 from markdown import markdown
 from django.utils.translation import gettext_lazy as _
 from django.db import models, IntegrityError
+import django.contrib.postgres.fields as postgres
+from django.contrib.postgres.indexes import GinIndex
 from django.core.serializers.json import DjangoJSONEncoder
 from django.db.models import Q, Count, Sum
 from markdownx.models import MarkdownxField
@@ -13,6 +15,10 @@ from django.conf import settings
 
 RE_HTML_TAG = re.compile(r"<[^>]*>")
 MAX_TOP_TAGS = 5
+# fields saved when rating of an entity changes, none of them is indexed for search
+RATING_FIELDS = ['rating', 'rating_number', 'rating_total_score', 'edited_time']
+# max number of values in one `__in` lookup
+LOOKUP_BATCH_SIZE = 1000
 
 
 # abstract base classes
@@ -131,7 +137,7 @@ class Entity(models.Model):
         @param new_rating: the new mark rating
         """
         self.calculate_rating(old_rating, new_rating)
-        self.save()
+        self.save(update_fields=RATING_FIELDS)
 
     def refresh_rating(self):  # TODO: replace update_rating()
         a = self.marks.filter(rating__gt=0).aggregate(Sum('rating'), Count('rating'))
@@ -139,7 +145,7 @@ class Entity(models.Model):
             self.rating_total_score = a['rating__sum']
             self.rating_number = a['rating__count']
             self.rating = a['rating__sum'] / a['rating__count'] if a['rating__count'] > 0 else None
-            self.save()
+            self.save(update_fields=RATING_FIELDS)
         return self.rating
 
     def get_tags_manager(self):
@@ -151,6 +157,8 @@ class Entity(models.Model):
 
     @property
     def top_tags(self):
+        if hasattr(self, '_prefetched_tag_list'):
+            return [{'content': t['content'], 'tag_frequency': t['frequency']} for t in self._prefetched_tag_list[:MAX_TOP_TAGS]]
         return self.get_tags_manager().values('content').annotate(tag_frequency=Count('content')).order_by('-tag_frequency')[:MAX_TOP_TAGS]
 
     def get_marks_manager(self):
@@ -169,8 +177,42 @@ class Entity(models.Model):
 
     @property
     def all_tag_list(self):
+        if hasattr(self, '_prefetched_tag_list'):
+            return self._prefetched_tag_list
         return self.get_tags_manager().values('content').annotate(frequency=Count('content')).order_by('-frequency')
 
+    @classmethod
+    def prefetch_tag_lists(cls, entities):
+        """
+        Load tags of a batch of entities with one grouped query per entity class,
+        the result is cached on each entity and used by `all_tag_list`, `tags` and `top_tags`.
+        """
+        groups = {}
+        for entity in entities:
+            groups.setdefault(entity.__class__, []).append(entity)
+        for entity_class, items in groups.items():
+            key = entity_class.__name__.lower() + '_id'
+            tag_lists = {item.id: [] for item in items}
+            rows = items[0].tag_class.objects.filter(**{key + '__in': list(tag_lists.keys())})\
+                .values(key, 'content').annotate(frequency=Count('content')).order_by('-frequency')
+            for row in rows:
+                tag_lists[row[key]].append({'content': row['content'], 'frequency': row['frequency']})
+            for item in items:
+                item._prefetched_tag_list = tag_lists[item.id]
+        return entities
+
+    @classmethod
+    def lookup_by_source_urls(cls, urls):
+        """
+        e.g. Book.lookup_by_source_urls(urls), return {source_url: book} for those already in db
+        """
+        urls = list(set(urls))
+        entities = {}
+        for i in range(0, len(urls), LOOKUP_BATCH_SIZE):
+            for entity in cls.objects.filter(source_url__in=urls[i:i + LOOKUP_BATCH_SIZE]):
+                entities[entity.source_url] = entity
+        return entities
+
     @property
     def tags(self):
         return list(map(lambda t: t['content'], self.all_tag_list))
@@ -266,6 +308,21 @@ class UserOwnedEntity(models.Model):
             user_owned_entities = user_owned_entities.filter(visibility=0)
         return user_owned_entities
 
+    @classmethod
+    def lookup_by_owner(cls, owner, entities):
+        """
+        e.g. BookMark.lookup_by_owner(user, books), return {book.id: mark} for books marked by user
+        """
+        found = {}
+        if not entities:
+            return found
+        key = entities[0].__class__.__name__.lower() + '_id'
+        ids = list(set(e.id for e in entities))
+        for i in range(0, len(ids), LOOKUP_BATCH_SIZE):
+            for obj in cls.objects.filter(owner=owner, **{key + '__in': ids[i:i + LOOKUP_BATCH_SIZE]}):
+                found[getattr(obj, key)] = obj
+        return found
+
     @property
     def item(self):
         attr = re.findall(r'[A-Z](?:[a-z]+|[A-Z]*(?=[A-Z]|$))', self.__class__.__name__)[0].lower()
@@ -365,3 +422,24 @@ class Tag(models.Model):
 
     class Meta:
         abstract = True
+
+
+# search index
+###################################
+class SearchDocument(models.Model):
+    """
+    Search document of an entity, used by the postgres search backend.
+    Trigram indexes on text columns are created by `init_index`.
+    """
+    # in form of `Book-123`
+    key = models.CharField(max_length=100, primary_key=True)
+    item_class = models.CharField(max_length=50, db_index=True)
+    item_id = models.PositiveIntegerField()
+    title = models.TextField(default='')
+    # other searchable attributes joined together
+    content = models.TextField(default='')
+    tags = postgres.ArrayField(models.CharField(max_length=50), default=list)
+    source_site = models.CharField(max_length=50, default='')
+
+    class Meta:
+        indexes = [GinIndex(fields=['tags'], name='search_document_tags')]
@@ -1,5 +1,6 @@
-import requests
+from common import http
 import functools
+import contextlib
 import random
 import logging
 import re
@@ -7,15 +8,20 @@ import dateparser
 import datetime
 import time
 import filetype
+import hashlib
+import pickle
+import django_rq
 import dns.resolver
 import urllib.parse
+from collections import namedtuple
 from lxml import html
-from threading import Thread
+from threading import Thread, Lock, BoundedSemaphore
 from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 from django.core.exceptions import ObjectDoesNotExist, ValidationError
 from django.core.files.uploadedfile import SimpleUploadedFile
 from common.models import SourceSiteEnum
+from users.models import User
 from django.conf import settings
 from django.core.exceptions import ValidationError
 
@@ -47,6 +53,23 @@ logger = logging.getLogger(__name__)
 
 # register all implemented scraper in form of {host: scraper_class,}
 scraper_registry = {}
+# all hosts in registry combined in one regex, rebuilt when a scraper is registered
+_host_router = None
+# {hostname: (expire_time, scraper_class or None)} decided by DNS lookups
+_dns_routes = {}
+_dns_routes_lock = Lock()
+DNS_ROUTES_MAX_SIZE = 10000
+
+
+SCRAPE_CACHE_KEY_PREFIX = 'scrape:cache:'
+SCRAPE_LOCK_KEY_PREFIX = 'scrape:lock:'
+SCRAPE_QUEUE = 'scrape'
+SCRAPE_JOB_FAILURE_TTL = 300
+
+
+# what a scrape returns, `form_class` overrides the scraper's one if not None,
+# `extra` holds site specific data not saved by the form, e.g. track urls of an album
+ScrapeResult = namedtuple('ScrapeResult', ['data', 'raw_img', 'img_ext', 'form_class', 'extra'], defaults=[None, None])
 
 
 def get_normalized_url(raw_url):
@@ -74,6 +97,64 @@ def log_url(func):
     return wrapper
 
 
+class PageNotFound(RuntimeError):
+    """
+    Page does not exist or is hidden by the site, scraping it again soon would be useless
+    """
+    pass
+
+
+def cache_scrape(func):
+    """
+    Keep results of decorated scrape method in redis by effective url for SCRAPE_CACHE_TTL,
+    pages not found are remembered for SCRAPE_CACHE_NEGATIVE_TTL.
+    Pass `refresh=True` to scrape anyway, the new result is still cached.
+    """
+    @functools.wraps(func)
+    def wrapper(cls, url, *args, refresh=False, **kwargs):
+        try:
+            effective_url = cls.get_effective_url(url)
+        except ValueError:
+            effective_url = None
+        if not effective_url:
+            return func(cls, url, *args, **kwargs)
+        key = SCRAPE_CACHE_KEY_PREFIX + hashlib.md5(effective_url.encode()).hexdigest()
+        if not refresh:
+            cached = get_scrape_cache(key)
+            if cached is not None:
+                status, value = cached
+                if status == 'not_found':
+                    raise PageNotFound(value)
+                return value
+        try:
+            result = func(cls, url, *args, **kwargs)
+        except PageNotFound as e:
+            set_scrape_cache(key, ('not_found', str(e)), settings.SCRAPE_CACHE_NEGATIVE_TTL)
+            raise
+        set_scrape_cache(key, ('ok', result), settings.SCRAPE_CACHE_TTL)
+        return result
+
+    return wrapper
+
+
+def get_scrape_cache(key):
+    try:
+        v = django_rq.get_connection('default').get(key)
+        return pickle.loads(v) if v else None
+    except Exception as e:
+        logger.error(f"unable to read scrape cache {key}: {e}")
+        return None
+
+
+def set_scrape_cache(key, value, ttl):
+    if not ttl:
+        return
+    try:
+        django_rq.get_connection('default').set(key, pickle.dumps(value), ex=ttl)
+    except Exception as e:
+        logger.error(f"unable to write scrape cache {key}: {e}")
+
+
 def parse_date(raw_str):
     return dateparser.parse(
         raw_str,
@@ -87,6 +168,10 @@ class AbstractScraper:
     """
     Scrape entities. The entities means those defined in the models.py file,
     like Book, Movie......
+
+    Scrapers keep no state between calls, everything scraped is returned in
+    a `ScrapeResult` and passed to `save()`, so one scraper can be used by
+    many threads at the same time.
     """
 
     # subclasses must specify those two variables
@@ -100,10 +185,6 @@ class AbstractScraper:
     form_class = None
     # used to extract effective url
     regex = None
-    # scraped raw image
-    raw_img = None
-    # scraped raw data
-    raw_data = {}
 
     def __init_subclass__(cls, **kwargs):
         # this statement initialize the subclasses
@@ -120,21 +201,22 @@ class AbstractScraper:
             cls.scrape), "scaper must have method `.scrape()`"
 
         # decorate the scrape method
-        cls.scrape = classmethod(log_url(cls.scrape))
+        cls.scrape = classmethod(cache_scrape(log_url(cls.scrape)))
 
         # register scraper
+        global _host_router
         if isinstance(cls.host, list):
             for host in cls.host:
                 scraper_registry[host] = cls
         else:
             scraper_registry[cls.host] = cls
+        _host_router = None
 
     def scrape(self, url):
         """
         Scrape/request model schema specified data from given url and return it.
         Implementations of subclasses to this method would be decorated as class method.
-        return (data_dict, image)
-        Should set the `raw_data` and the `raw_img`
+        return ScrapeResult(data_dict, raw_img, img_ext)
         """
         raise NotImplementedError("Subclass should implement this method")
 
@@ -167,9 +249,11 @@ class AbstractScraper:
                 'https': proxy_url,
             }
 
-        r = requests.get(url, proxies=proxies,
+        r = http.get(url, proxies=proxies,
                          headers=headers, timeout=settings.SCRAPING_TIMEOUT)
 
+        if r.status_code in [404, 410]:
+            raise PageNotFound(f"download page failed, status code {r.status_code}")
         if r.status_code != 200:
             raise RuntimeError(f"download page failed, status code {r.status_code}")
         # with open('temp.html', 'w', encoding='utf-8') as fp:
@@ -191,7 +275,7 @@ class AbstractScraper:
         if settings.LUMINATI_USERNAME is None:
             proxies = None
         if url:
-            img_response = requests.get(
+            img_response = http.get(
                 url,
                 headers={
                     'accept': 'image/webp,image/apng,image/*,*/*;q=0.8',
@@ -213,16 +297,19 @@ class AbstractScraper:
         return raw_img, ext
 
     @classmethod
-    def save(cls, request_user, instance=None):
+    def save(cls, request_user, result, instance=None):
+        """
+        Save a `ScrapeResult` as new entity, or to given `instance`, return the form
+        """
         entity_cover = {
-            'cover': SimpleUploadedFile('temp.' + cls.img_ext, cls.raw_img)
-        } if cls.img_ext is not None else None
-        form = cls.form_class(data=cls.raw_data, files=entity_cover, instance=instance)
+            'cover': SimpleUploadedFile('temp.' + result.img_ext, result.raw_img)
+        } if result.img_ext is not None else None
+        form_class = result.form_class or cls.form_class
+        form = form_class(data=result.data, files=entity_cover, instance=instance)
         if form.is_valid():
             form.instance.last_editor = request_user
             form.instance._change_reason = 'scrape'
             form.save()
-            cls.instance = form.instance
         else:
             logger.error(str(form.errors))
             raise ValidationError("Form invalid.")
@@ -241,22 +328,152 @@ from common.scrapers.douban import DoubanAlbumScraper, DoubanBookScraper, Douban
 from common.scrapers.bangumi import BangumiScraper
 
 
+def scrape_item(scraper, url, refresh=False):
+    """
+    Scrape without saving, at most SYNC_SCRAPE_PER_HOST at a time for each scraper,
+    for scraping many items in threads. `refresh` bypasses cached results.
+    """
+    with _host_semaphores_lock:
+        if scraper not in _host_semaphores:
+            _host_semaphores[scraper] = BoundedSemaphore(settings.SYNC_SCRAPE_PER_HOST)
+        semaphore = _host_semaphores[scraper]
+    with semaphore:
+        return scraper.scrape(url, refresh=refresh)
+
+
+_host_semaphores = {}
+_host_semaphores_lock = Lock()
+
+
+@contextlib.contextmanager
+def scrape_lock(effective_url):
+    """
+    Lock scraping and saving of given url across processes, yield whether the lock is acquired.
+    Waits up to SCRAPE_LOCK_WAIT seconds for other holder, then goes on without the lock.
+    """
+    lock = None
+    acquired = False
+    try:
+        key = SCRAPE_LOCK_KEY_PREFIX + hashlib.md5(effective_url.encode()).hexdigest()
+        lock = django_rq.get_connection('default').lock(key, timeout=settings.SCRAPE_LOCK_TTL, blocking_timeout=settings.SCRAPE_LOCK_WAIT)
+        acquired = lock.acquire()
+    except Exception as e:
+        logger.error(f"unable to lock scraping {effective_url}: {e}")
+    try:
+        yield acquired
+    finally:
+        if acquired:
+            try:
+                lock.release()
+            except Exception:
+                pass  # expired and maybe taken by another worker
+
+
+def get_or_scrape(scraper, url, request_user, scrape=None):
+    """
+    Return entity of url, scrape and save it if not in db yet.
+    A url is scraped by one worker at a time, others wait and get the entity it saved.
+    `scrape` is called instead of `scraper.scrape` to get the result if given,
+    e.g. `future.result` of a page scraped ahead in a thread pool.
+    """
+    effective_url = scraper.get_effective_url(url)
+    with scrape_lock(effective_url):
+        try:
+            return scraper.data_class.objects.get(source_url=effective_url)
+        except ObjectDoesNotExist:
+            pass
+        result = scrape() if scrape else scraper.scrape(url)
+        return scraper.save(request_user, result).instance
+
+
+def get_scrape_job_id(effective_url):
+    return 'scrape-' + hashlib.md5(effective_url.encode()).hexdigest()
+
+
+def enqueue_scrape(url, effective_url, request_user):
+    """
+    Scrape and save url in background, at most one job is queued for a url at a time
+    """
+    queue = django_rq.get_queue(SCRAPE_QUEUE)
+    job_id = get_scrape_job_id(effective_url)
+    job = queue.fetch_job(job_id)
+    if job is not None and job.get_status() in ['queued', 'started', 'deferred', 'scheduled']:
+        return
+    queue.enqueue(scrape_job, url, request_user.id, job_id=job_id,
+                  job_timeout=settings.SCRAPE_LOCK_TTL, failure_ttl=SCRAPE_JOB_FAILURE_TTL)
+
+
+def get_scrape_status(effective_url):
+    """
+    return (failed, pk of saved entity) of background scrape of url;
+    failed if the job failed or is no longer known, pk is known once the job is finished
+    """
+    job = django_rq.get_queue(SCRAPE_QUEUE).fetch_job(get_scrape_job_id(effective_url))
+    if job is None or job.get_status() in ['failed', 'stopped', 'canceled']:
+        return True, None
+    if job.get_status() == 'finished':
+        return job.result is None, job.result
+    return False, None
+
+
+def scrape_job(url, user_id):
+    scraper = get_scraper_by_url(url)
+    entity = get_or_scrape(scraper, url, User.objects.get(pk=user_id))
+    return entity.pk
+
+
 def get_scraper_by_url(url):
-    parsed_url = urllib.parse.urlparse(url)
-    hostname = parsed_url.netloc
-    for host in scraper_registry:
-        if host in url:
-            return scraper_registry[host]
+    scraper = get_scraper_by_host(url)
+    if scraper is None:
+        hostname = urllib.parse.urlparse(url).netloc
+        if hostname:
+            scraper = get_scraper_by_dns(hostname)
+    return scraper
+
+
+def get_scraper_by_host(url):
+    """
+    Find scraper whose `host` appears in url, by one regex search over all registered hosts
+    """
+    global _host_router
+    router = _host_router
+    if router is None:
+        # longer hosts first, so e.g. `www.douban.com/game/` wins over a shorter host it contains
+        hosts = sorted(scraper_registry.keys(), key=len, reverse=True)
+        router = re.compile('|'.join(re.escape(host) for host in hosts))
+        _host_router = router
+    m = router.search(url)
+    return scraper_registry[m.group(0)] if m else None
+
+
+def get_scraper_by_dns(hostname):
+    """
+    Detect custom domains of supported sites by DNS, decisions are cached in this process
+    """
+    now = time.time()
+    route = _dns_routes.get(hostname)
+    if route is not None and route[0] > now:
+        return route[1]
+    scraper = resolve_scraper_by_dns(hostname)
+    ttl = settings.SCRAPER_DNS_CACHE_TTL if scraper else settings.SCRAPER_DNS_NEGATIVE_TTL
+    with _dns_routes_lock:
+        if len(_dns_routes) >= DNS_ROUTES_MAX_SIZE:
+            _dns_routes.clear()
+        _dns_routes[hostname] = (now + ttl, scraper)
+    return scraper
+
+
+def resolve_scraper_by_dns(hostname):
     # TODO move this logic to scraper class
     try:
-        answers = dns.resolver.query(hostname, 'CNAME')
+        answers = dns.resolver.query(hostname, 'CNAME', lifetime=settings.SCRAPER_DNS_TIMEOUT)
         for rdata in answers:
             if str(rdata.target) == 'dom.bandcamp.com.':
                 return BandcampAlbumScraper
     except Exception as e:
         pass
     try:
-        answers = dns.resolver.query(hostname, 'A')
+        answers = dns.resolver.query(hostname, 'A', lifetime=settings.SCRAPER_DNS_TIMEOUT)
         for rdata in answers:
             if str(rdata.address) == '35.241.62.186':
                 return BandcampAlbumScraper
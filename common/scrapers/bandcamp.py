@@ -3,7 +3,7 @@ import dateparser
 import json
 from lxml import html
 from common.models import SourceSiteEnum
-from common.scraper import AbstractScraper
+from common.scraper import AbstractScraper, ScrapeResult
 from music.models import Album
 from music.forms import AlbumForm
 
@@ -62,8 +62,7 @@ class BandcampAlbumScraper(AbstractScraper):
             'cover_url': cover_url,
         }
 
-        self.raw_data, self.raw_img, self.img_ext = data, raw_img, ext
-        return data, raw_img
+        return ScrapeResult(data, raw_img, ext)
 
     @classmethod
     def get_effective_url(cls, raw_url):
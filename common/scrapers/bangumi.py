@@ -32,7 +32,7 @@ class BangumiScraper(AbstractScraper):
     data_class = type("FakeDataClass", (object,), {})()
     data_class.objects = type("FakeObjectsClass", (object,), {})()
     data_class.objects.get = find_entity
-    # should be set at scrape_* method
+    # depends on category of the page, given by scrape result
     form_class = ''
 
     regex = re.compile(r"https{0,1}://bgm\.tv/subject/\d+")
@@ -52,21 +52,18 @@ class BangumiScraper(AbstractScraper):
         # Test category
         category_code = content.xpath("//div[@id='headerSearch']//option[@selected]/@value")[0]
         handler_map = {
-            '1': self.scrape_book,
-            '2': self.scrape_movie,
-            '3': self.scrape_album,
-            '4': self.scrape_game
+            '1': (self.scrape_book, BookForm),
+            '2': (self.scrape_movie, MovieForm),
+            '3': (self.scrape_album, AlbumForm),
+            '4': (self.scrape_game, GameForm),
         }
-        data = handler_map[category_code](self, content)
+        handler, form_class = handler_map[category_code]
+        data = handler(self, content)
         data['source_url'] = self.get_effective_url(url)
 
-        self.raw_data, self.raw_img, self.img_ext = data, raw_img, ext
-        return data, raw_img
+        return ScrapeResult(data, raw_img, ext, form_class=form_class)
 
     def scrape_game(self, content):
-        self.data_class = Game
-        self.form_class = GameForm
-
         title_elem = content.xpath("//a[@property='v:itemreviewed']/text()")
         if not title_elem:
             raise ValueError("no game info found on this page")
@@ -184,16 +181,10 @@ class BangumiScraper(AbstractScraper):
         return data
 
     def scrape_movie(self, content):
-        self.data_class = Movie
-        self.form_class = MovieForm
         raise NotImplementedError
 
     def scrape_book(self, content):
-        self.data_class = Book
-        self.form_class = BookForm
         raise NotImplementedError
 
     def scrape_album(self, content):
-        self.data_class = Album
-        self.form_class = AlbumForm
         raise NotImplementedError
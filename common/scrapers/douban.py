@@ -1,4 +1,8 @@
 import requests
+import django_rq
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from common import http
 import re
 import filetype
 from lxml import html
@@ -18,127 +22,142 @@ from io import BytesIO
 from common.scraper import *
 
 
+DOUBAN_BAN_KEY_PREFIX = 'douban:banned:'
+_fetcher = ThreadPoolExecutor(max_workers=settings.DOUBAN_FETCH_WORKERS)
+
+
+def douban_get(url):
+    try:
+        return http.get(url, timeout=settings.SCRAPING_TIMEOUT)
+    except Exception as e:
+        r = requests.Response()
+        r.status_code = f"Exception when GET {url} {e}"
+        return r
+
+
+def check_douban_content(r):
+    """
+    return (content, last_error, error), content is None unless it's an authentic douban page
+    """
+    if r.status_code == 200:
+        content = r.content.decode('utf-8')
+        if content.find('关于豆瓣') == -1:
+            if content.find('你的 IP 发出') == -1:
+                return None, 'network', 'Content not authentic'  # response is garbage
+            else:
+                return None, 'banned', 'IP banned'
+        elif content.find('<title>页面不存在</title>') != -1 or content.find('呃... 你想访问的条目豆瓣不收录。') != -1:  # re.search('不存在[^<]+</title>', content, re.MULTILINE):
+            return None, 'censorship', 'Not found or hidden by Douban'
+        return content, None, ''
+    elif r.status_code == 204:
+        return None, 'censorship', 'Not found or hidden by Douban'
+    else:
+        return None, 'network', str(r.status_code)
+
+
+def fix_wayback_links(content):
+    # fix links
+    content = re.sub(r'href="http[^"]+http', r'href="http', content)
+    # https://img9.doubanio.com/view/subject/{l|m|s}/public/s1234.jpg
+    content = re.sub(r'src="[^"]+/(s\d+\.\w+)"',
+                     r'src="https://img9.doubanio.com/view/subject/m/public/\1"', content)
+    # https://img9.doubanio.com/view/photo/s_ratio_poster/public/p2681329386.jpg
+    # https://img9.doubanio.com/view/photo/{l|m|s}/public/p1234.webp
+    content = re.sub(r'src="[^"]+/(p\d+\.\w+)"',
+                     r'src="https://img9.doubanio.com/view/photo/m/public/\1"', content)
+    return content
+
+
+def fetch_douban_page(name, url):
+    """
+    Runs in fetch threads, return (name, content, last_error, error)
+    """
+    content, last_error, error = check_douban_content(douban_get(url))
+    if last_error == 'banned':
+        http.report_throttled(url)
+    return name, content, last_error, error
+
+
+# Wayback Machine: guess via CDX API
+def fetch_douban_wayback(url):
+    r = douban_get('http://web.archive.org/cdx/search/cdx?url=' + url)
+    if r.status_code != 200:
+        return 'Wayback', None, 'network', str(r.status_code)
+    dates = re.findall(r'[^\s]+\s+(\d+)\s+[^\s]+\s+[^\s]+\s+\d+\s+[^\s]+\s+\d{5,}',
+                       r.content.decode('utf-8'))
+    # assume snapshots whose size >9999 contain real content, use the latest one of them
+    if len(dates) == 0:
+        return 'Wayback', None, 'network', 'No snapshot available'
+    content, last_error, error = check_douban_content(douban_get('http://web.archive.org/web/' + dates[-1] + '/' + url))
+    if content is not None:
+        content = fix_wayback_links(content)
+    return 'Wayback', content, last_error, error
+
+
+def is_douban_banned(route):
+    try:
+        return bool(django_rq.get_connection('default').exists(DOUBAN_BAN_KEY_PREFIX + route))
+    except Exception as e:
+        logger.error(f"unable to read douban ban state: {e}")
+        return False
+
+
+def set_douban_banned(route):
+    try:
+        django_rq.get_connection('default').set(DOUBAN_BAN_KEY_PREFIX + route, 1, ex=settings.DOUBAN_BAN_COOLDOWN)
+    except Exception as e:
+        logger.error(f"unable to save douban ban state: {e}")
+
+
 class DoubanScrapperMixin:
     @classmethod
     def download_page(cls, url, headers):
+        """
+        Fetch the live page, and if it's not back in DOUBAN_HEDGE_DELAY seconds or has failed,
+        fetch it via fallbacks at the same time, the first authentic page wins.
+        Fallbacks start right away while the live route is known to be banned.
+        """
         url = cls.get_effective_url(url)
-        r = None
-        error = 'DoubanScrapper: error occured when downloading ' + url
+        if settings.SCRAPESTACK_KEY is not None:
+            route, live_url = 'ScrapeStack', f'http://api.scrapestack.com/scrape?access_key={settings.SCRAPESTACK_KEY}&url={url}'
+        elif settings.SCRAPERAPI_KEY is not None:
+            route, live_url = 'ScraperAPI', f'http://api.scraperapi.com?api_key={settings.SCRAPERAPI_KEY}&url={url}'
+        else:
+            route, live_url = 'Direct', url
+        errors = ['DoubanScrapper: error occured when downloading ' + url]
+        live = _fetcher.submit(fetch_douban_page, route, live_url)
+        pending = {live}
+        hedged = False
+        censored = False
         content = None
-        last_error = None
-
-        def get(url):
-            nonlocal r
-            # print('Douban GET ' + url)
-            try:
-                r = requests.get(url, timeout=settings.SCRAPING_TIMEOUT)
-            except Exception as e:
-                r = requests.Response()
-                r.status_code = f"Exception when GET {url} {e}" + url
-            # print('Douban CODE ' + str(r.status_code))
-            return r
-
-        def check_content():
-            nonlocal r, error, content, last_error
-            content = None
-            last_error = None
-            if r.status_code == 200:
-                content = r.content.decode('utf-8')
-                if content.find('关于豆瓣') == -1:
-                    if content.find('你的 IP 发出') == -1:
-                        error = error + 'Content not authentic'  # response is garbage
-                    else:
-                        error = error + 'IP banned'
-                    content = None
-                    last_error = 'network'
-                elif content.find('<title>页面不存在</title>') != -1 or content.find('呃... 你想访问的条目豆瓣不收录。') != -1:  # re.search('不存在[^<]+</title>', content, re.MULTILINE):
-                    content = None
-                    last_error = 'censorship'
-                    error = error + 'Not found or hidden by Douban'
-            elif r.status_code == 204:
-                content = None
-                last_error = 'censorship'
-                error = error + 'Not found or hidden by Douban'
-            else:
-                content = None
-                last_error = 'network'
-                error = error + str(r.status_code)
-
-        def fix_wayback_links():
-            nonlocal content
-            # fix links
-            content = re.sub(r'href="http[^"]+http', r'href="http', content)
-            # https://img9.doubanio.com/view/subject/{l|m|s}/public/s1234.jpg
-            content = re.sub(r'src="[^"]+/(s\d+\.\w+)"',
-                             r'src="https://img9.doubanio.com/view/subject/m/public/\1"', content)
-            # https://img9.doubanio.com/view/photo/s_ratio_poster/public/p2681329386.jpg
-            # https://img9.doubanio.com/view/photo/{l|m|s}/public/p1234.webp
-            content = re.sub(r'src="[^"]+/(p\d+\.\w+)"',
-                             r'src="https://img9.doubanio.com/view/photo/m/public/\1"', content)
-
-        # Wayback Machine: get latest available
-        def wayback():
-            nonlocal r, error, content
-            error = error + '\nWayback: '
-            get('http://archive.org/wayback/available?url=' + url)
-            if r.status_code == 200:
-                w = r.json()
-                if w['archived_snapshots'] and w['archived_snapshots']['closest']:
-                    get(w['archived_snapshots']['closest']['url'])
-                    check_content()
-                    if content is not None:
-                        fix_wayback_links()
-                else:
-                    error = error + 'No snapshot available'
-            else:
-                error = error + str(r.status_code)
-
-        # Wayback Machine: guess via CDX API
-        def wayback_cdx():
-            nonlocal r, error, content
-            error = error + '\nWayback: '
-            get('http://web.archive.org/cdx/search/cdx?url=' + url)
-            if r.status_code == 200:
-                dates = re.findall(r'[^\s]+\s+(\d+)\s+[^\s]+\s+[^\s]+\s+\d+\s+[^\s]+\s+\d{5,}',
-                                   r.content.decode('utf-8'))
-                # assume snapshots whose size >9999 contain real content, use the latest one of them
-                if len(dates) > 0:
-                    get('http://web.archive.org/web/' + dates[-1] + '/' + url)
-                    check_content()
-                    if content is not None:
-                        fix_wayback_links()
-                else:
-                    error = error + 'No snapshot available'
-            else:
-                error = error + str(r.status_code)
-
-        def latest():
-            nonlocal r, error, content
-            if settings.SCRAPESTACK_KEY is not None:
-                error = error + '\nScrapeStack: '
-                get(f'http://api.scrapestack.com/scrape?access_key={settings.SCRAPESTACK_KEY}&url={url}')
-            elif settings.SCRAPERAPI_KEY is not None:
-                error = error + '\nScraperAPI: '
-                get(f'http://api.scraperapi.com?api_key={settings.SCRAPERAPI_KEY}&url={url}')
-            else:
-                error = error + '\nDirect: '
-                get(url)
-            check_content()
-            if last_error == 'network' and settings.PROXYCRAWL_KEY is not None:
-                error = error + '\nProxyCrawl: '
-                get(f'https://api.proxycrawl.com/?token={settings.PROXYCRAWL_KEY}&url={url}')
-                check_content()
-            if last_error == 'censorship' and settings.LOCAL_PROXY is not None:
-                error = error + '\nLocal: '
-                get(f'{settings.LOCAL_PROXY}?url={url}')
-                check_content()
-
-        latest()
-        if content is None:
-            wayback_cdx()
+        hedge_time = time.time() + (0 if is_douban_banned(route) else settings.DOUBAN_HEDGE_DELAY)
+        while pending and content is None:
+            timeout = None if hedged else max(0, hedge_time - time.time())
+            done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                name, content, last_error, error = future.result()
+                if content is not None:
+                    break
+                errors.append(f'{name}: {error}')
+                if name == route:
+                    if last_error == 'banned':
+                        set_douban_banned(route)
+                    if last_error == 'censorship':
+                        censored = True
+                        if settings.LOCAL_PROXY is not None:
+                            pending.add(_fetcher.submit(fetch_douban_page, 'Local', f'{settings.LOCAL_PROXY}?url={url}'))
+            if content is None and not hedged and (not done or live in done):
+                # live page is slow or failed
+                hedged = True
+                if settings.PROXYCRAWL_KEY is not None and not censored:
+                    pending.add(_fetcher.submit(fetch_douban_page, 'ProxyCrawl', f'https://api.proxycrawl.com/?token={settings.PROXYCRAWL_KEY}&url={url}'))
+                pending.add(_fetcher.submit(fetch_douban_wayback, url))
+        for future in pending:
+            future.cancel()  # those already running are left to finish in background
 
         if content is None:
-            raise RuntimeError(error)
+            error = '\n'.join(errors)
+            raise PageNotFound(error) if censored else RuntimeError(error)
         # with open('/tmp/temp.html', 'w', encoding='utf-8') as fp:
         #     fp.write(content)
         return html.fromstring(content)
@@ -156,7 +175,7 @@ class DoubanScrapperMixin:
             dl_url = url
 
         try:
-            img_response = requests.get(dl_url, timeout=settings.SCRAPING_TIMEOUT)
+            img_response = http.get(dl_url, timeout=settings.SCRAPING_TIMEOUT)
             if img_response.status_code == 200:
                 raw_img = img_response.content
                 img = Image.open(BytesIO(raw_img))
@@ -174,7 +193,7 @@ class DoubanScrapperMixin:
         if raw_img is None and settings.PROXYCRAWL_KEY is not None:
             try:
                 dl_url = f'https://api.proxycrawl.com/?token={settings.PROXYCRAWL_KEY}&url={url}'
-                img_response = requests.get(dl_url, timeout=settings.SCRAPING_TIMEOUT)
+                img_response = http.get(dl_url, timeout=settings.SCRAPING_TIMEOUT)
                 if img_response.status_code == 200:
                     raw_img = img_response.content
                     img = Image.open(BytesIO(raw_img))
@@ -349,8 +368,7 @@ class DoubanBookScraper(DoubanScrapperMixin, AbstractScraper):
             'source_site': self.site_name,
             'source_url': self.get_effective_url(url),
         }
-        self.raw_data, self.raw_img, self.img_ext = data, raw_img, ext
-        return data, raw_img
+        return ScrapeResult(data, raw_img, ext)
 
 
 class DoubanMovieScraper(DoubanScrapperMixin, AbstractScraper):
@@ -540,8 +558,7 @@ class DoubanMovieScraper(DoubanScrapperMixin, AbstractScraper):
             'source_site': self.site_name,
             'source_url': self.get_effective_url(url),
         }
-        self.raw_data, self.raw_img, self.img_ext = data, raw_img, ext
-        return data, raw_img
+        return ScrapeResult(data, raw_img, ext)
 
 
 class DoubanAlbumScraper(DoubanScrapperMixin, AbstractScraper):
@@ -637,8 +654,7 @@ class DoubanAlbumScraper(DoubanScrapperMixin, AbstractScraper):
             'source_site': self.site_name,
             'source_url': self.get_effective_url(url),
         }
-        self.raw_data, self.raw_img, self.img_ext = data, raw_img, ext
-        return data, raw_img
+        return ScrapeResult(data, raw_img, ext)
 
 
 class DoubanGameScraper(DoubanScrapperMixin, AbstractScraper):
@@ -710,5 +726,4 @@ class DoubanGameScraper(DoubanScrapperMixin, AbstractScraper):
             'source_url': self.get_effective_url(url),
         }
 
-        self.raw_data, self.raw_img, self.img_ext = data, raw_img, ext
-        return data, raw_img
+        return ScrapeResult(data, raw_img, ext)
@@ -153,5 +153,4 @@ class GoodreadsScraper(AbstractScraper):
         }
         data['source_url'] = self.get_effective_url(url)
 
-        self.raw_data, self.raw_img, self.img_ext = data, raw_img, ext
-        return data, raw_img
+        return ScrapeResult(data, raw_img, ext)
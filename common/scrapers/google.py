@@ -1,4 +1,4 @@
-import requests
+from common import http
 import re
 import filetype
 from lxml import html
@@ -43,7 +43,7 @@ class GoogleBooksScraper(AbstractScraper):
             api_url = f'https://www.googleapis.com/books/v1/volumes/{m[1]}'
         else:
             raise ValueError("not valid url")
-        b = requests.get(api_url).json()
+        b = http.get(api_url).json()
         other = {}
         title = b['volumeInfo']['title']
         subtitle = b['volumeInfo']['subtitle'] if 'subtitle' in b['volumeInfo'] else None
@@ -98,5 +98,4 @@ class GoogleBooksScraper(AbstractScraper):
         }
         raw_img, ext = self.download_image(img_url, url)
 
-        self.raw_data, self.raw_img, self.img_ext = data, raw_img, ext
-        return data, raw_img
+        return ScrapeResult(data, raw_img, ext)
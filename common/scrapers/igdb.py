@@ -76,8 +76,7 @@ class IgdbGameScraper(AbstractScraper):
         }
         raw_img, ext = self.download_image('https:' + r['cover']['url'].replace('t_thumb', 't_cover_big'), url)
 
-        self.raw_data, self.raw_img, self.img_ext = data, raw_img, ext
-        return data, raw_img
+        return ScrapeResult(data, raw_img, ext)
 
     @classmethod
     def get_effective_url(cls, raw_url):
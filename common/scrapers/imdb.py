@@ -1,4 +1,4 @@
-import requests
+from common import http
 import re
 from common.models import SourceSiteEnum
 from movies.forms import MovieForm
@@ -20,17 +20,12 @@ class ImdbMovieScraper(AbstractScraper):
         if effective_url is None:
             raise ValueError("not valid url")
         code = self.regex.findall(effective_url)[0]
-        s = TmdbMovieScraper()
-        s.scrape_imdb(code)
-        self.raw_data = s.raw_data
-        self.raw_img = s.raw_img
-        self.img_ext = s.img_ext
-        self.raw_data['source_site'] = self.site_name
-        self.raw_data['source_url'] = effective_url
-        return self.raw_data, self.raw_img
+        result = TmdbMovieScraper().scrape_imdb(code)
+        data = dict(result.data, source_site=self.site_name, source_url=effective_url)
+        return result._replace(data=data)
 
         api_url = self.get_api_url(effective_url)
-        r = requests.get(api_url)
+        r = http.get(api_url)
         res_data = r.json()
 
         if not res_data['type'] in ['Movie', 'TVSeries']:
@@ -100,8 +95,7 @@ class ImdbMovieScraper(AbstractScraper):
             'source_site': self.site_name,
             'source_url': effective_url,
         }
-        self.raw_data, self.raw_img, self.img_ext = data, raw_img, ext
-        return data, raw_img
+        return ScrapeResult(data, raw_img, ext)
 
     @classmethod
     def get_effective_url(cls, raw_url):
@@ -1,4 +1,4 @@
-import requests
+from common import http
 import re
 import time
 from common.models import SourceSiteEnum
@@ -39,7 +39,7 @@ class SpotifyTrackScraper(AbstractScraper):
         headers = {
             'Authorization': f"Bearer {spotify_token}"
         }
-        r = requests.get(api_url, headers=headers)
+        r = http.get(api_url, headers=headers)
         res_data = r.json()
 
         artist = []
@@ -74,8 +74,7 @@ class SpotifyTrackScraper(AbstractScraper):
             'source_site': self.site_name,
             'source_url': effective_url,
         }
-        self.raw_data, self.raw_img, self.img_ext = data, raw_img, ext
-        return data, raw_img
+        return ScrapeResult(data, raw_img, ext)
 
     @classmethod
     def get_effective_url(cls, raw_url):
@@ -115,7 +114,7 @@ class SpotifyAlbumScraper(AbstractScraper):
         headers = {
             'Authorization': f"Bearer {spotify_token}"
         }
-        r = requests.get(api_url, headers=headers)
+        r = http.get(api_url, headers=headers)
         res_data = r.json()
 
         artist = []
@@ -167,11 +166,8 @@ class SpotifyAlbumScraper(AbstractScraper):
             'source_url': effective_url,
         }
 
-        # set tracks_data, used for adding tracks
-        self.track_urls = track_urls
-
-        self.raw_data, self.raw_img, self.img_ext = data, raw_img, ext
-        return data, raw_img
+        # track urls are used for adding tracks
+        return ScrapeResult(data, raw_img, ext, extra={'track_urls': track_urls})
 
     @classmethod
     def get_effective_url(cls, raw_url):
@@ -182,11 +178,11 @@ class SpotifyAlbumScraper(AbstractScraper):
             return None
 
     # @classmethod
-    # def save(cls, request_user):
-    #     form = super().save(request_user)
+    # def save(cls, request_user, result, instance=None):
+    #     form = super().save(request_user, result, instance)
     #     task = Thread(
     #         target=cls.add_tracks,
-    #         args=(form.instance, request_user),
+    #         args=(form.instance, result.extra['track_urls'], request_user),
     #         daemon=True
     #     )
     #     task.start()
@@ -197,9 +193,9 @@ class SpotifyAlbumScraper(AbstractScraper):
         return "https://api.spotify.com/v1/albums/" + cls.regex.findall(url)[0]
 
     @classmethod
-    def add_tracks(cls, album: Album, request_user):
+    def add_tracks(cls, album: Album, track_urls, request_user):
         to_be_updated_tracks = []
-        for track_url in cls.track_urls:
+        for track_url in track_urls:
             track = cls.get_track_or_none(track_url)
             # seems lik if fire too many requests at the same time
             # spotify would limit access
@@ -225,9 +221,9 @@ class SpotifyAlbumScraper(AbstractScraper):
 
     @classmethod
     def scrape_and_save_track(cls, url: str, album: Album, request_user):
-        data, img = SpotifyTrackScraper.scrape(url)
-        SpotifyTrackScraper.raw_data['album'] = album
-        SpotifyTrackScraper.save(request_user)
+        result = SpotifyTrackScraper.scrape(url)
+        result.data['album'] = album
+        SpotifyTrackScraper.save(request_user, result)
 
     @classmethod
     def bulk_update_track_album(cls, tracks, album, request_user):
@@ -256,7 +252,7 @@ def is_spotify_token_expired():
 
 def invoke_spotify_token():
     global spotify_token, spotify_token_expire_time
-    r = requests.post(
+    r = http.post(
         "https://accounts.spotify.com/api/token",
         data={
             "grant_type": "client_credentials"
@@ -270,7 +266,7 @@ def invoke_spotify_token():
         # token expired, try one more time
         # this maybe caused by external operations,
         # for example debugging using a http client
-        r = requests.post(
+        r = http.post(
             "https://accounts.spotify.com/api/token",
             data={
                 "grant_type": "client_credentials"
@@ -21,17 +21,10 @@ class SteamGameScraper(AbstractScraper):
         else:
             raise ValueError("not valid url")
         try:
-            s = IgdbGameScraper()
-            s.scrape_steam(effective_url)
-            self.raw_data = s.raw_data
-            self.raw_img = s.raw_img
-            self.img_ext = s.img_ext
-            self.raw_data['source_site'] = self.site_name
-            self.raw_data['source_url'] = effective_url
-            # return self.raw_data, self.raw_img
+            igdb = IgdbGameScraper().scrape_steam(effective_url)
         except:
-            self.raw_img = None
-            self.raw_data = {}
+            igdb = ScrapeResult({}, None, None)
+        igdb_data = igdb.data
         headers = DEFAULT_REQUEST_HEADERS.copy()
         headers['Host'] = self.host
         headers['Cookie'] = "wants_mature_content=1; birthtime=754700401;"
@@ -63,25 +56,23 @@ class SteamGameScraper(AbstractScraper):
             img_url = content.xpath("//img[@class='game_header_image_full']/@src")[0]
             raw_img, img_ext = self.download_image(img_url, url)
 
-        if raw_img is not None:
-            self.raw_img = raw_img
-            self.img_ext = img_ext
+        if raw_img is None:
+            raw_img, img_ext = igdb.raw_img, igdb.img_ext
 
         data = {
-            'title': title if title else self.raw_data['title'],
+            'title': title if title else igdb_data['title'],
             'other_title': None,
-            'developer': developer if 'developer' not in self.raw_data else self.raw_data['developer'],
-            'publisher': publisher if 'publisher' not in self.raw_data else self.raw_data['publisher'],
-            'release_date': release_date if 'release_date' not in self.raw_data else self.raw_data['release_date'],
-            'genre': genre if 'genre' not in self.raw_data else self.raw_data['genre'],
-            'platform': platform if 'platform' not in self.raw_data else self.raw_data['platform'],
-            'brief': brief if brief else self.raw_data['brief'],
-            'other_info': None if 'other_info' not in self.raw_data else self.raw_data['other_info'],
+            'developer': developer if 'developer' not in igdb_data else igdb_data['developer'],
+            'publisher': publisher if 'publisher' not in igdb_data else igdb_data['publisher'],
+            'release_date': release_date if 'release_date' not in igdb_data else igdb_data['release_date'],
+            'genre': genre if 'genre' not in igdb_data else igdb_data['genre'],
+            'platform': platform if 'platform' not in igdb_data else igdb_data['platform'],
+            'brief': brief if brief else igdb_data['brief'],
+            'other_info': None if 'other_info' not in igdb_data else igdb_data['other_info'],
             'source_site': self.site_name,
             'source_url': effective_url
         }
-        self.raw_data = data
-        return self.raw_data, self.raw_img
+        return ScrapeResult(data, raw_img, img_ext)
 
     @classmethod
     def get_effective_url(cls, raw_url):
@@ -1,4 +1,4 @@
-import requests
+from common import http
 import re
 from common.models import SourceSiteEnum
 from movies.models import Movie
@@ -47,7 +47,7 @@ class TmdbMovieScraper(AbstractScraper):
 
     def scrape_imdb(self, imdb_code):
         api_url = f"https://api.themoviedb.org/3/find/{imdb_code}?api_key={settings.TMDB_API3_KEY}&language=zh-CN&external_source=imdb_id"
-        r = requests.get(api_url)
+        r = http.get(api_url)
         res_data = r.json()
         if 'movie_results' in res_data and len(res_data['movie_results']) > 0:
             url = f"https://www.themoviedb.org/movie/{res_data['movie_results'][0]['id']}"
@@ -70,7 +70,7 @@ class TmdbMovieScraper(AbstractScraper):
             api_url = f"https://api.themoviedb.org/3/tv/{id}?api_key={settings.TMDB_API3_KEY}&language=zh-CN&append_to_response=external_ids,credits"
         else:
             api_url = f"https://api.themoviedb.org/3/movie/{id}?api_key={settings.TMDB_API3_KEY}&language=zh-CN&append_to_response=external_ids,credits"
-        r = requests.get(api_url)
+        r = http.get(api_url)
         res_data = r.json()
 
         if is_series:
@@ -138,8 +138,7 @@ class TmdbMovieScraper(AbstractScraper):
             'source_site': self.site_name,
             'source_url': effective_url,
         }
-        self.raw_data, self.raw_img, self.img_ext = data, raw_img, ext
-        return data, raw_img
+        return ScrapeResult(data, raw_img, ext)
 
     @classmethod
     def get_effective_url(cls, raw_url):
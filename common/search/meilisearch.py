@@ -2,11 +2,14 @@ import logging
 import meilisearch
 from django.conf import settings
 from django.db.models.signals import post_save, post_delete
+from .utils import load_search_result_items
+from .tasks import enqueue_index_update, enqueue_tags_update
 import types
 
 
 INDEX_NAME = 'items'
 SEARCHABLE_ATTRIBUTES = ['title', 'orig_title', 'other_title', 'subtitle', 'artist', 'author', 'translator', 'developer', 'director', 'actor', 'playwright', 'pub_house', 'company', 'publisher', 'isbn', 'imdb_code']
+FILTERABLE_ATTRIBUTES = ['_class', 'tags', 'source_site']
 INDEXABLE_DIRECT_TYPES = ['BigAutoField', 'BooleanField', 'CharField', 'PositiveIntegerField', 'PositiveSmallIntegerField', 'TextField', 'ArrayField']
 INDEXABLE_TIME_TYPES = ['DateTimeField']
 INDEXABLE_DICT_TYPES = ['JSONField']
@@ -18,22 +21,40 @@ SEARCH_PAGE_SIZE = 20
 logger = logging.getLogger(__name__)
 
 
-def item_post_save_handler(sender, instance, created, **kwargs):
+def item_post_save_handler(sender, instance, created, update_fields=None, **kwargs):
     if not created and settings.SEARCH_INDEX_NEW_ONLY:
         return
-    Indexer.replace_item(instance)
+    if update_fields and not set(update_fields) & set(sender.indexed_fields):
+        # e.g. rating update, nothing in search document changed
+        return
+    if settings.SEARCH_INDEX_QUEUE_WINDOW:
+        enqueue_index_update(instance)
+    else:
+        Indexer.replace_item(instance)
 
 
 def item_post_delete_handler(sender, instance, **kwargs):
-    Indexer.delete_item(instance)
+    if settings.SEARCH_INDEX_QUEUE_WINDOW:
+        enqueue_index_update(instance)
+    else:
+        Indexer.delete_item(instance)
 
 
 def tag_post_save_handler(sender, instance, **kwargs):
-    pass
+    model = sender.indexed_entity_class
+    pk = getattr(instance, model.__name__.lower() + '_id')
+    if pk is None:
+        return
+    if settings.SEARCH_INDEX_QUEUE_WINDOW:
+        enqueue_tags_update(model, pk)
+    else:
+        obj = model.objects.filter(id=pk).first()
+        if obj is not None:
+            Indexer.patch_batch([obj], ['tags'])
 
 
 def tag_post_delete_handler(sender, instance, **kwargs):
-    pass
+    tag_post_save_handler(sender, instance)
 
 
 class Indexer:
@@ -54,7 +75,7 @@ class Indexer:
     @classmethod
     def update_settings(self):
         self.instance().update_searchable_attributes(SEARCHABLE_ATTRIBUTES)
-        self.instance().update_filterable_attributes(['_class', 'tags', 'source_site'])
+        self.instance().update_filterable_attributes(FILTERABLE_ATTRIBUTES)
         self.instance().update_settings({'displayedAttributes': ['_id', '_class', 'id', 'title', 'tags']})
 
     @classmethod
@@ -84,8 +105,15 @@ class Indexer:
                 model.indexable_fields_dict.append(field.name)
             elif type in INDEXABLE_FLOAT_TYPES:
                 model.indexable_fields_float.append(field.name)
+        # model fields which may change the search document
+        model.indexed_fields = [f for f in model.indexable_fields + model.indexable_fields_time + model.indexable_fields_float
+                                if f in SEARCHABLE_ATTRIBUTES or f in FILTERABLE_ATTRIBUTES or f == 'id'] + model.indexable_fields_dict
         post_save.connect(item_post_save_handler, sender=model)
         post_delete.connect(item_post_delete_handler, sender=model)
+        tag_model = model._meta.get_field(model.__name__.lower() + '_tags').related_model
+        tag_model.indexed_entity_class = model
+        post_save.connect(tag_post_save_handler, sender=tag_model)
+        post_delete.connect(tag_post_delete_handler, sender=tag_model)
 
     @classmethod
     def obj_to_dict(self, obj):
@@ -105,7 +133,8 @@ class Indexer:
             d = getattr(obj, field)
             if d.__class__ is dict:
                 item.update(d)
-        item = {k: v for k, v in item.items() if v}
+        item = {k: v for k, v in item.items() if v and (
+            k in SEARCHABLE_ATTRIBUTES or k in FILTERABLE_ATTRIBUTES or k in ['id', '_id'])}
         return item
 
     @classmethod
@@ -121,6 +150,8 @@ class Indexer:
             self.instance().update_documents(documents=objects)
         except Exception as e:
             logger.error(f"replace batch error: \n{e}")
+            return False
+        return True
 
     @classmethod
     def delete_item(self, obj):
@@ -130,6 +161,13 @@ class Indexer:
         except Exception as e:
             logger.error(f"delete item error: \n{e}")
 
+    @classmethod
+    def delete_batch(self, pks):
+        try:
+            self.instance().delete_documents(pks)
+        except Exception as e:
+            logger.error(f"delete batch error: \n{e}")
+
     @classmethod
     def patch_item(self, obj, fields):
         pk = f'{obj.__class__.__name__}-{obj.id}'
@@ -141,6 +179,19 @@ class Indexer:
         except Exception as e:
             logger.error(f"patch item error: \n{e}")
 
+    @classmethod
+    def patch_batch(self, objects, fields):
+        docs = []
+        for obj in objects:
+            doc = {'_id': f'{obj.__class__.__name__}-{obj.id}'}
+            for f in fields:
+                doc[f] = getattr(obj, f)
+            docs.append(doc)
+        try:
+            self.instance().update_documents(documents=docs)
+        except Exception as e:
+            logger.error(f"patch batch error: \n{e}")
+
     @classmethod
     def search(self, q, page=1, category=None, tag=None, sort=None):
         if category or tag:
@@ -169,7 +220,7 @@ class Indexer:
             r = {'nbHits': 0, 'hits': []}
         # print(r)
         results = types.SimpleNamespace()
-        results.items = list([x for x in map(lambda i: self.item_to_obj(i), r['hits']) if x is not None])
+        results.items = self.items_to_objs(r['hits'])
         results.num_pages = (r['nbHits'] + SEARCH_PAGE_SIZE - 1) // SEARCH_PAGE_SIZE
         # print(results)
         return results
@@ -181,3 +232,7 @@ class Indexer:
         except Exception as e:
             logger.error(f"unable to load search result item from db:\n{item}")
             return None
+
+    @classmethod
+    def items_to_objs(self, items):
+        return load_search_result_items(self.class_map, [(i['_class'], i['id']) for i in items])
@@ -0,0 +1,233 @@
+import types
+import logging
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Q, Case, When, Value, IntegerField
+from django.db.models.signals import post_save, post_delete
+from django.contrib.postgres.search import TrigramSimilarity
+from common.models import SearchDocument
+from .utils import load_search_result_items
+from .tasks import enqueue_index_update, enqueue_tags_update
+
+
+SEARCHABLE_ATTRIBUTES = ['title', 'orig_title', 'other_title', 'subtitle', 'artist', 'author', 'translator',
+                         'developer', 'director', 'actor', 'playwright', 'pub_house', 'company', 'publisher', 'isbn', 'imdb_code']
+FILTERABLE_ATTRIBUTES = ['_class', 'tags', 'source_site']
+INDEXABLE_DIRECT_TYPES = ['BigAutoField', 'BooleanField', 'CharField',
+                          'PositiveIntegerField', 'PositiveSmallIntegerField', 'TextField', 'ArrayField']
+INDEXABLE_TIME_TYPES = ['DateTimeField']
+INDEXABLE_DICT_TYPES = ['JSONField']
+INDEXABLE_FLOAT_TYPES = ['DecimalField']
+# NONINDEXABLE_TYPES = ['ForeignKey', 'FileField',]
+SEARCH_PAGE_SIZE = 20
+# gin trigram indexes make `icontains` lookups on these columns use index
+TRIGRAM_INDEXES = {
+    'search_document_title_trgm': 'title',
+    'search_document_content_trgm': 'content',
+}
+
+
+logger = logging.getLogger(__name__)
+
+
+def item_post_save_handler(sender, instance, created, update_fields=None, **kwargs):
+    if not created and settings.SEARCH_INDEX_NEW_ONLY:
+        return
+    if update_fields and not set(update_fields) & set(sender.indexed_fields):
+        # e.g. rating update, nothing in search document changed
+        return
+    if settings.SEARCH_INDEX_QUEUE_WINDOW:
+        enqueue_index_update(instance)
+    else:
+        Indexer.replace_item(instance)
+
+
+def item_post_delete_handler(sender, instance, **kwargs):
+    if settings.SEARCH_INDEX_QUEUE_WINDOW:
+        enqueue_index_update(instance)
+    else:
+        Indexer.delete_item(instance)
+
+
+def tag_post_save_handler(sender, instance, **kwargs):
+    model = sender.indexed_entity_class
+    pk = getattr(instance, model.__name__.lower() + '_id')
+    if pk is None:
+        return
+    if settings.SEARCH_INDEX_QUEUE_WINDOW:
+        enqueue_tags_update(model, pk)
+    else:
+        obj = model.objects.filter(id=pk).first()
+        if obj is not None:
+            Indexer.patch_batch([obj], ['tags'])
+
+
+def tag_post_delete_handler(sender, instance, **kwargs):
+    tag_post_save_handler(sender, instance)
+
+
+class Indexer:
+    """
+    Search backend using a table in the site's own PostgreSQL database,
+    for deployments without Typesense or Meilisearch.
+    """
+    class_map = {}
+
+    @classmethod
+    def init(self):
+        with connection.cursor() as cursor:
+            cursor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        self.update_settings()
+
+    @classmethod
+    def update_settings(self):
+        with connection.cursor() as cursor:
+            for name, column in TRIGRAM_INDEXES.items():
+                cursor.execute(f'CREATE INDEX IF NOT EXISTS {name} ON {SearchDocument._meta.db_table} USING gin ({column} gin_trgm_ops)')
+
+    @classmethod
+    def get_stats(self):
+        return {'numberOfDocuments': SearchDocument.objects.count()}
+
+    @classmethod
+    def busy(self):
+        return False
+
+    @classmethod
+    def update_model_indexable(self, model):
+        if settings.SEARCH_BACKEND is None:
+            return
+        self.class_map[model.__name__] = model
+        model.indexable_fields = ['tags']
+        model.indexable_fields_time = []
+        model.indexable_fields_dict = []
+        model.indexable_fields_float = []
+        for field in model._meta.get_fields():
+            type = field.get_internal_type()
+            if type in INDEXABLE_DIRECT_TYPES:
+                model.indexable_fields.append(field.name)
+            elif type in INDEXABLE_TIME_TYPES:
+                model.indexable_fields_time.append(field.name)
+            elif type in INDEXABLE_DICT_TYPES:
+                model.indexable_fields_dict.append(field.name)
+            elif type in INDEXABLE_FLOAT_TYPES:
+                model.indexable_fields_float.append(field.name)
+        # model fields which may change the search document
+        model.indexed_fields = [f for f in model.indexable_fields + model.indexable_fields_time + model.indexable_fields_float
+                                if f in SEARCHABLE_ATTRIBUTES or f in FILTERABLE_ATTRIBUTES or f == 'id'] + model.indexable_fields_dict
+        post_save.connect(item_post_save_handler, sender=model)
+        post_delete.connect(item_post_delete_handler, sender=model)
+        tag_model = model._meta.get_field(model.__name__.lower() + '_tags').related_model
+        tag_model.indexed_entity_class = model
+        post_save.connect(tag_post_save_handler, sender=tag_model)
+        post_delete.connect(tag_post_delete_handler, sender=tag_model)
+
+    @classmethod
+    def obj_to_dict(self, obj):
+        pk = f'{obj.__class__.__name__}-{obj.id}'
+        item = {
+            '_id': pk,
+            '_class': obj.__class__.__name__,
+            'id': obj.id,
+        }
+        for field in obj.__class__.indexable_fields:
+            item[field] = getattr(obj, field)
+        for field in obj.__class__.indexable_fields_dict:
+            d = getattr(obj, field)
+            if d.__class__ is dict:
+                item.update(d)
+        item = {k: v for k, v in item.items() if v and (
+            k in SEARCHABLE_ATTRIBUTES or k in FILTERABLE_ATTRIBUTES or k in ['id', '_id'])}
+        return item
+
+    @classmethod
+    def dict_to_document(self, item):
+        content = []
+        for k in SEARCHABLE_ATTRIBUTES:
+            if k != 'title' and k in item:
+                v = item[k]
+                content.append(' '.join(map(str, v)) if isinstance(v, list) else str(v))
+        return SearchDocument(
+            key=item['_id'],
+            item_class=item['_class'],
+            item_id=item['id'],
+            title=str(item.get('title', '')),
+            content='\n'.join(content),
+            tags=item.get('tags', [])[:100],
+            source_site=item.get('source_site', ''),
+        )
+
+    @classmethod
+    def replace_item(self, obj):
+        self.replace_batch([self.obj_to_dict(obj)])
+
+    @classmethod
+    def replace_batch(self, objects):
+        docs = [self.dict_to_document(o) for o in objects]
+        try:
+            with transaction.atomic():
+                SearchDocument.objects.filter(key__in=[d.key for d in docs]).delete()
+                SearchDocument.objects.bulk_create(docs)
+        except Exception as e:
+            logger.error(f"replace batch error: \n{e}")
+            return False
+        return True
+
+    @classmethod
+    def delete_item(self, obj):
+        self.delete_batch([f'{obj.__class__.__name__}-{obj.id}'])
+
+    @classmethod
+    def delete_batch(self, pks):
+        try:
+            SearchDocument.objects.filter(key__in=pks).delete()
+        except Exception as e:
+            logger.error(f"delete batch error: \n{e}")
+
+    @classmethod
+    def patch_batch(self, objects, fields):
+        objs = {f'{obj.__class__.__name__}-{obj.id}': obj for obj in objects}
+        try:
+            docs = list(SearchDocument.objects.filter(key__in=list(objs.keys())))
+            for doc in docs:
+                for f in fields:
+                    v = getattr(objs[doc.key], f)
+                    setattr(doc, f, v[:100] if f == 'tags' else v)
+            SearchDocument.objects.bulk_update(docs, fields)
+        except Exception as e:
+            logger.error(f"patch batch error: \n{e}")
+
+    @classmethod
+    def search(self, q, page=1, category=None, tag=None, sort=None):
+        qs = SearchDocument.objects.all()
+        if category == 'music':
+            qs = qs.filter(item_class__in=['Album', 'Song'])
+        elif category:
+            qs = qs.filter(item_class__iexact=category)
+        if tag:
+            qs = qs.filter(tags__contains=[tag])
+        if q:
+            # every term must appear in title or other fields, not necessarily next to each other
+            for term in q.split():
+                qs = qs.filter(Q(title__icontains=term) | Q(content__icontains=term))
+            qs = qs.annotate(
+                exact=Case(When(title__iexact=q, then=Value(1)), default=Value(0), output_field=IntegerField()),
+                similarity=TrigramSimilarity('title', q),
+            ).order_by('-exact', '-similarity', '-item_id')
+        else:
+            qs = qs.order_by('-item_id')
+        results = types.SimpleNamespace()
+        try:
+            count = qs.count()
+            docs = qs[(page - 1) * SEARCH_PAGE_SIZE:page * SEARCH_PAGE_SIZE]
+            results.items = self.items_to_objs(docs)
+            results.num_pages = (count + SEARCH_PAGE_SIZE - 1) // SEARCH_PAGE_SIZE
+        except Exception as e:
+            logger.error(f"PostgreSQL search error: \n{e}")
+            results.items = []
+            results.num_pages = 1
+        return results
+
+    @classmethod
+    def items_to_objs(self, items):
+        return load_search_result_items(self.class_map, [(i.item_class, i.item_id) for i in items])
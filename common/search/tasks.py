@@ -0,0 +1,149 @@
+import json
+import hashlib
+import logging
+from datetime import timedelta
+import django_rq
+from django.conf import settings
+from django.db import transaction
+from common.models import Entity
+
+
+INDEX_QUEUE = 'index'
+PENDING_KEY = 'search_index:pending'
+PENDING_TAGS_KEY = 'search_index:pending_tags'
+FLUSH_SCHEDULED_KEY = 'search_index:flush_scheduled'
+# one hash field (key of item -> md5 hex of its document) per indexed item, roughly 100 bytes each in redis,
+# i.e. about 100MB per million items; it's wiped whenever index is created or fully rebuilt
+FINGERPRINTS_KEY = 'search_index:fingerprints'
+FLUSH_BATCH_SIZE = 1000
+
+
+logger = logging.getLogger(__name__)
+
+
+def enqueue_index_update(obj):
+    """
+    Queue an item for index update once current transaction is committed.
+    Pending items are kept in a redis set so that repeated saves of the same item
+    collapse into one document, and are written by `flush_index_updates` in batch.
+    Items no longer in db by then are deleted from index, so this works for both
+    post_save and post_delete.
+    """
+    key = f'{obj.__class__.__name__}-{obj.id}'
+    transaction.on_commit(lambda: _add_pending(PENDING_KEY, key))
+
+
+def enqueue_tags_update(model, pk):
+    """
+    Queue an item for refreshing only the `tags` field of its document
+    """
+    key = f'{model.__name__}-{pk}'
+    transaction.on_commit(lambda: _add_pending(PENDING_TAGS_KEY, key))
+
+
+def update_index_of(entities):
+    """
+    Write full documents of entities to index, for changes written in bulk without signals
+    """
+    if settings.SEARCH_BACKEND is None or not entities:
+        return
+    keys = [f'{e.__class__.__name__}-{e.id}' for e in entities]
+    if settings.SEARCH_INDEX_QUEUE_WINDOW:
+        transaction.on_commit(lambda: _add_pending(PENDING_KEY, *keys))
+    else:
+        update_index_batch(keys)
+
+
+def _add_pending(pending_key, *keys):
+    key = keys[0] if len(keys) == 1 else f'{len(keys)} items'
+    try:
+        conn = django_rq.get_connection(INDEX_QUEUE)
+        conn.sadd(pending_key, *keys)
+        window = settings.SEARCH_INDEX_QUEUE_WINDOW
+        # the flag expires in case the flush job is lost, so that later updates schedule a new one
+        if conn.set(FLUSH_SCHEDULED_KEY, 1, nx=True, ex=window * 10 + 60):
+            django_rq.get_queue(INDEX_QUEUE).enqueue_in(timedelta(seconds=window), flush_index_updates)
+    except Exception as e:
+        logger.error(f"queue index update error: {key}\n{e}")
+
+
+def flush_index_updates():
+    conn = django_rq.get_connection(INDEX_QUEUE)
+    # clear the flag first, items queued from now on will be handled by next flush
+    conn.delete(FLUSH_SCHEDULED_KEY)
+    for pending_key, update in [(PENDING_KEY, update_index_batch), (PENDING_TAGS_KEY, update_index_tags)]:
+        while True:
+            keys = conn.spop(pending_key, FLUSH_BATCH_SIZE)
+            if not keys:
+                break
+            update([k.decode() for k in keys])
+
+
+def _group_keys(keys):
+    ids = {}
+    for key in keys:
+        class_name, pk = key.rsplit('-', 1)
+        ids.setdefault(class_name, set()).add(int(pk))
+    return ids
+
+
+def update_index_batch(keys):
+    """
+    Write current state of items to index, keys are in form of `Book-123`
+    """
+    from common.index import Indexer
+    docs = {}
+    deleted = []
+    for class_name, pks in _group_keys(keys).items():
+        model = Indexer.class_map.get(class_name)
+        if model is None:
+            logger.error(f"unknown class in index queue: {class_name}")
+            continue
+        objs = Entity.prefetch_tag_lists(list(model.objects.filter(id__in=pks)))
+        for o in objs:
+            docs[f'{class_name}-{o.id}'] = Indexer.obj_to_dict(o)
+        deleted += [f'{class_name}-{pk}' for pk in pks - set(o.id for o in objs)]
+    conn = django_rq.get_connection(INDEX_QUEUE)
+    if docs:
+        # skip documents identical to what was written last time
+        keys = list(docs.keys())
+        fingerprints = dict(zip(keys, map(get_fingerprint, docs.values())))
+        written = dict(zip(keys, conn.hmget(FINGERPRINTS_KEY, keys)))
+        changed = [k for k in keys if written[k] is None or written[k].decode() != fingerprints[k]]
+        # fingerprints are only kept for documents written, failed ones are sent again next time they are queued
+        if changed and Indexer.replace_batch([docs[k] for k in changed]):
+            conn.hset(FINGERPRINTS_KEY, mapping={k: fingerprints[k] for k in changed})
+    if deleted:
+        Indexer.delete_batch(deleted)
+        conn.hdel(FINGERPRINTS_KEY, *deleted)
+
+
+def update_index_tags(keys):
+    """
+    Refresh `tags` field of documents, items no longer in db are ignored
+    """
+    from common.index import Indexer
+    objs = []
+    for class_name, pks in _group_keys(keys).items():
+        model = Indexer.class_map.get(class_name)
+        if model is None:
+            logger.error(f"unknown class in index queue: {class_name}")
+            continue
+        objs += list(model.objects.filter(id__in=pks).only('id'))
+    if objs:
+        Entity.prefetch_tag_lists(objs)
+        Indexer.patch_batch(objs, ['tags'])
+        # documents no longer match fingerprints of full writes
+        conn = django_rq.get_connection(INDEX_QUEUE)
+        conn.hdel(FINGERPRINTS_KEY, *[f'{o.__class__.__name__}-{o.id}' for o in objs])
+
+
+def get_fingerprint(doc):
+    return hashlib.md5(json.dumps(doc, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def clear_fingerprints():
+    """
+    Forget what have been written to index, must be called when index is recreated or rebuilt
+    """
+    django_rq.get_connection(INDEX_QUEUE).delete(FINGERPRINTS_KEY)
@@ -4,6 +4,8 @@ import typesense
 from typesense.exceptions import ObjectNotFound
 from django.conf import settings
 from django.db.models.signals import post_save, post_delete
+from .utils import load_search_result_items
+from .tasks import enqueue_index_update, enqueue_tags_update
 
 
 INDEX_NAME = 'items'
@@ -23,22 +25,40 @@ SEARCH_PAGE_SIZE = 20
 logger = logging.getLogger(__name__)
 
 
-def item_post_save_handler(sender, instance, created, **kwargs):
+def item_post_save_handler(sender, instance, created, update_fields=None, **kwargs):
     if not created and settings.SEARCH_INDEX_NEW_ONLY:
         return
-    Indexer.replace_item(instance)
+    if update_fields and not set(update_fields) & set(sender.indexed_fields):
+        # e.g. rating update, nothing in search document changed
+        return
+    if settings.SEARCH_INDEX_QUEUE_WINDOW:
+        enqueue_index_update(instance)
+    else:
+        Indexer.replace_item(instance)
 
 
 def item_post_delete_handler(sender, instance, **kwargs):
-    Indexer.delete_item(instance)
+    if settings.SEARCH_INDEX_QUEUE_WINDOW:
+        enqueue_index_update(instance)
+    else:
+        Indexer.delete_item(instance)
 
 
 def tag_post_save_handler(sender, instance, **kwargs):
-    pass
+    model = sender.indexed_entity_class
+    pk = getattr(instance, model.__name__.lower() + '_id')
+    if pk is None:
+        return
+    if settings.SEARCH_INDEX_QUEUE_WINDOW:
+        enqueue_tags_update(model, pk)
+    else:
+        obj = model.objects.filter(id=pk).first()
+        if obj is not None:
+            Indexer.patch_batch([obj], ['tags'])
 
 
 def tag_post_delete_handler(sender, instance, **kwargs):
-    pass
+    tag_post_save_handler(sender, instance)
 
 
 class Indexer:
@@ -123,8 +143,15 @@ class Indexer:
                 model.indexable_fields_dict.append(field.name)
             elif type in INDEXABLE_FLOAT_TYPES:
                 model.indexable_fields_float.append(field.name)
+        # model fields which may change the search document
+        model.indexed_fields = [f for f in model.indexable_fields + model.indexable_fields_time + model.indexable_fields_float
+                                if f in SEARCHABLE_ATTRIBUTES or f in FILTERABLE_ATTRIBUTES or f == 'id'] + model.indexable_fields_dict
         post_save.connect(item_post_save_handler, sender=model)
         post_delete.connect(item_post_delete_handler, sender=model)
+        tag_model = model._meta.get_field(model.__name__.lower() + '_tags').related_model
+        tag_model.indexed_entity_class = model
+        post_save.connect(tag_post_save_handler, sender=tag_model)
+        post_delete.connect(tag_post_delete_handler, sender=tag_model)
 
     @classmethod
     def obj_to_dict(self, obj):
@@ -162,10 +189,16 @@ class Indexer:
     @classmethod
     def replace_batch(self, objects):
         try:
-            self.instance().collections[INDEX_NAME].documents.import_(
-                objects, {'action': 'upsert'})
+            results = self.instance().collections[INDEX_NAME].documents.import_(
+                objects, {'action': 'upsert', 'dirty_values': 'coerce_or_drop'})
         except Exception as e:
             logger.error(f"replace batch error: \n{e}")
+            return False
+        failed = [r for r in results if not r.get('success')]
+        if failed:
+            logger.error(f"replace batch error: {len(failed)} documents failed\n{failed[0]}")
+            return False
+        return True
 
     @classmethod
     def delete_item(self, obj):
@@ -175,6 +208,30 @@ class Indexer:
         except Exception as e:
             logger.error(f"delete item error: \n{e}")
 
+    @classmethod
+    def delete_batch(self, pks):
+        for pk in pks:
+            try:
+                self.instance().collections[INDEX_NAME].documents[pk].delete()
+            except ObjectNotFound:
+                pass
+            except Exception as e:
+                logger.error(f"delete batch error: \n{e}")
+
+    @classmethod
+    def patch_batch(self, objects, fields):
+        docs = []
+        for obj in objects:
+            doc = {'id': f'{obj.__class__.__name__}-{obj.id}'}
+            for f in fields:
+                doc[f] = getattr(obj, f)
+            docs.append(doc)
+        try:
+            self.instance().collections[INDEX_NAME].documents.import_(
+                docs, {'action': 'update', 'dirty_values': 'coerce_or_drop'})
+        except Exception as e:
+            logger.error(f"patch batch error: \n{e}")
+
     @classmethod
     def search(self, q, page=1, category=None, tag=None, sort=None):
         f = []
@@ -200,7 +257,7 @@ class Indexer:
 
         try:
             r = self.instance().collections[INDEX_NAME].documents.search(options)
-            results.items = list([x for x in map(lambda i: self.item_to_obj(i['document']), r['hits']) if x is not None])
+            results.items = self.items_to_objs([i['document'] for i in r['hits']])
             results.num_pages = (r['found'] + SEARCH_PAGE_SIZE - 1) // SEARCH_PAGE_SIZE
         except ObjectNotFound:
             results.items = []
@@ -215,3 +272,7 @@ class Indexer:
         except Exception as e:
             logger.error(f"unable to load search result item from db:\n{item}")
             return None
+
+    @classmethod
+    def items_to_objs(self, items):
+        return load_search_result_items(self.class_map, [(i['_class'], i['_id']) for i in items])
@@ -0,0 +1,33 @@
+import logging
+from common.models import Entity
+
+
+logger = logging.getLogger(__name__)
+
+
+def load_search_result_items(class_map, refs):
+    """
+    Load model objects for search hits with one query per class.
+
+    refs -- list of (class name, id) in the order returned by search engine
+    return objects in the same order, hits missing from db are skipped
+    """
+    ids = {}
+    for class_name, pk in refs:
+        ids.setdefault(class_name, []).append(pk)
+    objects = {}
+    for class_name, pks in ids.items():
+        if class_name not in class_map:
+            logger.error(f"unknown class in search result: {class_name}")
+            continue
+        for obj in class_map[class_name].objects.filter(id__in=pks):
+            objects[(class_name, obj.id)] = obj
+    items = []
+    for class_name, pk in refs:
+        obj = objects.get((class_name, int(pk)))
+        if obj is None:
+            logger.error(f"unable to load search result item from db: {class_name} {pk}")
+        else:
+            items.append(obj)
+    Entity.prefetch_tag_lists(items)
+    return items
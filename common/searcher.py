@@ -4,11 +4,19 @@ from common.models import SourceSiteEnum
 from django.conf import settings
 from common.scrapers.goodreads import GoodreadsScraper
 from common.scrapers.spotify import get_spotify_token
-import requests
+from concurrent.futures import ThreadPoolExecutor, wait
+import django_rq
+from common import http
 from lxml import html
 import logging
+import hashlib
+import pickle
+import time
 
 SEARCH_PAGE_SIZE = 5  # not all apis support page size
+EXTERNAL_SEARCH_WORKERS = 20
+METRICS_KEY = 'external_search:metrics'
+CACHE_KEY_PREFIX = 'external_search:cache'
 logger = logging.getLogger(__name__)
 
 
@@ -47,39 +55,36 @@ class ProxiedRequest:
     @classmethod
     def get(cls, url):
         u = f'http://api.scraperapi.com?api_key={settings.SCRAPERAPI_KEY}&url={quote_plus(url)}'
-        return requests.get(u, timeout=10)
+        return http.get(u, timeout=10)
 
 
 class Goodreads:
     @classmethod
     def search(self, q, page=1):
         results = []
-        try:
-            search_url = f'https://www.goodreads.com/search?page={page}&q={quote_plus(q)}'
-            r = requests.get(search_url)
-            if r.url.startswith('https://www.goodreads.com/book/show/'):
-                # Goodreads will 302 if only one result matches ISBN
-                data, img = GoodreadsScraper.scrape(r.url, r)
-                subtitle = f"{data['pub_year']} {', '.join(data['author'])} {', '.join(data['translator'] if data['translator'] else [])}"
-                results.append(SearchResultItem(Category.Book, SourceSiteEnum.GOODREADS,
-                                                data['source_url'], data['title'], subtitle,
-                                                data['brief'], data['cover_url']))
-            else:
-                h = html.fromstring(r.content.decode('utf-8'))
-                for c in h.xpath('//tr[@itemtype="http://schema.org/Book"]'):
-                    el_cover = c.xpath('.//img[@class="bookCover"]/@src')
-                    cover = el_cover[0] if el_cover else None
-                    el_title = c.xpath('.//a[@class="bookTitle"]//text()')
-                    title = ''.join(el_title).strip() if el_title else None
-                    el_url = c.xpath('.//a[@class="bookTitle"]/@href')
-                    url = 'https://www.goodreads.com' + \
-                        el_url[0] if el_url else None
-                    el_authors = c.xpath('.//a[@class="authorName"]//text()')
-                    subtitle = ', '.join(el_authors) if el_authors else None
-                    results.append(SearchResultItem(
-                        Category.Book, SourceSiteEnum.GOODREADS, url, title, subtitle, '', cover))
-        except Exception as e:
-            logger.error(f"Goodreads search '{q}' error: {e}")
+        search_url = f'https://www.goodreads.com/search?page={page}&q={quote_plus(q)}'
+        r = http.get(search_url, timeout=settings.EXTERNAL_SEARCH_TIMEOUT)
+        if r.url.startswith('https://www.goodreads.com/book/show/'):
+            # Goodreads will 302 if only one result matches ISBN
+            data = GoodreadsScraper.scrape(r.url, r).data
+            subtitle = f"{data['pub_year']} {', '.join(data['author'])} {', '.join(data['translator'] if data['translator'] else [])}"
+            results.append(SearchResultItem(Category.Book, SourceSiteEnum.GOODREADS,
+                                            data['source_url'], data['title'], subtitle,
+                                            data['brief'], data['cover_url']))
+        else:
+            h = html.fromstring(r.content.decode('utf-8'))
+            for c in h.xpath('//tr[@itemtype="http://schema.org/Book"]'):
+                el_cover = c.xpath('.//img[@class="bookCover"]/@src')
+                cover = el_cover[0] if el_cover else None
+                el_title = c.xpath('.//a[@class="bookTitle"]//text()')
+                title = ''.join(el_title).strip() if el_title else None
+                el_url = c.xpath('.//a[@class="bookTitle"]/@href')
+                url = 'https://www.goodreads.com' + \
+                    el_url[0] if el_url else None
+                el_authors = c.xpath('.//a[@class="authorName"]//text()')
+                subtitle = ', '.join(el_authors) if el_authors else None
+                results.append(SearchResultItem(
+                    Category.Book, SourceSiteEnum.GOODREADS, url, title, subtitle, '', cover))
         return results
 
 
@@ -87,33 +92,30 @@ class GoogleBooks:
     @classmethod
     def search(self, q, page=1):
         results = []
-        try:
-            api_url = f'https://www.googleapis.com/books/v1/volumes?country=us&q={quote_plus(q)}&startIndex={SEARCH_PAGE_SIZE*(page-1)}&maxResults={SEARCH_PAGE_SIZE}&maxAllowedMaturityRating=MATURE'
-            j = requests.get(api_url).json()
-            if 'items' in j:
-                for b in j['items']:
-                    if 'title' not in b['volumeInfo']:
-                        continue
-                    title = b['volumeInfo']['title']
-                    subtitle = ''
-                    if 'publishedDate' in b['volumeInfo']:
-                        subtitle += b['volumeInfo']['publishedDate'] + ' '
-                    if 'authors' in b['volumeInfo']:
-                        subtitle += ', '.join(b['volumeInfo']['authors'])
-                    if 'description' in b['volumeInfo']:
-                        brief = b['volumeInfo']['description']
-                    elif 'textSnippet' in b['volumeInfo']:
-                        brief = b["volumeInfo"]["textSnippet"]["searchInfo"]
-                    else:
-                        brief = ''
-                    category = Category.Book
-                    # b['volumeInfo']['infoLink'].replace('http:', 'https:')
-                    url = 'https://books.google.com/books?id=' + b['id']
-                    cover = b['volumeInfo']['imageLinks']['thumbnail'] if 'imageLinks' in b['volumeInfo'] else None
-                    results.append(SearchResultItem(
-                        category, SourceSiteEnum.GOOGLEBOOKS, url, title, subtitle, brief, cover))
-        except Exception as e:
-            logger.error(f"GoogleBooks search '{q}' error: {e}")
+        api_url = f'https://www.googleapis.com/books/v1/volumes?country=us&q={quote_plus(q)}&startIndex={SEARCH_PAGE_SIZE*(page-1)}&maxResults={SEARCH_PAGE_SIZE}&maxAllowedMaturityRating=MATURE'
+        j = http.get(api_url, timeout=settings.EXTERNAL_SEARCH_TIMEOUT).json()
+        if 'items' in j:
+            for b in j['items']:
+                if 'title' not in b['volumeInfo']:
+                    continue
+                title = b['volumeInfo']['title']
+                subtitle = ''
+                if 'publishedDate' in b['volumeInfo']:
+                    subtitle += b['volumeInfo']['publishedDate'] + ' '
+                if 'authors' in b['volumeInfo']:
+                    subtitle += ', '.join(b['volumeInfo']['authors'])
+                if 'description' in b['volumeInfo']:
+                    brief = b['volumeInfo']['description']
+                elif 'textSnippet' in b['volumeInfo']:
+                    brief = b["volumeInfo"]["textSnippet"]["searchInfo"]
+                else:
+                    brief = ''
+                category = Category.Book
+                # b['volumeInfo']['infoLink'].replace('http:', 'https:')
+                url = 'https://books.google.com/books?id=' + b['id']
+                cover = b['volumeInfo']['imageLinks']['thumbnail'] if 'imageLinks' in b['volumeInfo'] else None
+                results.append(SearchResultItem(
+                    category, SourceSiteEnum.GOOGLEBOOKS, url, title, subtitle, brief, cover))
         return results
 
 
@@ -121,25 +123,22 @@ class TheMovieDatabase:
     @classmethod
     def search(self, q, page=1):
         results = []
-        try:
-            api_url = f'https://api.themoviedb.org/3/search/multi?query={quote_plus(q)}&page={page}&api_key={settings.TMDB_API3_KEY}&language=zh-CN&include_adult=true'
-            j = requests.get(api_url).json()
-            for m in j['results']:
-                if m['media_type'] in ['tv', 'movie']:
-                    url = f"https://www.themoviedb.org/{m['media_type']}/{m['id']}"
-                    if m['media_type'] == 'tv':
-                        cat = Category.TV
-                        title = m['name']
-                        subtitle = f"{m.get('first_air_date')} {m.get('original_name')}"
-                    else:
-                        cat = Category.Movie
-                        title = m['title']
-                        subtitle = f"{m.get('release_date')} {m.get('original_name')}"
-                    cover = f"https://image.tmdb.org/t/p/w500/{m.get('poster_path')}"
-                    results.append(SearchResultItem(
-                        cat, SourceSiteEnum.TMDB, url, title, subtitle, m.get('overview'), cover))
-        except Exception as e:
-            logger.error(f"TMDb search '{q}' error: {e}")
+        api_url = f'https://api.themoviedb.org/3/search/multi?query={quote_plus(q)}&page={page}&api_key={settings.TMDB_API3_KEY}&language=zh-CN&include_adult=true'
+        j = http.get(api_url, timeout=settings.EXTERNAL_SEARCH_TIMEOUT).json()
+        for m in j['results']:
+            if m['media_type'] in ['tv', 'movie']:
+                url = f"https://www.themoviedb.org/{m['media_type']}/{m['id']}"
+                if m['media_type'] == 'tv':
+                    cat = Category.TV
+                    title = m['name']
+                    subtitle = f"{m.get('first_air_date')} {m.get('original_name')}"
+                else:
+                    cat = Category.Movie
+                    title = m['title']
+                    subtitle = f"{m.get('release_date')} {m.get('original_name')}"
+                cover = f"https://image.tmdb.org/t/p/w500/{m.get('poster_path')}"
+                results.append(SearchResultItem(
+                    cat, SourceSiteEnum.TMDB, url, title, subtitle, m.get('overview'), cover))
         return results
 
 
@@ -147,23 +146,20 @@ class Spotify:
     @classmethod
     def search(self, q, page=1):
         results = []
-        try:
-            api_url = f"https://api.spotify.com/v1/search?q={q}&type=album&limit={SEARCH_PAGE_SIZE}&offset={page*SEARCH_PAGE_SIZE}"
-            headers = {
-                'Authorization': f"Bearer {get_spotify_token()}"
-            }
-            j = requests.get(api_url, headers=headers).json()
-            for a in j['albums']['items']:
-                title = a['name']
-                subtitle = a['release_date']
-                for artist in a['artists']:
-                    subtitle += ' ' + artist['name']
-                url = a['external_urls']['spotify']
-                cover = a['images'][0]['url']
-                results.append(SearchResultItem(
-                    Category.Music, SourceSiteEnum.SPOTIFY, url, title, subtitle, '', cover))
-        except Exception as e:
-            logger.error(f"Spotify search '{q}' error: {e}")
+        api_url = f"https://api.spotify.com/v1/search?q={q}&type=album&limit={SEARCH_PAGE_SIZE}&offset={page*SEARCH_PAGE_SIZE}"
+        headers = {
+            'Authorization': f"Bearer {get_spotify_token()}"
+        }
+        j = http.get(api_url, headers=headers, timeout=settings.EXTERNAL_SEARCH_TIMEOUT).json()
+        for a in j['albums']['items']:
+            title = a['name']
+            subtitle = a['release_date']
+            for artist in a['artists']:
+                subtitle += ' ' + artist['name']
+            url = a['external_urls']['spotify']
+            cover = a['images'][0]['url']
+            results.append(SearchResultItem(
+                Category.Music, SourceSiteEnum.SPOTIFY, url, title, subtitle, '', cover))
         return results
 
 
@@ -171,26 +167,28 @@ class Bandcamp:
     @classmethod
     def search(self, q, page=1):
         results = []
-        try:
-            search_url = f'https://bandcamp.com/search?from=results&item_type=a&page={page}&q={quote_plus(q)}'
-            r = requests.get(search_url)
-            h = html.fromstring(r.content.decode('utf-8'))
-            for c in h.xpath('//li[@class="searchresult data-search"]'):
-                el_cover = c.xpath('.//div[@class="art"]/img/@src')
-                cover = el_cover[0] if el_cover else None
-                el_title = c.xpath('.//div[@class="heading"]//text()')
-                title = ''.join(el_title).strip() if el_title else None
-                el_url = c.xpath('..//div[@class="itemurl"]/a/@href')
-                url = el_url[0] if el_url else None
-                el_authors = c.xpath('.//div[@class="subhead"]//text()')
-                subtitle = ', '.join(el_authors) if el_authors else None
-                results.append(SearchResultItem(Category.Music, SourceSiteEnum.BANDCAMP, url, title, subtitle, '', cover))
-        except Exception as e:
-            logger.error(f"Goodreads search '{q}' error: {e}")
+        search_url = f'https://bandcamp.com/search?from=results&item_type=a&page={page}&q={quote_plus(q)}'
+        r = http.get(search_url, timeout=settings.EXTERNAL_SEARCH_TIMEOUT)
+        h = html.fromstring(r.content.decode('utf-8'))
+        for c in h.xpath('//li[@class="searchresult data-search"]'):
+            el_cover = c.xpath('.//div[@class="art"]/img/@src')
+            cover = el_cover[0] if el_cover else None
+            el_title = c.xpath('.//div[@class="heading"]//text()')
+            title = ''.join(el_title).strip() if el_title else None
+            el_url = c.xpath('..//div[@class="itemurl"]/a/@href')
+            url = el_url[0] if el_url else None
+            el_authors = c.xpath('.//div[@class="subhead"]//text()')
+            subtitle = ', '.join(el_authors) if el_authors else None
+            results.append(SearchResultItem(Category.Music, SourceSiteEnum.BANDCAMP, url, title, subtitle, '', cover))
         return results
 
 
 class ExternalSources:
+    """
+    Query providers concurrently, return whatever arrived before the deadline
+    """
+    executor = ThreadPoolExecutor(max_workers=EXTERNAL_SEARCH_WORKERS, thread_name_prefix='external_search')
+
     @classmethod
     def search(self, c, q, page=1):
         if not q:
@@ -198,12 +196,114 @@ class ExternalSources:
         results = []
         if c == '' or c is None:
             c = 'all'
+        providers = []
         if c == 'all' or c == 'movie':
-            results.extend(TheMovieDatabase.search(q, page))
+            providers.append(TheMovieDatabase)
         if c == 'all' or c == 'book':
-            results.extend(GoogleBooks.search(q, page))
-            results.extend(Goodreads.search(q, page))
+            providers.append(GoogleBooks)
+            providers.append(Goodreads)
         if c == 'all' or c == 'music':
-            results.extend(Spotify.search(q, page))
-            results.extend(Bandcamp.search(q, page))
+            providers.append(Spotify)
+            providers.append(Bandcamp)
+        futures = [self.executor.submit(self.search_provider, p, q, page) for p in providers]
+        wait(futures, timeout=settings.EXTERNAL_SEARCH_DEADLINE)
+        # keep results in provider order so that pages look the same each time
+        for provider, future in zip(providers, futures):
+            if future.done():
+                results.extend(future.result())
+            else:
+                logger.error(f"{provider.__name__} search '{q}' timed out")
+                self.record_metrics(provider, timeouts=1)
         return results
+
+    @classmethod
+    def search_provider(self, provider, q, page):
+        """
+        Serve from cache when possible, stale results are served while being refreshed in background
+        """
+        key = self.cache_key(provider, q, page)
+        cached = self.cache_get(key)
+        if cached is not None:
+            fetched_time, results = cached
+            self.record_metrics(provider, cache_hits=1)
+            if results and time.time() - fetched_time > settings.EXTERNAL_SEARCH_CACHE_TTL:
+                # only one refresh at a time for each key
+                try:
+                    conn = django_rq.get_connection('default')
+                    if conn.set(key + ':refreshing', 1, nx=True, ex=settings.EXTERNAL_SEARCH_DEADLINE * 2):
+                        self.executor.submit(self.fetch_provider, provider, q, page, key)
+                except Exception as e:
+                    logger.error(f"unable to refresh external search cache {key}: {e}")
+            return results
+        results = self.fetch_provider(provider, q, page, key)
+        return results if results is not None else []
+
+    @classmethod
+    def fetch_provider(self, provider, q, page, key):
+        """
+        return None if provider failed, otherwise results which are also saved to cache
+        """
+        start = time.time()
+        try:
+            results = provider.search(q, page)
+            self.record_metrics(provider, calls=1, latency_ms=int((time.time() - start) * 1000))
+        except Exception as e:
+            logger.error(f"{provider.__name__} search '{q}' error: {e}")
+            self.record_metrics(provider, calls=1, errors=1, latency_ms=int((time.time() - start) * 1000))
+            return None
+        self.cache_set(key, results)
+        return results
+
+    @classmethod
+    def cache_key(self, provider, q, page):
+        normalized_q = ' '.join(q.lower().split())
+        return f'{CACHE_KEY_PREFIX}:{provider.__name__}:{page}:{hashlib.md5(normalized_q.encode()).hexdigest()}'
+
+    @classmethod
+    def cache_get(self, key):
+        try:
+            v = django_rq.get_connection('default').get(key)
+            return pickle.loads(v) if v else None
+        except Exception as e:
+            logger.error(f"unable to read external search cache {key}: {e}")
+            return None
+
+    @classmethod
+    def cache_set(self, key, results):
+        # empty results are kept shortly and never served stale
+        if results:
+            ex = settings.EXTERNAL_SEARCH_CACHE_TTL + settings.EXTERNAL_SEARCH_CACHE_STALE_TTL
+        else:
+            ex = settings.EXTERNAL_SEARCH_CACHE_NEGATIVE_TTL
+        try:
+            django_rq.get_connection('default').set(key, pickle.dumps((time.time(), results)), ex=ex)
+        except Exception as e:
+            logger.error(f"unable to write external search cache {key}: {e}")
+
+    @classmethod
+    def record_metrics(self, provider, **counters):
+        try:
+            conn = django_rq.get_connection('default')
+            pipe = conn.pipeline()
+            for k, v in counters.items():
+                pipe.hincrby(METRICS_KEY, f'{provider.__name__}:{k}', v)
+            pipe.execute()
+        except Exception as e:
+            logger.error(f"unable to record metrics of {provider.__name__}: {e}")
+
+    @classmethod
+    def get_metrics(self):
+        """
+        return {provider: {calls, errors, timeouts, latency_ms, avg_latency_ms, cache_hits}}, counted since last reset
+        """
+        metrics = {}
+        for k, v in django_rq.get_connection('default').hgetall(METRICS_KEY).items():
+            provider, counter = k.decode().split(':')
+            metrics.setdefault(provider, {'calls': 0, 'errors': 0, 'timeouts': 0, 'latency_ms': 0, 'cache_hits': 0})[counter] = int(v)
+        for m in metrics.values():
+            m['avg_latency_ms'] = m['latency_ms'] // m['calls'] if m['calls'] else None
+        return metrics
+
+    @classmethod
+    def reset_metrics(self):
+        django_rq.get_connection('default').delete(METRICS_KEY)
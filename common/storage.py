@@ -0,0 +1,62 @@
+import os
+import hashlib
+import tempfile
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+from django.utils.deconstruct import deconstructible
+
+
+@deconstructible
+class CoverStorage(FileSystemStorage):
+    """
+    Store cover images by hash of their content under COVER_MEDIA_PATH_ROOT.
+    The name given by `upload_to` is only used for its extension, identical
+    images share one file, and saving an image already stored writes nothing.
+    Files are referenced by the `cover` columns of entities, those no longer
+    referenced are removed by `manage.py gc_covers`.
+
+    Files are written to a temporary name and renamed into place, so a crash
+    never leaves a truncated image under a name already in use.
+    """
+
+    def save(self, name, content, max_length=None):
+        if name is None:
+            name = content.name
+        if not hasattr(content, 'chunks'):
+            content = File(content, name)
+        name = self.get_content_name(name, content)
+        if self.exists(name):
+            return name
+        return super().save(name, content, max_length)
+
+    def _save(self, name, content):
+        full_path = self.path(name)
+        directory = os.path.dirname(full_path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in content.chunks():
+                    f.write(chunk)
+            if self.file_permissions_mode is not None:
+                os.chmod(tmp_path, self.file_permissions_mode)
+            # same content always gets same name, replacing a file saved meanwhile is harmless
+            os.replace(tmp_path, full_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return name
+
+    @classmethod
+    def get_content_name(cls, name, content):
+        ext = os.path.splitext(name)[1].lower()
+        digest = hashlib.sha256()
+        for chunk in content.chunks():
+            digest.update(chunk)
+        h = digest.hexdigest()
+        return os.path.join(settings.COVER_MEDIA_PATH_ROOT, h[:2], h[2:4], h + ext)
+
+
+cover_storage = CoverStorage()
@@ -1,18 +1,39 @@
 from django import template
-from easy_thumbnails.templatetags.thumbnail import thumbnail_url
+from easy_thumbnails.alias import aliases
+from common.thumbnails import get_existing_thumbnail, get_webp_name
 
 register = template.Library()
 
 @register.filter
 def thumb(source, alias):
     """
-    This filter modifies that from `easy_thumbnails` so that
-    it can neglect .svg file.
+    Url of pre-generated thumbnail, or the original image if thumbnail is not ready yet.
+    .svg files are not resized.
     """
     if source.url.endswith('.svg'):
         return source.url
     else:
         try:
-            return thumbnail_url(source, alias)
+            thumbnail = get_existing_thumbnail(source, alias)
+            return thumbnail.url if thumbnail else source.url
         except Exception as e:
             return ''
+
+
+@register.filter
+def thumb_urls(source, alias):
+    """
+    Urls of pre-generated thumbnail and its WebP variant, looked up once for <picture>.
+    'url' falls back like thumb filter, 'webp' is empty if not available.
+    """
+    if source.url.endswith('.svg'):
+        return {'url': source.url, 'webp': ''}
+    try:
+        thumbnail = get_existing_thumbnail(source, alias)
+        if thumbnail is None:
+            return {'url': source.url, 'webp': ''}
+        # thumbnails with 'webp' option are saved after their WebP copy, see generate_thumbnails
+        webp = thumbnail.storage.url(get_webp_name(thumbnail)) if aliases.get(alias).get('webp') else ''
+        return {'url': thumbnail.url, 'webp': webp}
+    except Exception as e:
+        return {'url': '', 'webp': ''}
@@ -1,3 +1,281 @@
-from django.test import TestCase
+import os
+import hashlib
+import tempfile
+from unittest import mock
+import django_rq
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.test import TestCase, override_settings
+from books.models import Book, BookTag
+from common.search.utils import load_search_result_items
+from common.search.tasks import update_index_batch, FINGERPRINTS_KEY
+from common.storage import CoverStorage
+from common import scraper, http
+from common.scraper import cache_scrape, PageNotFound, get_scraper_by_host, scraper_registry, DoubanBookScraper, DoubanGameScraper, \
+    SpotifyAlbumScraper, SpotifyTrackScraper, GoogleBooksScraper
 
-# Create your tests here.
+
+class FakeRedis:
+    """
+    Just enough of a redis connection for code keeping plain keys and hashes in it
+    """
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None, nx=False):
+        if nx and key in self.data:
+            return None
+        self.data[key] = value if isinstance(value, bytes) else str(value).encode()
+        return True
+
+    def delete(self, *keys):
+        for key in keys:
+            self.data.pop(key, None)
+
+    def hmget(self, key, fields):
+        h = self.data.get(key, {})
+        return [h.get(f) for f in fields]
+
+    def hset(self, key, mapping):
+        self.data.setdefault(key, {}).update({k: v.encode() for k, v in mapping.items()})
+
+    def hdel(self, key, *fields):
+        for f in fields:
+            self.data.get(key, {}).pop(f, None)
+
+
+def create_book(n, **kwargs):
+    return Book.objects.create(title=f'Book {n}', source_url=f'https://book.douban.com/subject/{n}/', source_site='douban', **kwargs)
+
+
+class LoadSearchResultItemsTest(TestCase):
+    def setUp(self):
+        self.book1 = create_book(1)
+        self.book2 = create_book(2)
+        BookTag.objects.create(content='fiction', book=self.book1)
+        BookTag.objects.create(content='fiction', book=self.book1)
+        BookTag.objects.create(content='classic', book=self.book1)
+
+    def test_keep_order_and_skip_missing(self):
+        refs = [('Book', self.book2.id), ('Book', 999999), ('Unknown', 1), ('Book', str(self.book1.id))]
+        items = load_search_result_items({'Book': Book}, refs)
+        self.assertEqual(items, [self.book2, self.book1])
+
+    def test_tags_prefetched(self):
+        with self.assertNumQueries(2):
+            items = load_search_result_items({'Book': Book}, [('Book', self.book1.id), ('Book', self.book2.id)])
+        with self.assertNumQueries(0):
+            self.assertEqual(items[0].tags, ['fiction', 'classic'])
+            self.assertEqual(items[0].top_tags[0], {'content': 'fiction', 'tag_frequency': 2})
+            self.assertEqual(items[1].tags, [])
+
+
+class UpdateIndexBatchTest(TestCase):
+    def setUp(self):
+        self.book = create_book(1)
+        self.redis = FakeRedis()
+        self.indexer = mock.Mock(class_map={'Book': Book})
+        self.indexer.obj_to_dict.side_effect = lambda o: {'id': o.id, 'title': o.title}
+        self.indexer.replace_batch.return_value = True
+        patchers = [mock.patch('django_rq.get_connection', return_value=self.redis),
+                    mock.patch('common.index.Indexer', self.indexer)]
+        for p in patchers:
+            p.start()
+            self.addCleanup(p.stop)
+
+    def test_skip_unchanged(self):
+        key = f'Book-{self.book.id}'
+        update_index_batch([key])
+        self.assertEqual(self.indexer.replace_batch.call_count, 1)
+        self.assertIn(key, self.redis.data[FINGERPRINTS_KEY])
+        update_index_batch([key])
+        self.assertEqual(self.indexer.replace_batch.call_count, 1)
+        Book.objects.filter(pk=self.book.pk).update(title='New title')
+        update_index_batch([key])
+        self.assertEqual(self.indexer.replace_batch.call_count, 2)
+        self.assertEqual(self.indexer.replace_batch.call_args[0][0], [{'id': self.book.id, 'title': 'New title'}])
+
+    def test_retry_failed_write(self):
+        key = f'Book-{self.book.id}'
+        self.indexer.replace_batch.return_value = False
+        update_index_batch([key])
+        self.assertNotIn(key, self.redis.data.get(FINGERPRINTS_KEY, {}))
+        self.indexer.replace_batch.return_value = True
+        update_index_batch([key])
+        self.assertEqual(self.indexer.replace_batch.call_count, 2)
+        self.assertIn(key, self.redis.data[FINGERPRINTS_KEY])
+
+    def test_delete_missing(self):
+        key = f'Book-{self.book.id}'
+        update_index_batch([key])
+        Book.objects.filter(pk=self.book.pk).delete()
+        update_index_batch([key])
+        self.indexer.delete_batch.assert_called_once_with([key])
+        self.assertNotIn(key, self.redis.data[FINGERPRINTS_KEY])
+
+
+class CoverStorageTest(TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        override = override_settings(MEDIA_ROOT=tmp.name)
+        override.enable()
+        self.addCleanup(override.disable)
+        self.storage = CoverStorage()
+
+    def test_content_name(self):
+        h = hashlib.sha256(b'cover').hexdigest()
+        name = CoverStorage.get_content_name('temp.JPG', ContentFile(b'cover'))
+        self.assertEqual(name, os.path.join(settings.COVER_MEDIA_PATH_ROOT, h[:2], h[2:4], h + '.jpg'))
+
+    def test_dedup(self):
+        name = self.storage.save('a.jpg', ContentFile(b'cover'))
+        self.assertEqual(self.storage.save('b.jpg', ContentFile(b'cover')), name)
+        self.assertNotEqual(self.storage.save('c.jpg', ContentFile(b'another cover')), name)
+        with self.storage.open(name) as f:
+            self.assertEqual(f.read(), b'cover')
+        # nothing else in the directory, e.g. temporary files
+        self.assertEqual(os.listdir(os.path.dirname(self.storage.path(name))), [os.path.basename(name)])
+
+
+class ScraperRouterTest(TestCase):
+    def setUp(self):
+        scraper._host_router = None
+        self.addCleanup(setattr, scraper, '_host_router', None)
+
+    def test_route(self):
+        self.assertEqual(get_scraper_by_host('https://book.douban.com/subject/1/'), DoubanBookScraper)
+        self.assertEqual(get_scraper_by_host('https://www.douban.com/game/1/'), DoubanGameScraper)
+        self.assertEqual(get_scraper_by_host('https://open.spotify.com/album/1'), SpotifyAlbumScraper)
+        self.assertEqual(get_scraper_by_host('https://open.spotify.com/track/1'), SpotifyTrackScraper)
+        self.assertEqual(get_scraper_by_host('https://www.google.com/books/edition/_/1'), GoogleBooksScraper)
+        self.assertIsNone(get_scraper_by_host('https://www.douban.com/people/1/'))
+        self.assertIsNone(get_scraper_by_host('https://example.org/'))
+
+    def test_longer_host_first(self):
+        with mock.patch.dict(scraper_registry, {'example.org/': 'short', 'example.org/books/': 'long'}):
+            scraper._host_router = None
+            self.assertEqual(get_scraper_by_host('https://example.org/books/1'), 'long')
+            self.assertEqual(get_scraper_by_host('https://example.org/music/1'), 'short')
+
+
+class CacheScrapeTest(TestCase):
+    def setUp(self):
+        patcher = mock.patch('django_rq.get_connection', return_value=FakeRedis())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.calls = []
+
+        def scrape(cls, url):
+            self.calls.append(url)
+            if 'missing' in url:
+                raise PageNotFound(url)
+            return f'{url} #{len(self.calls)}'
+
+        def get_effective_url(cls, url):
+            if 'invalid' in url:
+                raise ValueError(url)
+            return url.rstrip('/')
+
+        self.scraper = type('Scraper', (), {
+            'get_effective_url': classmethod(get_effective_url),
+            'scrape': classmethod(cache_scrape(scrape)),
+        })
+
+    def test_cached_by_effective_url(self):
+        self.assertEqual(self.scraper.scrape('https://example.org/1/'), 'https://example.org/1/ #1')
+        self.assertEqual(self.scraper.scrape('https://example.org/1'), 'https://example.org/1/ #1')
+        self.assertEqual(len(self.calls), 1)
+
+    def test_refresh(self):
+        self.scraper.scrape('https://example.org/1')
+        self.assertEqual(self.scraper.scrape('https://example.org/1', refresh=True), 'https://example.org/1 #2')
+        # refreshed result replaces the cached one
+        self.assertEqual(self.scraper.scrape('https://example.org/1'), 'https://example.org/1 #2')
+        self.assertEqual(len(self.calls), 2)
+
+    def test_not_found(self):
+        for i in range(2):
+            with self.assertRaises(PageNotFound):
+                self.scraper.scrape('https://example.org/missing')
+        self.assertEqual(len(self.calls), 1)
+        with self.assertRaises(PageNotFound):
+            self.scraper.scrape('https://example.org/missing', refresh=True)
+        self.assertEqual(len(self.calls), 2)
+
+    @override_settings(SCRAPE_CACHE_NEGATIVE_TTL=0)
+    def test_not_found_not_cached(self):
+        for i in range(2):
+            with self.assertRaises(PageNotFound):
+                self.scraper.scrape('https://example.org/missing')
+        self.assertEqual(len(self.calls), 2)
+
+    def test_invalid_url_not_cached(self):
+        self.scraper.scrape('https://example.org/invalid')
+        self.scraper.scrape('https://example.org/invalid')
+        self.assertEqual(len(self.calls), 2)
+
+
+class AcquireTest(TestCase):
+    host = 'acquire-test.example.org'
+
+    def setUp(self):
+        self.conn = django_rq.get_connection('default')
+        self.keys = [prefix + self.host for prefix in [http.BUCKET_KEY_PREFIX, http.RATE_FACTOR_KEY_PREFIX, http.FAILURES_KEY_PREFIX, http.BREAKER_KEY_PREFIX]]
+        self.conn.delete(*self.keys)
+        self.addCleanup(self.conn.delete, *self.keys)
+
+    def tokens(self):
+        return float(self.conn.hget(http.BUCKET_KEY_PREFIX + self.host, 'tokens'))
+
+    def test_closed(self):
+        http.acquire(self.host, 10)
+        self.assertEqual(self.tokens(), settings.HTTP_BURST - 1)
+
+    def test_open_after_failures(self):
+        http.acquire(self.host, 10)
+        for i in range(settings.HTTP_BREAKER_THRESHOLD - 1):
+            http.report_failure(self.host)
+        http.acquire(self.host, 10)
+        http.report_failure(self.host)
+        tokens = self.tokens()
+        with self.assertRaises(http.HostUnavailable):
+            http.acquire(self.host, 10)
+        # no token is taken while open
+        self.assertEqual(self.tokens(), tokens)
+
+    def test_success_resets_failures(self):
+        for i in range(settings.HTTP_BREAKER_THRESHOLD - 1):
+            http.report_failure(self.host)
+        http.report_success(self.host)
+        http.report_failure(self.host)
+        http.acquire(self.host, 10)
+
+    def test_open_when_throttled_at_lowest_rate(self):
+        factor = 1
+        while factor > http.MIN_RATE_FACTOR:
+            http.report_failure(self.host, throttled=True)
+            factor /= 2
+            self.assertEqual(float(self.conn.get(http.RATE_FACTOR_KEY_PREFIX + self.host)), factor)
+            http.acquire(self.host, 10)
+        http.report_failure(self.host, throttled=True)
+        with self.assertRaises(http.HostUnavailable):
+            http.acquire(self.host, 10)
+
+    def test_reserve_token_while_waiting(self):
+        with override_settings(HTTP_BURST=1, HTTP_RATE_LIMITS={self.host: 20}):
+            http.acquire(self.host, 10)
+            http.acquire(self.host, 10)
+            # second caller took the token before it was refilled
+            self.assertLess(self.tokens(), 0)
+
+    def test_not_reserved_beyond_max_wait(self):
+        with override_settings(HTTP_BURST=1, HTTP_RATE_LIMITS={self.host: 0.01}, HTTP_RATE_MAX_WAIT=1):
+            http.acquire(self.host, 10)
+            tokens = self.tokens()
+            with self.assertRaises(http.HostUnavailable):
+                http.acquire(self.host, 10)
+            self.assertEqual(self.tokens(), tokens)
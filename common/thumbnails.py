@@ -0,0 +1,90 @@
+"""
+Thumbnails of covers are generated in background when covers are saved,
+pages only look up existing thumbnails and never resize images themselves.
+"""
+import logging
+from io import BytesIO
+import django_rq
+from PIL import Image
+from django.apps import apps
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_save
+from easy_thumbnails.alias import aliases
+from easy_thumbnails.files import get_thumbnailer
+from django.core.files.base import ContentFile
+
+
+THUMBNAIL_QUEUE = 'thumbnail'
+PENDING_KEY_PREFIX = 'thumbnail:pending:'
+PENDING_TTL = 600
+
+
+logger = logging.getLogger(__name__)
+
+
+def get_existing_thumbnail(source, alias):
+    """
+    return thumbnail of given alias if generated, otherwise queue generation and return None
+    """
+    thumbnail = get_thumbnailer(source).get_existing_thumbnail(aliases.get(alias))
+    if thumbnail is None:
+        enqueue_thumbnails(source.instance, source.field.name)
+    return thumbnail
+
+
+def get_webp_name(thumbnail):
+    return thumbnail.name + '.webp'
+
+
+def enqueue_thumbnails(instance, field_name):
+    source = getattr(instance, field_name)
+    if not source or source.name.endswith('.svg'):
+        return
+    try:
+        # a source is queued once, no matter how many pages are waiting for it
+        if django_rq.get_connection(THUMBNAIL_QUEUE).set(PENDING_KEY_PREFIX + source.name, 1, nx=True, ex=PENDING_TTL):
+            django_rq.get_queue(THUMBNAIL_QUEUE).enqueue(generate_thumbnails, instance._meta.label, instance.pk, field_name)
+    except Exception as e:
+        logger.error(f"queue thumbnails error: {source.name}\n{e}")
+
+
+def generate_thumbnails(model_label, pk, field_name):
+    """
+    Generate thumbnails of all aliases and their WebP variants
+    """
+    instance = apps.get_model(model_label).objects.filter(pk=pk).first()
+    if instance is None:
+        return
+    source = getattr(instance, field_name)
+    try:
+        thumbnailer = get_thumbnailer(source)
+        for alias, options in aliases.all(source).items():
+            if thumbnailer.get_existing_thumbnail(options) is not None:
+                continue
+            thumbnail = thumbnailer.generate_thumbnail(options)
+            if options.get('webp'):
+                # WebP copy is saved first, an existing thumbnail with 'webp' option always has one
+                img = Image.open(thumbnail)
+                buffer = BytesIO()
+                img.save(buffer, 'WEBP', quality=settings.THUMBNAIL_WEBP_QUALITY)
+                if thumbnail.storage.exists(get_webp_name(thumbnail)):
+                    # left by an interrupted job, otherwise storage saves under another name
+                    thumbnail.storage.delete(get_webp_name(thumbnail))
+                thumbnail.storage.save(get_webp_name(thumbnail), ContentFile(buffer.getvalue()))
+                thumbnail.seek(0)
+            thumbnailer.save_thumbnail(thumbnail)
+    except Exception as e:
+        logger.error(f"generate thumbnails error: {source.name}\n{e}")
+    finally:
+        django_rq.get_connection(THUMBNAIL_QUEUE).delete(PENDING_KEY_PREFIX + source.name)
+
+
+def cover_post_save_handler(sender, instance, created, update_fields=None, **kwargs):
+    if update_fields and 'cover' not in update_fields:
+        return
+    transaction.on_commit(lambda: enqueue_thumbnails(instance, 'cover'))
+
+
+def init_thumbnail_handler(model):
+    post_save.connect(cover_post_save_handler, sender=model)
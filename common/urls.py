@@ -8,4 +8,5 @@ urlpatterns = [
     path('search/', search, name='search'),
     path('search.json/', search, name='search.json'),
     path('external_search/', external_search, name='external_search'),
+    path('scrape_status/', scrape_status, name='scrape_status'),
 ]
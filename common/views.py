@@ -1,3 +1,4 @@
+import heapq
 import operator
 import logging
 from difflib import SequenceMatcher
@@ -8,8 +9,8 @@ from django.utils.translation import gettext_lazy as _
 from django.core.paginator import Paginator
 from django.core.validators import URLValidator
 from django.core.exceptions import ValidationError, ObjectDoesNotExist
-from django.db.models import Q, Count
-from django.http import HttpResponseBadRequest
+from django.db.models import Q, F, Count, Case, When, Value, IntegerField
+from django.http import HttpResponse, HttpResponseBadRequest
 from books.models import Book
 from movies.models import Movie
 from games.models import Game
@@ -18,9 +19,9 @@ from users.models import Report, User, Preference
 from mastodon.decorators import mastodon_request_included
 from users.views import home as user_home
 from timeline.views import timeline as user_timeline
-from common.models import MarkStatusEnum
+from common.models import MarkStatusEnum, Entity
 from common.utils import PageLinksGenerator
-from common.scraper import get_scraper_by_url, get_normalized_url
+from common.scraper import get_scraper_by_url, get_normalized_url, get_or_scrape, enqueue_scrape, get_scrape_status
 from common.config import *
 from common.searcher import ExternalSources
 from management.models import Announcement
@@ -157,6 +158,23 @@ def search2(request):
                 }
             )
 
+        def coarse_relevance(fields):
+            # computed in db, used to pick candidates before ranking them in python
+            whens = []
+            for keyword in keywords:
+                whens.append(When(title__iexact=keyword, then=Value(3)))
+                whens.append(When(title__istartswith=keyword, then=Value(2)))
+                for field in fields:
+                    whens.append(When(**{field + '__icontains': keyword}, then=Value(1)))
+            return Case(*whens, default=Value(0), output_field=IntegerField())
+
+        def candidates(queryset, fields):
+            if keywords:
+                queryset = queryset.annotate(relevance=coarse_relevance(fields))
+                return queryset.order_by('-relevance', F('rating_number').desc(nulls_last=True))
+            else:
+                return queryset.order_by(F('rating_number').desc(nulls_last=True))
+
         def book_param_handler(**kwargs):
             # keywords
             keywords = kwargs.get('keywords')
@@ -181,9 +199,9 @@ def search2(request):
                     # search by keywords
                     similarity, n = 0, 0
                     for keyword in keywords:
-                        similarity += 1/2 * SequenceMatcher(None, keyword, book.title).quick_ratio() 
-                        + 1/3 * SequenceMatcher(None, keyword, book.orig_title).quick_ratio()
-                        + 1/6 * SequenceMatcher(None, keyword, book.subtitle).quick_ratio()
+                        similarity += 1/2 * SequenceMatcher(None, keyword, book.title).quick_ratio() \
+                            + 1/3 * SequenceMatcher(None, keyword, book.orig_title).quick_ratio() \
+                            + 1/6 * SequenceMatcher(None, keyword, book.subtitle).quick_ratio()
                         n += 1
                     book.similarity = similarity / n
 
@@ -193,11 +211,7 @@ def search2(request):
                 else:
                     book.similarity = 0
                 return book.similarity
-            if len(queryset) > 0:
-                ordered_queryset = sorted(queryset, key=calculate_similarity, reverse=True)
-            else:
-                ordered_queryset = list(queryset)
-            return ordered_queryset
+            return [(candidates(queryset, ['subtitle', 'orig_title']), calculate_similarity)]
 
         def movie_param_handler(**kwargs):
             # keywords
@@ -221,11 +235,12 @@ def search2(request):
             def calculate_similarity(movie):
                 if keywords:
                     # search by name
+                    other_title_dump = ' '.join(movie.other_title)
                     similarity, n = 0, 0
                     for keyword in keywords:
-                        similarity += 1/2 * SequenceMatcher(None, keyword, movie.title).quick_ratio()
-                        + 1/4 * SequenceMatcher(None, keyword, movie.orig_title).quick_ratio()
-                        + 1/4 * SequenceMatcher(None, keyword, movie.other_title).quick_ratio()
+                        similarity += 1/2 * SequenceMatcher(None, keyword, movie.title).quick_ratio() \
+                            + 1/4 * SequenceMatcher(None, keyword, movie.orig_title).quick_ratio() \
+                            + 1/4 * SequenceMatcher(None, keyword, other_title_dump).quick_ratio()
                         n += 1
                     movie.similarity = similarity / n
                 elif tag:
@@ -234,11 +249,7 @@ def search2(request):
                 else:
                     movie.similarity = 0
                 return movie.similarity
-            if len(queryset) > 0:
-                ordered_queryset = sorted(queryset, key=calculate_similarity, reverse=True)
-            else:
-                ordered_queryset = list(queryset)
-            return ordered_queryset
+            return [(candidates(queryset, ['orig_title']), calculate_similarity)]
 
         def game_param_handler(**kwargs):
             # keywords
@@ -263,14 +274,15 @@ def search2(request):
             def calculate_similarity(game):
                 if keywords:
                     # search by name
+                    other_title_dump = ' '.join(game.other_title)
                     developer_dump = ' '.join(game.developer)
                     publisher_dump = ' '.join(game.publisher)
                     similarity, n = 0, 0
                     for keyword in keywords:
-                        similarity += 1/2 * SequenceMatcher(None, keyword, game.title).quick_ratio()
-                        + 1/4 * SequenceMatcher(None, keyword, game.other_title).quick_ratio()
-                        + 1/16 * SequenceMatcher(None, keyword, developer_dump).quick_ratio()
-                        + 1/16 * SequenceMatcher(None, keyword, publisher_dump).quick_ratio()
+                        similarity += 1/2 * SequenceMatcher(None, keyword, game.title).quick_ratio() \
+                            + 1/4 * SequenceMatcher(None, keyword, other_title_dump).quick_ratio() \
+                            + 1/16 * SequenceMatcher(None, keyword, developer_dump).quick_ratio() \
+                            + 1/16 * SequenceMatcher(None, keyword, publisher_dump).quick_ratio()
                         n += 1
                     game.similarity = similarity / n
                 elif tag:
@@ -279,11 +291,7 @@ def search2(request):
                 else:
                     game.similarity = 0
                 return game.similarity
-            if len(queryset) > 0:
-                ordered_queryset = sorted(queryset, key=calculate_similarity, reverse=True)
-            else:
-                ordered_queryset = list(queryset)
-            return ordered_queryset
+            return [(candidates(queryset, []), calculate_similarity)]
 
         def music_param_handler(**kwargs):
             # keywords
@@ -314,8 +322,7 @@ def search2(request):
                 q = q & Q(song_tags__content__iexact=tag)
             query_args.clear()
             query_args.append(q)
-            song_queryset = Song.objects.filter(*query_args).distinct()
-            queryset = list(album_queryset) + list(song_queryset)
+            song_queryset = Song.objects.filter(*query_args).select_related('album').distinct()
 
             def calculate_similarity(music):
                 if keywords:
@@ -338,23 +345,12 @@ def search2(request):
                 else:
                     music.similarity = 0
                 return music.similarity
-            if len(queryset) > 0:
-                ordered_queryset = sorted(queryset, key=calculate_similarity, reverse=True)
-            else:
-                ordered_queryset = list(queryset)
-            return ordered_queryset
+            return [(candidates(album_queryset, []), calculate_similarity),
+                    (candidates(song_queryset, ['album__title']), calculate_similarity)]
 
         def all_param_handler(**kwargs):
-            book_queryset = book_param_handler(**kwargs)
-            movie_queryset = movie_param_handler(**kwargs)
-            music_queryset = music_param_handler(**kwargs)
-            game_queryset = game_param_handler(**kwargs)
-            ordered_queryset = sorted(
-                book_queryset + movie_queryset + music_queryset + game_queryset, 
-                key=operator.attrgetter('similarity'), 
-                reverse=True
-            )
-            return ordered_queryset
+            return book_param_handler(**kwargs) + movie_param_handler(**kwargs) \
+                + music_param_handler(**kwargs) + game_param_handler(**kwargs)
 
         param_handler = {
             'book': book_param_handler,
@@ -368,28 +364,40 @@ def search2(request):
         categories = [k for k in param_handler.keys() if not k in ['all', '']]
 
         try:
-            queryset = param_handler[category](
+            sources = param_handler[category](
                 keywords=keywords,
                 tag=tag
             )
         except KeyError as e:
-            queryset = param_handler['all'](
+            sources = param_handler['all'](
                 keywords=keywords,
                 tag=tag
             )
-        paginator = Paginator(queryset, ITEMS_PER_PAGE)
-        page_number = request.GET.get('page', default=1)
-        items = paginator.get_page(page_number)
-        items.pagination = PageLinksGenerator(PAGE_LINK_NUMBER, page_number, paginator.num_pages)
+        # only the best SEARCH2_MAX_CANDIDATES matches by db relevance in each source are ranked,
+        # the same pool for every page so that pages neither overlap nor skip items
+        # for broad queries the page count is therefore a lower bound, the template marks it with an ellipsis
+        counts = [queryset[:SEARCH2_MAX_CANDIDATES + 1].count() for queryset, _ in sources]
+        pages_capped = any(count > SEARCH2_MAX_CANDIDATES for count in counts)
+        total = sum(min(count, SEARCH2_MAX_CANDIDATES) for count in counts)
+        num_pages = max((total + ITEMS_PER_PAGE - 1) // ITEMS_PER_PAGE, 1)
+        p = request.GET.get('page', default='1')
+        page_number = min(int(p), num_pages) if p.isdigit() and int(p) > 0 else 1
+        top_k = page_number * ITEMS_PER_PAGE
+        ranked = []
+        for queryset, calculate_similarity in sources:
+            ranked += heapq.nlargest(top_k, queryset[:SEARCH2_MAX_CANDIDATES], key=calculate_similarity)
+        items = heapq.nlargest(top_k, ranked, key=operator.attrgetter('similarity'))[top_k - ITEMS_PER_PAGE:]
+        Entity.prefetch_tag_lists(items)
         for item in items:
-            item.tag_list = item.get_tags_manager().values('content').annotate(
-                tag_frequency=Count('content')).order_by('-tag_frequency')[:TAG_NUMBER_ON_LIST]
+            item.tag_list = item.all_tag_list[:TAG_NUMBER_ON_LIST]
 
         return render(
             request,
             "common/search_result.html",
             {
                 "items": items,
+                "pagination": PageLinksGenerator(PAGE_LINK_NUMBER, page_number, num_pages),
+                "pages_capped": pages_capped,
                 "categories": categories,
             }
         )
@@ -403,7 +411,8 @@ def search2(request):
 def jump_or_scrape(request, url):
     """
     1. match url to registered scrapers
-    2. try to find the url in the db, if exits then jump, else scrape and jump
+    2. try to find the url in the db, if exits then jump, else scrape in background
+       and show a page polling `scrape_status` which jumps when scraped
     """
 
     # redirect to this site
@@ -432,10 +441,16 @@ def jump_or_scrape(request, url):
                     })
             return redirect(entity)
         except ObjectDoesNotExist:
+            if not request.path.endswith('.json/'):
+                try:
+                    enqueue_scrape(url, effective_url, request.user)
+                    return render(request, 'common/scraping.html', {'url': effective_url})
+                except Exception as e:
+                    # scrape right here if unable to queue
+                    logger.error(f"unable to queue scraping {url}: {e}")
             # scrape if not exists
             try:
-                scraper.scrape(url)
-                form = scraper.save(request_user=request.user)
+                entity = get_or_scrape(scraper, url, request.user)
             except IntegrityError as ie:  # duplicate key on source_url may be caused by user's double submission
                 try:
                     entity = scraper.data_class.objects.get(source_url=effective_url)
@@ -450,7 +465,39 @@ def jump_or_scrape(request, url):
                 if settings.DEBUG:
                     logger.error("Expections during saving scraped data:", exc_info=e)
                 return render(request, 'common/error.html', {'msg': _("爬取数据失败😫")})
-            return redirect(form.instance)
+            return redirect(entity)
+
+
+@login_required
+def scrape_status(request):
+    """
+    Polled by the page of a scraping url, jump to the entity once it is saved
+    """
+    url = request.GET.get('url', '')
+    p = request.GET.get('polls', default='0')
+    polls = int(p) if p.isdigit() else 0
+    scraper = get_scraper_by_url(url)
+    if scraper is None:
+        return HttpResponseBadRequest()
+    entity = scraper.data_class.objects.filter(source_url=url).first()
+    failed = False
+    if entity is None:
+        try:
+            failed, pk = get_scrape_status(url)
+            # saved entity may have a source url other than the polled one
+            if pk is not None:
+                entity = scraper.data_class.objects.filter(pk=pk).first()
+                failed = entity is None
+        except Exception as e:
+            logger.error(f"unable to check scraping {url}: {e}")
+            failed = True
+    if entity is not None:
+        response = HttpResponse()
+        response['HX-Redirect'] = entity.get_absolute_url()
+        return response
+    if polls >= SCRAPE_STATUS_MAX_POLLS:
+        failed = True
+    return render(request, 'common/scraping_status.html', {'url': url, 'failed': failed, 'polls': polls + 1})
 
 
 def go_relogin(request):
@@ -31,6 +31,6 @@ if [ "$PROCESS_TYPE" = "server" ]; then
             boofilsic.wsgi
     fi  
 elif [ "$PROCESS_TYPE" = "rq" ]; then
-    rqworker --with-scheduler doufen export mastodon
+    rqworker --with-scheduler doufen export mastodon index thumbnail scrape
 fi
 
@@ -6,5 +6,7 @@ class GamesConfig(AppConfig):
 
     def ready(self):
         from common.index import Indexer
+        from common.thumbnails import init_thumbnail_handler
         from .models import Game
         Indexer.update_model_indexable(Game)
+        init_thumbnail_handler(Game)
@@ -6,6 +6,7 @@ from django.core.serializers.json import DjangoJSONEncoder
 from django.shortcuts import reverse
 from common.models import Entity, Mark, Review, Tag, MarkStatusEnum
 from common.utils import ChoicesDictGenerator, GenerateDateUUIDMediaFilePath
+from common.storage import cover_storage
 from django.utils import timezone
 from django.conf import settings
 from simple_history.models import HistoricalRecords
@@ -76,7 +77,7 @@ class Game(Entity):
         verbose_name=_("平台")
     )
 
-    cover = models.ImageField(_("封面"), upload_to=game_cover_path, default=settings.DEFAULT_GAME_IMAGE, blank=True)
+    cover = models.ImageField(_("封面"), upload_to=game_cover_path, storage=cover_storage, default=settings.DEFAULT_GAME_IMAGE, blank=True)
 
     history = HistoricalRecords()
 
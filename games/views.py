@@ -96,8 +96,8 @@ def rescrape(request, id):
     item = get_object_or_404(Game, pk=id)
     url = get_normalized_url(item.source_url)
     scraper = get_scraper_by_url(url)
-    scraper.scrape(url)
-    form = scraper.save(request_user=request.user, instance=item)
+    result = scraper.scrape(url, refresh=True)
+    form = scraper.save(request.user, result, instance=item)
     return redirect(reverse("games:retrieve", args=[form.instance.id]))
 
 
@@ -6,5 +6,7 @@ class MoviesConfig(AppConfig):
 
     def ready(self):
         from common.index import Indexer
+        from common.thumbnails import init_thumbnail_handler
         from .models import Movie
         Indexer.update_model_indexable(Movie)
+        init_thumbnail_handler(Movie)
@@ -6,6 +6,7 @@ from django.core.serializers.json import DjangoJSONEncoder
 from django.shortcuts import reverse
 from common.models import Entity, Mark, Review, Tag, MarkStatusEnum
 from common.utils import ChoicesDictGenerator, GenerateDateUUIDMediaFilePath
+from common.storage import cover_storage
 from django.utils import timezone
 from django.conf import settings
 from django.db.models import Q
@@ -154,7 +155,7 @@ class Movie(Entity):
     year = models.PositiveIntegerField(null=True, blank=True)
     duration = models.CharField(blank=True, default='', max_length=200)
 
-    cover = models.ImageField(_("poster"), upload_to=movie_cover_path, default=settings.DEFAULT_MOVIE_IMAGE, blank=True)
+    cover = models.ImageField(_("poster"), upload_to=movie_cover_path, storage=cover_storage, default=settings.DEFAULT_MOVIE_IMAGE, blank=True)
 
     ############################################
     # exclusive fields to series
@@ -6,6 +6,9 @@ class MusicConfig(AppConfig):
 
     def ready(self):
         from common.index import Indexer
+        from common.thumbnails import init_thumbnail_handler
         from .models import Album, Song
         Indexer.update_model_indexable(Album)
         Indexer.update_model_indexable(Song)
+        init_thumbnail_handler(Album)
+        init_thumbnail_handler(Song)
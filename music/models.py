@@ -6,6 +6,7 @@ from django.core.serializers.json import DjangoJSONEncoder
 from django.shortcuts import reverse
 from common.models import Entity, Mark, Review, Tag, SourceSiteEnum, MarkStatusEnum
 from common.utils import ChoicesDictGenerator, GenerateDateUUIDMediaFilePath
+from common.storage import cover_storage
 from django.utils import timezone
 from django.conf import settings
 from simple_history.models import HistoricalRecords
@@ -31,7 +32,7 @@ class Album(Entity):
     release_date = models.DateField(
         _('发行日期'), auto_now=False, auto_now_add=False, null=True, blank=True)
     cover = models.ImageField(
-        _("封面"), upload_to=album_cover_path, default=settings.DEFAULT_ALBUM_IMAGE, blank=True)
+        _("封面"), upload_to=album_cover_path, storage=cover_storage, default=settings.DEFAULT_ALBUM_IMAGE, blank=True)
     duration = models.PositiveIntegerField(_("时长"), null=True, blank=True)
     artist = postgres.ArrayField(
         models.CharField(_("artist"), blank=True,
@@ -114,7 +115,7 @@ class Song(Entity):
     # duration in ms
     duration = models.PositiveIntegerField(_("时长"), null=True, blank=True)
     cover = models.ImageField(
-        _("封面"), upload_to=song_cover_path, default=settings.DEFAULT_SONG_IMAGE, blank=True)
+        _("封面"), upload_to=song_cover_path, storage=cover_storage, default=settings.DEFAULT_SONG_IMAGE, blank=True)
     artist = postgres.ArrayField(
         models.CharField(blank=True,
                          default='', max_length=100),
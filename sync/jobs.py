@@ -1,8 +1,13 @@
 import logging
+import itertools
+import time
 import pytz
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from datetime import datetime
 from django.conf import settings
+from django.db import transaction
 from django.utils import timezone
 from django.core.exceptions import ObjectDoesNotExist
 from openpyxl import load_workbook
@@ -10,8 +15,11 @@ from books.models import BookMark, Book, BookTag
 from movies.models import MovieMark, Movie, MovieTag
 from music.models import AlbumMark, Album, AlbumTag
 from games.models import GameMark, Game, GameTag
-from common.scraper import DoubanAlbumScraper, DoubanBookScraper, DoubanGameScraper, DoubanMovieScraper
-from common.models import MarkStatusEnum
+from common.scraper import DoubanAlbumScraper, DoubanBookScraper, DoubanGameScraper, DoubanMovieScraper, scrape_item, get_or_scrape
+from common.models import MarkStatusEnum, LOOKUP_BATCH_SIZE
+from common import http
+from common.search.tasks import update_index_of
+from timeline.models import Activity
 from .models import SyncTask
 
 
@@ -44,9 +52,9 @@ class DoufenParser:
             self.__is_new_task = False
         if self.__progress_row is None:
             self.__progress_row = 2
-        # data in the excel parse in python types
         self.task = task
-        self.items = []
+        self.__fp = None
+        self.__wb = None
 
     def __open_file(self):
         self.__fp = open(self.__file_path, 'rb')
@@ -60,7 +68,10 @@ class DoufenParser:
     def __close_file(self):
         if self.__wb is not None:
             self.__wb.close()
-        self.__fp.close()
+            self.__wb = None
+        if self.__fp is not None:
+            self.__fp.close()
+            self.__fp = None
 
     def __get_item_classes_mapping(self):
         '''
@@ -96,11 +107,10 @@ class DoufenParser:
 
     def __parse_items(self):
         assert self.__wb is not None, 'workbook not found'
-
-        item_classes_mappings = self.__get_item_classes_mapping()
+        assert self.__mappings is not None, 'mappings not found'
 
         is_first_sheet = True
-        for mapping in item_classes_mappings:
+        for mapping in self.__mappings:
             if mapping['sheet'] not in self.__wb:
                 print(f"Sheet not found: {mapping['sheet']}")
                 continue
@@ -137,7 +147,7 @@ class DoufenParser:
                     content = ""
                 rating = cells[self.RATING_INDEX - 1]
                 rating = int(rating) * 2 if rating else None
-                self.items.append({
+                yield {
                     'data': DoufenRowData(url, tags, time, content, rating),
                     'entity_class': mapping['entity_class'],
                     'mark_class': mapping['mark_class'],
@@ -145,7 +155,7 @@ class DoufenParser:
                     'scraper': mapping['scraper'],
                     'sheet': mapping['sheet'],
                     'row_index': i,
-                })
+                }
                 i = i + 1
 
             # set first sheet flag
@@ -169,19 +179,22 @@ class DoufenParser:
         self.task.save(update_fields=["total_items"])
 
     def parse(self):
+        """
+        Generator of rows starting from the breakpoint, rows are read from the
+        workbook only when asked for, and the file is closed when all rows are
+        read or the generator is closed.
+        """
         try:
             self.__open_file()
-            self.__parse_items()
+            self.__get_item_classes_mapping()
             if self.__is_new_task:
                 self.__update_total_items()
-            self.__close_file()
-            return self.items
+            yield from self.__parse_items()
         except Exception as e:
             logger.error(f'Error parsing {self.__file_path} {e}')
             self.task.is_failed = True
         finally:
             self.__close_file()
-        return []
 
 
 @dataclass
@@ -193,62 +206,157 @@ class DoufenRowData:
     rating: int
 
 
-def add_new_mark(data, user, entity, entity_class, mark_class, tag_class, sheet, default_public):
-    params = {
-        'owner': user,
-        'created_time': data.time,
-        'edited_time': data.time,
-        'rating': data.rating,
-        'text': data.content,
-        'status': translate_status(sheet),
-        'visibility': 0 if default_public else 1,
-        entity_class.__name__.lower(): entity,
-    }
-    mark = mark_class.objects.create(**params)
-    entity.update_rating(None, data.rating)
-    if data.tags:
-        for tag in data.tags:
-            params = {
-                'content': tag,
-                entity_class.__name__.lower(): entity,
-                'mark': mark
-            }
-            try:
-                tag_class.objects.create(**params)
-            except Exception as e:
-                logger.error(f'Error creating tag {tag} {mark}: {e}')
-
-
-def overwrite_mark(entity, entity_class, mark, mark_class, tag_class, data, sheet):
-    old_rating = mark.rating
-    old_tags = getattr(mark, mark_class.__name__.lower() + '_tags').all()
-    # update mark logic
-    mark.created_time = data.time
-    mark.edited_time = data.time
-    mark.text = data.content
-    mark.rating = data.rating
-    mark.status = translate_status(sheet)
-    mark.save()
-    entity.update_rating(old_rating, data.rating)
-    if old_tags:
-        for tag in old_tags:
-            tag.delete()
-    if data.tags:
-        for tag in data.tags:
-            params = {
-                'content': tag,
-                entity_class.__name__.lower(): entity,
-                'mark': mark
-            }
-            try:
-                tag_class.objects.create(**params)
-            except Exception as e:
-                logger.error(f'Error creating tag {tag} {mark}: {e}')
+class MarkBatch:
+    """
+    Marks and tags of a chunk of rows, written to db together by `flush()`.
+    Ratings of affected entities are recalculated once per flush, timeline
+    activities and search index are updated in bulk as signals are not sent.
+    Those are all the skipped signals do for marks and tags, which have no
+    edit history; entities are saved as usual so their own signals are sent.
+    """
+
+    def __init__(self, user, default_public):
+        self.user = user
+        self.default_public = default_public
+        self.flushed_time = time.time()
+        self.reset()
+
+    def reset(self):
+        # new marks and existing marks to update, in order added
+        self.created = []
+        self.updated = []
+        # id(mark): (mark, entity, tag_class, tags)
+        self.tags = {}
+        self.urls = []
+
+    def __len__(self):
+        return len(self.urls)
+
+    def is_due(self):
+        return len(self) >= settings.SYNC_PROGRESS_FLUSH_ITEMS \
+            or time.time() - self.flushed_time >= settings.SYNC_PROGRESS_FLUSH_INTERVAL
+
+    def add_new_mark(self, data, entity, entity_class, mark_class, tag_class, sheet):
+        params = {
+            'owner': self.user,
+            'created_time': data.time,
+            'edited_time': data.time,
+            'rating': data.rating,
+            'text': data.content,
+            'status': translate_status(sheet),
+            'visibility': 0 if self.default_public else 1,
+            entity_class.__name__.lower(): entity,
+        }
+        mark = mark_class(**params)
+        self.created.append(mark)
+        self.tags[id(mark)] = (mark, entity, tag_class, data.tags)
+        self.urls.append(data.url)
+        return mark
+
+    def overwrite_mark(self, data, entity, mark, tag_class, sheet):
+        mark.created_time = data.time
+        mark.edited_time = data.time
+        mark.text = data.content
+        mark.rating = data.rating
+        mark.status = translate_status(sheet)
+        # mark may be added to this batch already, by a previous row with same url
+        if id(mark) not in self.tags:
+            self.updated.append(mark)
+        self.tags[id(mark)] = (mark, entity, tag_class, data.tags)
+        self.urls.append(data.url)
+
+    def flush(self):
+        """
+        return urls of rows failed to write
+        """
+        if not len(self):
+            self.flushed_time = time.time()
+            return []
+        failed = []
+        try:
+            with transaction.atomic():
+                self._write()
+        except Exception as e:
+            logger.error(f'Error writing {len(self)} marks of {self.user}', exc_info=e)
+            failed = self.urls
+            # bulk_create has set pks before the rollback, marks not in db must look unsaved
+            for mark in self.created:
+                mark.pk = None
+                mark._state.adding = True
+        else:
+            entities = {(entity.__class__, entity.id): entity for _, entity, _, _ in self.tags.values()}
+            for entity in entities.values():
+                entity.refresh_rating()
+            # documents are rewritten in full, unchanged ones are skipped by their fingerprints
+            update_index_of(list(entities.values()))
+        self.reset()
+        self.flushed_time = time.time()
+        return failed
+
+    def _write(self):
+        for mark_class, marks in group_by_class(self.created).items():
+            mark_class.objects.bulk_create(marks)
+        for mark_class, marks in group_by_class(self.updated).items():
+            mark_class.objects.bulk_update(marks, ['created_time', 'edited_time', 'text', 'rating', 'status'])
+            tag_class = self.tags[id(marks[0])][2]
+            tag_class.objects.filter(mark__in=marks).delete()
+        tags = {}
+        for mark, entity, tag_class, contents in self.tags.values():
+            for content in contents or []:
+                params = {
+                    'content': content,
+                    entity.__class__.__name__.lower(): entity,
+                    'mark': mark
+                }
+                tags.setdefault(tag_class, []).append(tag_class(**params))
+        for tag_class, objs in tags.items():
+            tag_class.objects.bulk_create(objs, ignore_conflicts=True)
+        # timeline, same as what Activity.upsert_item does for each mark
+        activities = []
+        for mark_class, marks in group_by_class(self.created).items():
+            attr = mark_class.__name__.lower()
+            for mark in marks:
+                activities.append(Activity(owner=mark.owner, created_time=mark.created_time, visibility=mark.visibility, **{attr: mark}))
+        for mark_class, marks in group_by_class(self.updated).items():
+            attr = mark_class.__name__.lower()
+            existing = {getattr(a, attr + '_id'): a for a in Activity.objects.filter(**{attr + '__in': marks})}
+            for mark in marks:
+                activity = existing.get(mark.id)
+                if activity:
+                    activity.created_time = mark.created_time
+                    activity.visibility = mark.visibility
+                else:
+                    activities.append(Activity(owner=mark.owner, created_time=mark.created_time, visibility=mark.visibility, **{attr: mark}))
+            Activity.objects.bulk_update(list(existing.values()), ['created_time', 'visibility'])
+        Activity.objects.bulk_create(activities)
+
+
+def group_by_class(objs):
+    groups = {}
+    for obj in objs:
+        groups.setdefault(obj.__class__, []).append(obj)
+    return groups
+
+
+def resolve_items(items, user, entities, marks):
+    """
+    Look up entities of rows and user's marks of them with a few queries per class,
+    results are added to `entities` and `marks`
+    """
+    urls = {}
+    for item in items:
+        urls.setdefault((item['entity_class'], item['mark_class']), []).append(item['data'].url)
+    for (entity_class, mark_class), class_urls in urls.items():
+        known = entities.setdefault(entity_class, {})
+        found = entity_class.lookup_by_source_urls([url for url in class_urls if url not in known])
+        known.update(found)
+        marks.setdefault(mark_class, {}).update(mark_class.lookup_by_owner(user, list(found.values())))
 
 
 def sync_doufen_job(task, stop_check_func):
     """
-    TODO: Update task status every certain amount of items to reduce IO consumption
+    Items missing from db are scraped ahead in a thread pool, while rows are
+    written to db one by one in order, so the breakpoint is still the last row synced.
     """
     task = SyncTask.objects.get(pk=task.pk)
     if task.is_finished:
@@ -256,81 +364,135 @@ def sync_doufen_job(task, stop_check_func):
 
     print(f'Task {task.pk}: loading')
     parser = DoufenParser(task)
-    items = parser.parse()
-
-    # use pop to reduce memo consumption
-    while len(items) > 0 and not stop_check_func():
-        item = items.pop(0)
-        data = item['data']
-        entity_class = item['entity_class']
-        mark_class = item['mark_class']
-        tag_class = item['tag_class']
-        scraper = item['scraper']
-        sheet = item['sheet']
-        row_index = item['row_index']
-
-        # update progress
-        task.set_breakpoint(sheet, row_index, save=True)
-
-        # scrape the entity if not exists
-        try:
-            entity = entity_class.objects.get(source_url=data.url)
-            print(f'Task {task.pk}: {len(items)+1} remaining; matched {data.url}')
-        except ObjectDoesNotExist:
+    rows = parser.parse()
+    rows_exhausted = False
+    # rows looked up but not scraped yet
+    items = deque()
+    # entities and marks already in db, looked up in bulk for each chunk of rows:
+    # {entity_class: {url: entity}}, {mark_class: {entity id: mark}}
+    entities = {}
+    marks = {}
+    # rows being scraped ahead, in original order
+    pending = deque()
+    # url: future of scrape_item
+    scraping = {}
+    fetcher = ThreadPoolExecutor(max_workers=settings.SYNC_SCRAPE_CONCURRENCY)
+
+    def read_ahead():
+        nonlocal rows_exhausted
+        while len(pending) < settings.SYNC_SCRAPE_CONCURRENCY * 2:
+            if not items:
+                if rows_exhausted:
+                    return
+                chunk = list(itertools.islice(rows, LOOKUP_BATCH_SIZE))
+                if not chunk:
+                    rows_exhausted = True
+                    return
+                resolve_items(chunk, task.user, entities, marks)
+                items.extend(chunk)
+            item = items.popleft()
+            url = item['data'].url
+            item['entity'] = entities[item['entity_class']].get(url)
+            if item['entity'] is None and url not in scraping:
+                scraping[url] = fetcher.submit(scrape_item, item['scraper'], url)
+            pending.append(item)
+
+    # marks are written in chunks, progress is saved to db right after each chunk so that resuming never skips unwritten rows
+    batch = MarkBatch(task.user, task.default_public)
+
+    def flush_batch():
+        failed = batch.flush()
+        if failed:
+            task.failed_urls += failed
+            task.success_items -= len(failed)
+            # forget marks not created
+            for mark_class in marks:
+                marks[mark_class] = {k: m for k, m in marks[mark_class].items() if m.pk is not None}
+        task.save_progress(force=True)
+
+    def row_done():
+        task.publish_progress()
+        if batch.is_due():
+            flush_batch()
+
+    try:
+        while not stop_check_func():
+            read_ahead()
+            if not pending:
+                break
+            item = pending.popleft()
+            data = item['data']
+            entity_class = item['entity_class']
+            mark_class = item['mark_class']
+            tag_class = item['tag_class']
+            scraper = item['scraper']
+            sheet = item['sheet']
+            row_index = item['row_index']
+            remaining = task.total_items - task.finished_items
+
+            # update progress
+            task.set_breakpoint(sheet, row_index)
+
+            # scrape the entity if not exists
+            entity = item['entity']
+            if entity is None:
+                # may have been saved for a previous row with same url
+                entity = entities[entity_class].get(data.url)
+                future = scraping.pop(data.url, None)
+            if entity is not None:
+                print(f'Task {task.pk}: {remaining} remaining; matched {data.url}')
+            else:
+                try:
+                    print(f'Task {task.pk}: {remaining} remaining; scraping {data.url}')
+                    if future is None:
+                        future = fetcher.submit(scrape_item, scraper, data.url)
+                    # saved under the lock of url, another import or user may be saving it too
+                    entity = get_or_scrape(scraper, data.url, task.user, future.result)
+                    entities[entity_class][data.url] = entity
+                except Exception as e:
+                    logger.error(f"Task {task.pk}: scrape failed: {data.url} {e}")
+                    if settings.DEBUG:
+                        logger.error("Expections during scraping data:", exc_info=e)
+                    task.failed_urls.append(data.url)
+                    task.finished_items += 1
+                    row_done()
+                    continue
+
+            # sync mark
             try:
-                print(f'Task {task.pk}: {len(items)+1} remaining; scraping {data.url}')
-                scraper.scrape(data.url)
-                form = scraper.save(request_user=task.user)
-                entity = form.instance
+                mark = marks[mark_class].get(entity.id)
+                if mark is None:
+                    marks[mark_class][entity.id] = batch.add_new_mark(data, entity, entity_class, mark_class, tag_class, sheet)
+                elif task.overwrite:
+                    batch.overwrite_mark(data, entity, mark, tag_class, sheet)
             except Exception as e:
-                logger.error(f"Task {task.pk}: scrape failed: {data.url} {e}")
-                if settings.DEBUG:
-                    logger.error("Expections during scraping data:", exc_info=e)
+                logger.error(
+                    f"Task {task.pk}: error when syncing marks", exc_info=e)
                 task.failed_urls.append(data.url)
                 task.finished_items += 1
-                task.save(update_fields=['failed_urls', 'finished_items'])
+                row_done()
                 continue
 
-        # sync mark
-        try:
-            # already exists
-            params = {
-                'owner': task.user,
-                entity_class.__name__.lower(): entity
-            }
-            mark = mark_class.objects.get(**params)
-
-            if task.overwrite:
-                overwrite_mark(entity, entity_class, mark,
-                               mark_class, tag_class, data, sheet)
-            else:
-                task.success_items += 1
-                task.finished_items += 1
-                task.save(update_fields=['success_items', 'finished_items'])
-                continue
-
-        except ObjectDoesNotExist:
-            add_new_mark(data, task.user, entity, entity_class,
-                         mark_class, tag_class, sheet, task.default_public)
-
-        except Exception as e:
-            logger.error(
-                f"Task {task.pk}: error when syncing marks", exc_info=e)
-            task.failed_urls.append(data.url)
+            task.success_items += 1
             task.finished_items += 1
-            task.save(update_fields=['failed_urls', 'finished_items'])
-            continue
+            row_done()
 
-        task.success_items += 1
-        task.finished_items += 1
-        task.save(update_fields=['success_items', 'finished_items'])
+    finally:
+        # rows not synced yet will be read again when resumed
+        for future in scraping.values():
+            future.cancel()
+        fetcher.shutdown()
+        rows.close()
+        flush_batch()
 
     # if task finish
     print(f'Task {task.pk}: stopping')
-    if len(items) == 0:
+    http.log_stats()
+    if rows_exhausted and len(items) == 0 and len(pending) == 0:
         task.is_finished = True
         task.clear_breakpoint()
-        task.save(update_fields=['is_finished', 'break_point'])
+        task.save(update_fields=['is_finished', 'is_failed', 'break_point'])
+        task.clear_progress()
 
 
 def translate_status(sheet_name):
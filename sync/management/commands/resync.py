@@ -6,7 +6,7 @@ from users.models import User
 from django.core.exceptions import ObjectDoesNotExist, PermissionDenied
 from tqdm import tqdm
 from django.conf import settings
-import requests
+from common import http
 import os
 
 
@@ -44,7 +44,7 @@ class Command(BaseCommand):
         self.stdout.write(f'Checking local proxy...{settings.LOCAL_PROXY}')
         url = f'{settings.LOCAL_PROXY}?url=https://www.douban.com/doumail/'
         try:
-            r = requests.get(url, timeout=settings.SCRAPING_TIMEOUT)
+            r = http.get(url, timeout=settings.SCRAPING_TIMEOUT)
         except Exception as e:
             self.stdout.write(self.style.ERROR(e))
             return
@@ -80,8 +80,8 @@ class Command(BaseCommand):
                 except ObjectDoesNotExist:
                     try:
                         # self.stdout.write(f'Fetching {url} via {scraper.__name__}')
-                        scraper.scrape(url)
-                        form = scraper.save(request_user=user)
+                        result = scraper.scrape(url)
+                        form = scraper.save(user, result)
                         f_s.write(url + '\n')
                         f_s.flush()
                         os.fsync(f_s.fileno())
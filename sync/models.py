@@ -4,6 +4,18 @@ import django.contrib.postgres.fields as postgres
 from users.models import User
 from common.utils import GenerateDateUUIDMediaFilePath
 from django.conf import settings
+import django_rq
+import logging
+import json
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+# fields updated while task is running
+PROGRESS_FIELDS = ['break_point', 'finished_items', 'success_items', 'failed_urls']
+PROGRESS_TTL = 86400
 
 
 def sync_file_path(instance, filename):
@@ -110,3 +122,54 @@ class SyncTask(models.Model):
         self.break_point = ""
         if save:
             self.save(update_fields=['break_point'])
+
+    @property
+    def progress_key(self):
+        return f'sync_task:{self.id}:progress'
+
+    def publish_progress(self):
+        """
+        Publish progress to redis for views to read
+        """
+        try:
+            progress = {f: getattr(self, f) for f in PROGRESS_FIELDS}
+            django_rq.get_connection('doufen').set(self.progress_key, json.dumps(progress), ex=PROGRESS_TTL)
+        except Exception as e:
+            logger.error(f'Error publishing progress of task {self.id}: {e}')
+
+    def save_progress(self, force=False):
+        """
+        Publish progress, and write it to db every SYNC_PROGRESS_FLUSH_ITEMS calls
+        or SYNC_PROGRESS_FLUSH_INTERVAL seconds.
+        Breakpoint is written together with counters, so a crashed task resumes
+        from a row consistent with them.
+        """
+        self.publish_progress()
+        self._unsaved_progress = getattr(self, '_unsaved_progress', 0) + 1
+        now = time.time()
+        if force or self._unsaved_progress >= settings.SYNC_PROGRESS_FLUSH_ITEMS \
+                or now - getattr(self, '_progress_saved_time', 0) >= settings.SYNC_PROGRESS_FLUSH_INTERVAL:
+            self.save(update_fields=PROGRESS_FIELDS)
+            self._unsaved_progress = 0
+            self._progress_saved_time = now
+
+    def load_progress(self):
+        """
+        Update progress with the latest one published by running job, if any
+        """
+        if self.is_finished:
+            return self
+        try:
+            progress = django_rq.get_connection('doufen').get(self.progress_key)
+            if progress:
+                for f, v in json.loads(progress).items():
+                    setattr(self, f, v)
+        except Exception as e:
+            logger.error(f'Error loading progress of task {self.id}: {e}')
+        return self
+
+    def clear_progress(self):
+        try:
+            django_rq.get_connection('doufen').delete(self.progress_key)
+        except Exception as e:
+            logger.error(f'Error clearing progress of task {self.id}: {e}')
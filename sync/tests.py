@@ -1,3 +1,66 @@
-from django.test import TestCase
+from datetime import datetime
+from unittest import mock
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from books.models import Book, BookMark, BookTag
+from timeline.models import Activity
+from users.models import User
+from .jobs import MarkBatch, DoufenRowData
 
-# Create your tests here.
+
+class MarkBatchTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='doufen', mastodon_id='1', mastodon_site='example.org')
+        self.books = [Book.objects.create(title=f'Book {n}', source_url=f'https://book.douban.com/subject/{n}/', source_site='douban') for n in range(3)]
+        self.batch = MarkBatch(self.user, True)
+
+    def row(self, book, tags=None, rating=8):
+        return DoufenRowData(url=book.source_url, tags=tags or [], time=timezone.make_aware(datetime(2022, 1, 1)), content='ok', rating=rating)
+
+    def test_counts(self):
+        mark = BookMark.objects.create(owner=self.user, book=self.books[2], status='wish')
+        self.batch.add_new_mark(self.row(self.books[0]), self.books[0], Book, BookMark, BookTag, '读过')
+        self.batch.add_new_mark(self.row(self.books[1]), self.books[1], Book, BookMark, BookTag, '想读')
+        self.batch.overwrite_mark(self.row(self.books[2]), self.books[2], mark, BookTag, '在读')
+        # same mark again, e.g. a later row with same url
+        self.batch.overwrite_mark(self.row(self.books[2]), self.books[2], mark, BookTag, '读过')
+        self.assertEqual(len(self.batch), 4)
+        self.assertEqual(len(self.batch.created), 2)
+        self.assertEqual(len(self.batch.updated), 1)
+        with override_settings(SYNC_PROGRESS_FLUSH_ITEMS=4):
+            self.assertTrue(self.batch.is_due())
+        with override_settings(SYNC_PROGRESS_FLUSH_ITEMS=5):
+            self.assertFalse(self.batch.is_due())
+
+    def test_flush(self):
+        mark = BookMark.objects.create(owner=self.user, book=self.books[2], status='wish')
+        BookTag.objects.create(content='old', book=self.books[2], mark=mark)
+        self.batch.add_new_mark(self.row(self.books[0], ['a', 'b']), self.books[0], Book, BookMark, BookTag, '读过')
+        self.batch.add_new_mark(self.row(self.books[1], ['a'], rating=None), self.books[1], Book, BookMark, BookTag, '想读')
+        self.batch.overwrite_mark(self.row(self.books[2], ['c']), self.books[2], mark, BookTag, '读过')
+        self.assertEqual(self.batch.flush(), [])
+        self.assertEqual(len(self.batch), 0)
+        self.assertEqual(BookMark.objects.filter(owner=self.user).count(), 3)
+        self.assertEqual(BookTag.objects.filter(mark__owner=self.user).count(), 4)
+        self.assertEqual(list(BookTag.objects.filter(mark=mark).values_list('content', flat=True)), ['c'])
+        self.assertEqual(BookMark.objects.get(pk=mark.pk).status, 'collect')
+        self.assertEqual(Activity.objects.filter(owner=self.user).count(), 3)
+        self.books[0].refresh_from_db()
+        self.assertEqual(self.books[0].rating_number, 1)
+
+    def test_flush_failed(self):
+        self.batch.add_new_mark(self.row(self.books[0]), self.books[0], Book, BookMark, BookTag, '读过')
+        mark = self.batch.created[0]
+        write = MarkBatch._write
+
+        def write_and_fail(batch):
+            # marks get pks from bulk_create, then the transaction is rolled back
+            write(batch)
+            raise RuntimeError()
+
+        with mock.patch.object(MarkBatch, '_write', write_and_fail):
+            self.assertEqual(self.batch.flush(), [self.books[0].source_url])
+        self.assertIsNone(mark.pk)
+        self.assertTrue(mark._state.adding)
+        self.assertEqual(len(self.batch), 0)
+        self.assertFalse(BookMark.objects.filter(owner=self.user).exists())
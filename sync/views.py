@@ -48,6 +48,7 @@ def sync_douban(request):
 def query_progress(request):
     task = request.user.user_synctasks.order_by('-id').first()
     if task is not None:
+        task.load_progress()
         return JsonResponse({
             'progress': task.get_progress()
         })
@@ -59,6 +60,7 @@ def query_progress(request):
 def query_last_task(request):
     task = request.user.user_synctasks.order_by('-id').first()
     if task is not None:
+        task.load_progress()
         return JsonResponse({
             'total_items': task.total_items,
             'success_items': task.success_items,
@@ -61,10 +61,11 @@ def preferences(request):
 @mastodon_request_included
 @login_required
 def data(request):
+    latest_task = request.user.user_synctasks.order_by("-id").first()
     return render(request, 'users/data.html', {
         'allow_any_site': settings.MASTODON_ALLOW_ANY_SITE,
-        'latest_task': request.user.user_synctasks.order_by("-id").first(),
-        'import_status': request.user.get_preference().import_status,
+        'latest_task': latest_task.load_progress() if latest_task else None,
+        'import_status': DoubanImporter.get_user_import_status(request.user),
         'export_status': request.user.get_preference().export_status
     })
 